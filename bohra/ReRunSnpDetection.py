@@ -1,5 +1,5 @@
 import pathlib
-import os,getpass
+import os,getpass,shutil
 import pandas
 import jinja2
 import sh
@@ -36,8 +36,13 @@ class ReRunSnpDetection(RunSnpDetection):
 
         self.run_kraken = False
         self.kraken_db = args.kraken_db
+        # versions of the tools used, found once when dependencies are checked
+        self.tool_manifest = {}
         # get original data 
         self.get_source()
+        # keep the previous core builder unless a new one is given
+        if args.core_builder is not None:
+            self.core_builder = args.core_builder
         # Reference mask and snippy
         
         if self.pipeline != 'a':
@@ -45,6 +50,8 @@ class ReRunSnpDetection(RunSnpDetection):
             # check dependencies
             self.check_for_snippy()
             self.mask = self.check_mask(args.mask, original_mask = self.original_mask)
+            if f"{self.mask}" != self.original_mask and self.core_builder == 'bohra':
+                logger.info(f"The mask has changed, the core alignment will be updated from the saved core without rebuilding it.")
         elif self.pipeline == 'a':
             self.snippy_version = ''
             self.ref = ''
@@ -67,10 +74,24 @@ class ReRunSnpDetection(RunSnpDetection):
         
         self.dryrun = args.dry_run
         self.keep = args.keep
+        self.preflight = args.preflight
         
         self.assembler_dict = {'shovill': 'shovill', 'skesa':'skesa','spades':'spades.py'}
         
         self.cpus = args.cpus
+        # keep the previous subsampling depth unless a new one is given
+        self.original_max_depth = self.max_depth
+        if args.max_depth is not None:
+            self.max_depth = args.max_depth
+        # keep the previous tree update fraction unless a new one is given
+        if args.tree_update is not None:
+            self.tree_update = args.tree_update
+        # keep the previous tree mode unless a new one is given
+        if args.tree_mode is not None:
+            self.tree_mode = args.tree_mode
+        # keep the previous snp thresholds unless new ones are given
+        if args.snp_thresholds is not None:
+            self.snp_thresholds = args.snp_thresholds
         self.set_snakemake_jobs()
 
     def get_cluster_reqs(self):
@@ -121,6 +142,12 @@ class ReRunSnpDetection(RunSnpDetection):
         self.cpus = df.loc[df.index[-1], 'CPUS']
         self.prefillpath = df.loc[df.index[-1], 'prefillpath']
         self.minaln = df.loc[df.index[-1], 'MinAln']
+        self.max_depth = int(df.loc[df.index[-1], 'MaxDepth']) if 'MaxDepth' in df.columns and not pandas.isnull(df.loc[df.index[-1], 'MaxDepth']) else 0
+        self.core_builder = df.loc[df.index[-1], 'CoreBuilder'] if 'CoreBuilder' in df.columns and not pandas.isnull(df.loc[df.index[-1], 'CoreBuilder']) else 'snippy'
+        self.tree_update = float(df.loc[df.index[-1], 'TreeUpdate']) if 'TreeUpdate' in df.columns and not pandas.isnull(df.loc[df.index[-1], 'TreeUpdate']) else 0.1
+        self.tree_mode = df.loc[df.index[-1], 'TreeMode'] if 'TreeMode' in df.columns and not pandas.isnull(df.loc[df.index[-1], 'TreeMode']) else 'ml'
+        self.original_tree_mode = self.tree_mode
+        self.snp_thresholds = f"{df.loc[df.index[-1], 'SnpThresholds']}" if 'SnpThresholds' in df.columns and not pandas.isnull(df.loc[df.index[-1], 'SnpThresholds']) else '5,10,25'
         
         # return reference, mask, snippy_version, date, input_file, pipeline
         
@@ -170,7 +197,7 @@ class ReRunSnpDetection(RunSnpDetection):
         df = pandas.read_csv('source.log', sep = None, engine = 'python')
         # if self.pipeline == 'a':
         snippy_v = f'singularity_{self.day}' if self.use_singularity else self.snippy_version
-        data =pandas.DataFrame({'JobID':self.job_id, 'Reference':self.ref,'Mask':self.mask, 'Pipeline': self.pipeline, 'CPUS': self.cpus,'MinAln':self.minaln,'Date':self.day, 'User':self.user,'snippy_version':snippy_v ,'input_file':f"{self.input_file}",'prefillpath': self.prefillpath,'Assembler':self.assembler},index=[0])
+        data =pandas.DataFrame({'JobID':self.job_id, 'Reference':self.ref,'Mask':self.mask, 'Pipeline': self.pipeline, 'CPUS': self.cpus,'MinAln':self.minaln,'Date':self.day, 'User':self.user,'snippy_version':snippy_v ,'input_file':f"{self.input_file}",'prefillpath': self.prefillpath,'Assembler':self.assembler, 'MaxDepth': self.max_depth, 'CoreBuilder': self.core_builder, 'TreeUpdate': self.tree_update, 'TreeMode': self.tree_mode, 'SnpThresholds': self.snp_thresholds},index=[0])
         df = df.append(data, sort = True)
         df.to_csv('source.log', index=False, sep = '\t')
     
@@ -206,13 +233,40 @@ class ReRunSnpDetection(RunSnpDetection):
     def remove_core(self):
         '''
         Need to remove core_isolates.txt to get snakemake to redo snippy core step
+        saved distances in cache/ are kept and only updated for the isolates and core sites that change
+        the bohra core builder keeps the full alignment in cache/, if only the mask has changed it is updated in place
+        an ml tree is kept in cache/ so that new isolates can be placed on it, a quick tree is not a good place to start from
         '''
         logger.info(f"Removing previous snippy-core output.")
+        cache = pathlib.Path(self.workdir, self.job_id, 'cache')
+        full_aln = pathlib.Path(self.workdir, self.job_id, 'core.full.aln')
+        if self.core_builder == 'bohra' and full_aln.exists():
+            cache.mkdir(exist_ok = True)
+            full_aln.rename(cache / 'core.full.aln')
+        tree = pathlib.Path(self.workdir, self.job_id, 'core.treefile')
+        if tree.exists() and self.original_tree_mode == 'ml':
+            cache.mkdir(exist_ok = True)
+            tree.rename(cache / 'previous.treefile')
         corefiles = sorted(pathlib.Path(self.workdir, self.job_id).glob('core*'))
         if corefiles:
             for core in corefiles:
                 core.unlink()
         
+    def remove_subsampled(self):
+        '''
+        if the subsampling depth has changed the reads and the snippy and assembly outputs made from them are removed
+        so snakemake makes them again - the outputs would otherwise be newer than the reads and not be redone
+        '''
+        if self.max_depth == self.original_max_depth:
+            return
+        logger.info(f"The subsampling depth has changed from {self.original_max_depth} to {self.max_depth}, SNPs will be called and isolates assembled again.")
+        jobdir = pathlib.Path(self.workdir, self.job_id)
+        shutil.rmtree(jobdir / 'SUBSAMPLED', ignore_errors = True)
+        outputs = sorted(jobdir.glob('*/snps.vcf')) + sorted(jobdir.glob('*/snps.aligned.fa')) + [d / f"{d.name}.fa" for d in sorted(jobdir.iterdir()) if d.is_dir()]
+        for output in outputs:
+            if output.exists():
+                output.unlink()
+
     def check_singularity_directory(self):
         '''
         Check if the singularity directory is empty
@@ -245,6 +299,7 @@ class ReRunSnpDetection(RunSnpDetection):
             # check that the .singularity directory is present... if not rerun from scratch
             self.check_singularity_directory()
             logger.info(f"You have chosen to run bohra with singularity containers. Good luck")
+            self.write_tool_manifest()
 
         else:
             # check if the previous run used singularity - if so check for containers.
@@ -253,6 +308,7 @@ class ReRunSnpDetection(RunSnpDetection):
         self.update_source_log()
         self.rerun_report()
         self.remove_core()
+        self.remove_subsampled()
         
         isolates = self.set_workflow_input()
         # setup the workflow files Snakefile and config file
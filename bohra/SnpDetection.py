@@ -13,6 +13,9 @@ import json
 from Bio import SeqIO, Phylo
 from packaging import version
 from bohra.bohra_logger import logger
+from bohra.preflight import check_reads
+from bohra.utils.tool_manifest import build_manifest, container_manifest, write_manifest, pipeline_tools
+from bohra.scheduler import host_resources, reads_gb, plan_resources
 # from bohra.utils.write_report import Report
 
 
@@ -84,9 +87,23 @@ class RunSnpDetection(object):
         self.run_kraken = False
         self.assembler = args.assembler
         self.snippy_version = ''
+        # versions of the tools used, found once when dependencies are checked
+        self.tool_manifest = {}
         self.assembler_dict = {'shovill': 'shovill', 'skesa':'skesa','spades':'spades.py'}
         self.use_singularity = args.use_singularity
         self.singularity_path = args.singularity_path
+        # subsample reads to this depth before snippy and assembly (0 = use all reads)
+        self.max_depth = args.max_depth
+        # check gzip integrity and pairing of all reads before starting
+        self.preflight = args.preflight
+        # tool used to build the core alignment - snippy-core or the bohra core_builder
+        self.core_builder = args.core_builder
+        # on rerun new isolates are placed on the previous tree unless more than this fraction are new
+        self.tree_update = args.tree_update
+        # ml tree with iqtree or a quick neighbour joining tree
+        self.tree_mode = args.tree_mode
+        # snp thresholds for clusters
+        self.snp_thresholds = args.snp_thresholds
         self.set_snakemake_jobs()
 
     def check_queue(self, queue):
@@ -117,12 +134,22 @@ class RunSnpDetection(object):
         
     def set_snakemake_jobs(self):
         '''
-        set the number of jobs to run in parallel based on the number of cpus from args
+        set the number of cores and the memory (mb) snakemake can use, from the cpus from args and what is free on the host
         '''
-        if int(self.cpus) < int(psutil.cpu_count()):
-            self.jobs =  self.cpus
-        else:
-            self.jobs = 1
+        self.jobs, self.mem_mb = host_resources(self.cpus)
+
+    def plan_resources(self, isolates):
+        '''
+        the threads and memory of each rule, from the cores and memory free and the number of isolates and size of their reads
+        input:
+            :isolates: a list of isolates in the job
+        output:
+            a dictionary of the threads and mem_mb of each rule
+        '''
+        reads = [[self.workdir / self.job_id / 'READS' / f"{i}" / r for r in ['R1.fq.gz', 'R2.fq.gz']] for i in isolates]
+        plan = plan_resources(self.jobs, self.mem_mb, len(isolates), reads_gb(reads))
+        logger.info(f"Running with {self.jobs} cores and {self.mem_mb} MB of memory, {plan['snippy']['threads']} threads for each isolate with snippy")
+        return(plan)
     
     def force_overwrite(self):
         '''
@@ -160,15 +187,13 @@ class RunSnpDetection(object):
         '''
         logger.info(f"Checking that snippy is installed and recording version.")
         version_pat = re.compile(r'\bv?(?P<major>[0-9]+)\.(?P<minor>[0-9]+)\.(?P<release>[0-9]+)(?:\.(?P<build>[0-9]+))?\b')
-        try:
-            snippy = subprocess.run(['snippy', '--version'], stderr=subprocess.PIPE)
-            snippy = snippy.stderr.decode().strip()
-            self.snippy_version = version_pat.search(snippy)
-            logger.info(f"Snippy {snippy} found. Good job!")
-            return(version_pat.search(snippy))
-        except FileNotFoundError:
+        snippy = self.tool_manifest.get('snippy', {})
+        if not snippy.get('found'):
             logger.info(f"snippy is not installed.")
             raise SystemExit
+        self.snippy_version = version_pat.search(snippy['version'])
+        logger.info(f"Snippy {snippy['version']} found. Good job!")
+        return(self.snippy_version)
     
     def check_snippycore(self):
         '''
@@ -176,12 +201,6 @@ class RunSnpDetection(object):
         '''
         self.check_installation('snippy-core')
 
-    def check_snpdists(self):
-        '''
-        check for snp-dists
-        '''
-        self.check_installation('snp-dists')
-
 
 
     def check_iqtree(self):
@@ -192,12 +211,12 @@ class RunSnpDetection(object):
 
     def check_installation(self,software):
         '''
-        Check that software is installed
+        Check that software is installed, from the tool manifest if it has been found
         input:
             :software: the name of the software - must be command line name 
         '''
 
-        if shutil.which(software):
+        if self.tool_manifest[software]['found'] if software in self.tool_manifest else shutil.which(software):
             logger.info(f"{software} is installed")
         else:
             logger.warning(f"{software} is not installed, please check dependencies and try again.")
@@ -242,12 +261,10 @@ class RunSnpDetection(object):
         '''
         if pathlib.Path(k2db).is_dir():
                 logger.info(f'Found {k2db}, checking that files are not empty')
-                kmerfiles = sorted(pathlib.Path(k2db).glob('*'))
-                s = []
-                for k in range(len(kmerfiles)):
-                    s.append(self.check_size_file(pathlib.Path(k2db) / kmerfiles[k]))
-                if 0 not in s:
-                    self.run_kraken = True
+                # the sizes come from a single directory scan, stopping at the first empty file
+                with os.scandir(k2db) as entries:
+                    if all(e.stat().st_size > 0 for e in entries if not e.name.startswith('.')):
+                        self.run_kraken = True
         
 
     def check_kraken2DB(self):
@@ -273,16 +290,32 @@ class RunSnpDetection(object):
             logger.warning(f"Your kraken DB is not installed in the expected path. Speciation will not be performed. If you would like to perform speciation in future please re-read bohra installation instructions.")
             
 
+    def write_tool_manifest(self):
+        '''
+        record the versions of the tools used by the pipeline in tool_manifest.json, which the report reads
+        when containers are used the tools are not on this machine so the containers are recorded instead
+        '''
+        tools = pipeline_tools(self.pipeline, self.assembler)
+        if self.use_singularity:
+            self.tool_manifest = container_manifest(tools, self.singularity_path, f"singularity_{self.day}")
+        else:
+            # all tools are found and their versions recorded at once
+            self.tool_manifest = build_manifest(tools, cache_path = self.workdir / 'tool_cache.json')
+        J = pathlib.Path(self.workdir, self.job_id)
+        J.mkdir(exist_ok = True)
+        write_manifest(self.tool_manifest, J / 'tool_manifest.json')
+
     def check_deps(self):
         '''
-        check dependencies Snippy, snippy-core, snp-dists, iqtree
+        check dependencies Snippy, snippy-core, iqtree
         '''
         # TODO check all software tools used and is there a way to check database last update??
         # TODO check assemblers
         logger.info(f"Checking software dependencies")
+        self.write_tool_manifest()
         if self.pipeline != "a":
-            self.check_snippycore()
-            self.check_snpdists()
+            if self.core_builder == 'snippy':
+                self.check_snippycore()
             self.check_kraken2DB()
             self.check_iqtree()
             return(self.check_snippy())
@@ -341,7 +374,7 @@ class RunSnpDetection(object):
         logger.info(f"Recording your settings for job: {self.job_id}")
         new_df = pandas.DataFrame({'JobID':self.job_id, 'Reference':f"{self.ref}",'Mask':f"{self.mask}", 
                                     'MinAln':self.minaln, 'Pipeline': self.pipeline, 'CPUS': self.cpus, 'Assembler':self.assembler,
-                                    'Date':self.day, 'User':self.user, 'snippy_version':snippy_v, 'input_file':f"{self.input_file}",'prefillpath': self.prefillpath, 'cluster': self.cluster,'singularity': s, 'kraken_db':kraken}, 
+                                    'Date':self.day, 'User':self.user, 'snippy_version':snippy_v, 'input_file':f"{self.input_file}",'prefillpath': self.prefillpath, 'cluster': self.cluster,'singularity': s, 'kraken_db':kraken, 'MaxDepth': self.max_depth, 'CoreBuilder': self.core_builder, 'TreeUpdate': self.tree_update, 'TreeMode': self.tree_mode, 'SnpThresholds': self.snp_thresholds}, 
                                     index=[0], )
         
         source_path = self.workdir / 'source.log'
@@ -603,6 +636,29 @@ class RunSnpDetection(object):
                 self.link_reads(pathlib.Path(r2), isolate_id=f"{i[1].strip()}", r_pair='R2.fq.gz')
         return True
 
+    def preflight_reads(self, tab):
+        '''
+        check every read file is a complete gzip (CRC and length trailer) and that R1 and R2 have the same reads.
+        Files are checked in parallel and results are kept in preflight.json, so unchanged files are not checked again on rerun.
+        :input
+            :tab: dataframe of the input file
+        '''
+        logger.info(f"Checking the integrity and pairing of all read files. This may take some time.")
+        pairs = []
+        for i in tab.itertuples():
+            if not '#' in i[1]:
+                r1 = pathlib.Path(i[2]) if f"{i[2]}"[0] == '/' else self.workdir / i[2]
+                r2 = pathlib.Path(i[3]) if f"{i[3]}"[0] == '/' else self.workdir / i[3]
+                pairs.append((f"{i[1].strip()}", r1, r2))
+        problems = check_reads(pairs, cache_path = self.workdir / 'preflight.json', workers = self.cpus)
+        if problems:
+            for p in problems:
+                logger.warning(p)
+            logger.warning(f"Some read files are corrupt or not correctly paired. Please fix or remove them from {self.input_file} and try again.")
+            raise SystemExit
+        logger.info(f"All read files passed the integrity check.")
+        return True
+
     def set_isolate_log(self, tab, logfile, validation = False):
         '''
         add the isolates to a log file also adds in anoterh check that this is a rerun of an existing job
@@ -613,6 +669,8 @@ class RunSnpDetection(object):
         '''        
         self.check_input_structure(tab=tab)
         self.check_reads_exists(tab=tab)
+        if self.preflight:
+            self.preflight_reads(tab=tab)
         logger.info(f"Recording the isolates used in job: {self.job_id} on {self.day}")
         lf = pandas.DataFrame({'Isolate': [i for i in list(tab.iloc[ : , 0]) if '#' not in i ], 'Status': f"INCLUDED", 'Date': self.day})
         lf['Status'] = numpy.where(lf['Isolate'].str.contains('#'), f"REMOVED", lf['Status'])
@@ -711,6 +769,98 @@ rule combine_kraken:
 		id_table.to_csv(f\"{{output}}\", sep = \"\\t\", index = False)
 		subprocess.run(f"sed -i 's/%[0-9]/%/g' {{output}}", shell=True)
 """)
+    def subsample_string(self, script_path):
+        '''
+        the rule for subsampling reads to max_depth before snippy and assembly
+        '''
+        return(f"""
+localrules: subsample
+
+rule subsample:
+	input:
+		'READS/{{sample}}/R1.fq.gz',
+		'READS/{{sample}}/R2.fq.gz',
+		'{{sample}}/yield.tab'
+	output:
+		'SUBSAMPLED/{{sample}}/R1.fq.gz',
+		'SUBSAMPLED/{{sample}}/R2.fq.gz'
+	shell:
+		\"""
+		python3 {script_path}/subsample.py {{input[0]}} {{input[1]}} --yield_tab {{input[2]}} --depth {self.max_depth} --outdir SUBSAMPLED/{{wildcards.sample}}
+		\"""
+
+""")
+
+    def core_string(self, script_path, maskstring):
+        '''
+        the rule for building the core alignment with snippy-core or the bohra core_builder
+        '''
+        if self.core_builder == 'bohra':
+            return(f"""
+rule run_snippy_core:
+	input:
+		'core_isolates.txt',
+		'ref.fa'
+	output:
+		'core.vcf',
+		'core.txt',
+		'core.aln', 
+		'core.full.aln',
+		'core.tab'
+	threads:
+		{self.rule_resources['run_snippy_core']['threads']}
+	resources:
+		mem_mb = {self.rule_resources['run_snippy_core']['mem_mb']}
+	shell:
+		\"""
+		python3 {script_path}/core_builder.py {maskstring} --ref {{input[1]}} --state cache/core_state.npz --full_cache cache/core.full.aln -j {{threads}} $(cat core_isolates.txt)
+		\"""
+	
+""")
+        return(f"""
+rule run_snippy_core:
+	input:
+		'core_isolates.txt'
+	output:
+		'core.vcf',
+		'core.txt',
+		'core.aln', 
+		'core.full.aln',
+		'core.tab'
+	threads:
+		1
+	resources:
+		mem_mb = {self.rule_resources['run_snippy_core']['mem_mb']}
+	singularity:"{self.singularity_path}/snippy"
+	shell:
+		\"""
+		snippy-core {maskstring} --ref {{REFERENCE}}  $(cat core_isolates.txt)
+		
+		\"""
+	
+""")
+
+    def tree_string(self, script_path):
+        '''
+        the rule for a neighbour joining tree from the snp distances, it takes priority over iqtree for core.treefile
+        '''
+        if self.tree_mode != 'quick':
+            return('')
+        return(f"""
+ruleorder: run_quick_tree > run_iqtree_core
+
+rule run_quick_tree:
+	input:
+		'distances.tab'
+	output:
+		'core.treefile'
+	shell:
+		\"""
+		python3 {script_path}/quick_tree.py {{input}} -o {{output}}
+		\"""
+	
+""")
+
     def species_summary(self):
         return "'species_identification.tab'"
 
@@ -722,12 +872,14 @@ rule combine_kraken:
 
         return "cp species_identification.tab report/species_identification.tab"
 
-    def write_pipeline_job(self, maskstring,  script_path = f"{pathlib.Path(__file__).parent / 'utils'}", resource_path = f"{pathlib.Path(__file__).parent / 'templates'}"):
+    def write_pipeline_job(self, maskstring, isolates = (), script_path = f"{pathlib.Path(__file__).parent / 'utils'}", resource_path = f"{pathlib.Path(__file__).parent / 'templates'}"):
         '''
         write out the pipeline string for transfer to job specific pipeline
         '''
         
         wd = self.workdir / self.job_id
+        # threads and memory of each rule
+        self.rule_resources = self.plan_resources(isolates)
         
         
         kraken_output = self.kraken_output() if self.run_kraken else ''
@@ -736,6 +888,11 @@ rule combine_kraken:
         kraken_report = self.kraken_report() if self.run_kraken else ''    
         copy_species_id = self.kraken_copy() if self.run_kraken else ''  
         species_summary = self.species_summary() if self.run_kraken else '' 
+        subsample = self.max_depth > 0
+        subsample_rule = self.subsample_string(script_path = script_path) if subsample else ''
+        reads_dir = 'SUBSAMPLED' if subsample else 'READS'
+        core_rule = self.core_string(script_path = script_path, maskstring = maskstring) if self.pipeline != 'a' else ''
+        tree_rule = self.tree_string(script_path = script_path) if self.pipeline != 'a' else ''
 
         pipeline_setup = {
             's':'Snakefile_snippy',
@@ -758,7 +915,17 @@ rule combine_kraken:
             'kraken_summary': kraken_summary,
             'species_report': kraken_report,
             'species_summary':species_summary,
-            'copy_species_id': copy_species_id
+            'copy_species_id': copy_species_id,
+            'subsample_rule': subsample_rule,
+            'reads_dir': reads_dir,
+            'core_rule': core_rule,
+            'cpus': self.cpus,
+            'tree_update': self.tree_update,
+            # constant site counts are shared by all jobs in the working directory
+            'const_sites_cache': f"{self.workdir / 'const_sites.json'}",
+            'tree_rule': tree_rule,
+            'snp_thresholds': self.snp_thresholds,
+            'rules': self.rule_resources
         }
         
         logger.info(f"Writing Snakefile for job : {self.job_id}")
@@ -845,7 +1012,7 @@ rule combine_kraken:
         
         logger.info(f"Config file successfully created")
 
-        self.write_pipeline_job(maskstring = maskstring)
+        self.write_pipeline_job(maskstring = maskstring, isolates = isolates)
         
 
  
@@ -874,7 +1041,7 @@ rule combine_kraken:
         if self.cluster:
             cmd = f"{self.cluster_cmd()} -s {snake_name} {force} {singularity_string} --latency-wait 1200"
         else:
-            cmd = f"snakemake {dry} -s {snake_name} --cores {self.cpus} {force} {singularity_string} 2>&1 | tee -a bohra.log"
+            cmd = f"snakemake {dry} -s {snake_name} --cores {self.jobs} --resources mem_mb={self.mem_mb} {force} {singularity_string} 2>&1 | tee -a bohra.log"
             # cmd = f"snakemake -s {snake_name} --cores {self.cpus} {force} "
         logger.info(f"Running job : {self.job_id} with {cmd} this may take some time. We appreciate your patience.")
         wkf = subprocess.run(cmd, shell = True)
@@ -895,6 +1062,7 @@ rule combine_kraken:
         # check the pipeline setup 
         if self.use_singularity:
             logger.info(f"You have chosen to run bohra with singularity containers. Good luck")
+            self.write_tool_manifest()
         else:
             self.run_checks()
         
@@ -918,7 +1086,7 @@ rule combine_kraken:
                     force = f"-F"
                 else:
                     force = f""
-                logger.info(f"snakemake -j {self.jobs} {force} 2>&1 | tee -a bohra.log")
+                logger.info(f"snakemake -j {self.jobs} --resources mem_mb={self.mem_mb} {force} 2>&1 | tee -a bohra.log")
             logger.info(f"Have a nice day. Come back soon.") 
             
 
@@ -39,6 +39,47 @@ def rerun_pipeline(args):
     return(R.run_pipeline())
 
 
+def non_negative_int(value):
+    '''
+    check that a command line value is a whole number that is not negative
+    '''
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"{value} is not a whole number")
+    if number < 0:
+        raise argparse.ArgumentTypeError(f"{value} can not be negative")
+    return(number)
+
+
+def non_negative_float(value):
+    '''
+    check that a command line value is a number that is not negative
+    '''
+    try:
+        number = float(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"{value} is not a number")
+    if not number >= 0:
+        raise argparse.ArgumentTypeError(f"{value} can not be negative")
+    return(number)
+
+
+def snp_thresholds(value):
+    '''
+    check that the snp thresholds are comma separated whole numbers above 0
+    output:
+        the thresholds sorted and without repeats, joined with commas
+    '''
+    try:
+        thresholds = sorted(set(int(t) for t in value.split(',')))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"{value} is not a comma separated list of whole numbers")
+    if thresholds[0] < 1:
+        raise argparse.ArgumentTypeError(f"snp thresholds in {value} must be above 0")
+    return(','.join(f"{t}" for t in thresholds))
+
+
 def main():
     # setup the parser
   
@@ -51,21 +92,27 @@ def main():
     # options for running
     parser_sub_run.add_argument('--input_file','-i',help='Input file = tab-delimited with 3 columns <isolatename>  <path_to_read1> <path_to_read2>', default='')
     parser_sub_run.add_argument('-S', '--use_singularity', action='store_true', help = 'Set if you would like to use singularity containers to run bohra.')
-    parser_sub_run.add_argument('--singularity_path', default='shub://phgenomics-singularity', help='The path to singularity containers. If you want to use locally stored contianers please pull from shub://phgenomics-singularity (snippy.simg, prokka.simg, seqtk.simg, mash_kmc.simg, assemblers.simg, roary.simg). IMPORTANT bohra is designed to run with these containers... if you wish to use custom containers please contact developer or proceed at your own risk.')
+    parser_sub_run.add_argument('--singularity_path', default='shub://phgenomics-singularity', help='The path to singularity containers. If you want to use locally stored contianers please pull from shub://phgenomics-singularity (snippy.simg, prokka.simg, assemblers.simg, roary.simg). IMPORTANT bohra is designed to run with these containers... if you wish to use custom containers please contact developer or proceed at your own risk.')
     parser_sub_run.add_argument('--job_id','-j',help='Job ID, will be the name of the output directory', default='')
     parser_sub_run.add_argument('--reference','-r',help='Path to reference (.gbk or .fa)', default = '')
     parser_sub_run.add_argument('--mask','-m',default = False, help='Path to mask file if used (.bed)')
     parser_sub_run.add_argument('--kraken_db', '-k', env_var="KRAKEN2_DEFAULT_DB", help="Path to DB for use with kraken2, if no DB present speciation will not be performed.")
     parser_sub_run.add_argument('--pipeline','-p', default = 'sa', choices=['sa','s','a', 'all'], help=f"The pipeline to run. SNPS ('s') will call SNPs and generate phylogeny, ASSEMBLIES ('a') will generate assemblies and perform mlst and species identification using kraken2, SNPs and ASSEMBLIES ('sa' - default) will perform SNPs and ASSEMBLIES. ALL ('all') will perform SNPS, ASSEMBLIES and ROARY for pan-genome analysis")
     parser_sub_run.add_argument('--assembler','-a', default = 'shovill', choices=['shovill','skesa','spades'], help=f"Assembler to use.")
-    parser_sub_run.add_argument('--cpus','-c',help='Number of CPU cores to run, will define how many rules are run at a time', default=36)
+    parser_sub_run.add_argument('--cpus','-c',help='Number of CPU cores to run, will define how many rules are run at a time. Cores that are already busy on the machine are not used, and the threads and memory of each rule are set from the cores and memory free and the number of isolates', default=36)
     parser_sub_run.add_argument('--minaln','-ma',help='Minimum percent alignment', default=0)
+    parser_sub_run.add_argument('--max_depth', help='Subsample reads to this estimated depth before SNP calling and assembly, 0 will use all reads', default=0, type=non_negative_int)
+    parser_sub_run.add_argument('--core_builder', default = 'snippy', choices=['snippy', 'bohra'], help='Tool used to build the core alignment. bohra streams the snippy alignments with bounded memory and adds isolates to an existing core on rerun without rebuilding it.')
+    parser_sub_run.add_argument('--snp_thresholds', help='Comma separated snp thresholds for single linkage clusters, reported as a cluster code for each isolate in the summary', default='5,10,25', type=snp_thresholds)
+    parser_sub_run.add_argument('--tree_mode', default = 'ml', choices=['ml', 'quick'], help='ml builds the tree with iqtree, quick builds a neighbour joining tree from the snp distances in minutes for very large jobs. The ml tree can be built later with bohra rerun --tree_mode ml')
+    parser_sub_run.add_argument('--tree_update', help='On rerun, new isolates are placed on the previous tree and only a short tree search is run, unless more than this fraction of isolates are new. 0 will always build the tree from scratch', default=0.1, type=non_negative_float)
     parser_sub_run.add_argument('--prefillpath','-pf',help='Path to existing assemblies - in the form path_to_somewhere/isolatename/contigs.fa')
     parser_sub_run.add_argument('-mdu', action = "store_true", help='If running on MDU data')
     parser_sub_run.add_argument('-workdir','-w', default = f"{pathlib.Path.cwd().absolute()}", help='The directory where Bohra will be run, default is current directory')
     parser_sub_run.add_argument('-resources','-s', default = f"{pathlib.Path(__file__).parent / 'templates'}", help='Directory where templates are stored')
     parser_sub_run.add_argument('-force','-f', action="store_true", help = "Add if you would like to force a complete restart of the pipeline. All previous logs will be lost.")
     parser_sub_run.add_argument('-dry-run','-n', action="store_true", help = "If you would like to see a dry run of commands to be executed.")
+    parser_sub_run.add_argument('--preflight', action="store_true", help = "Check that all read files are complete gzip files and that R1 and R2 are correctly paired before starting. Results are cached so unchanged files are only checked once.")
     parser_sub_run.add_argument('--cluster', action="store_true", help = "If you are running Bohra on a cluster.")
     parser_sub_run.add_argument('--json',help='Path to cluster.json - required if --cluster is set', default='')
     parser_sub_run.add_argument('--queue',help='Type of queue (sbatch or qsub currently supported) - required if --cluster is set.', default='')
@@ -77,14 +124,20 @@ def main():
     parser_sub_rerun = subparsers.add_parser('rerun', help='Rerun of Bohra. Add or remove isolates from isolate list, change mask or reference.', formatter_class=configargparse.ArgumentDefaultsHelpFormatter,default_config_files=[f"{pathlib.Path.cwd().absolute() / 'bohra.conf'}"])
     # options for rerun
     parser_sub_rerun.add_argument('-S', '--use_singularity', action='store_true', help = 'Set if you would like to use singularity containers to run bohra.')
-    parser_sub_rerun.add_argument('--singularity_path', default='shub://phgenomics-singularity', help='The path to singularity containers. If you want to use locally stored contianers please pull from shub://phgenomics-singularity (snippy.simg, prokka.simg, seqtk.simg, mash_kmc.simg, assemblers.simg, roary.simg). IMPORTANT bohra is designed to run with these containers... if you wish to use custom containers please contact developer or proceed at your own risk.')
+    parser_sub_rerun.add_argument('--singularity_path', default='shub://phgenomics-singularity', help='The path to singularity containers. If you want to use locally stored contianers please pull from shub://phgenomics-singularity (snippy.simg, prokka.simg, assemblers.simg, roary.simg). IMPORTANT bohra is designed to run with these containers... if you wish to use custom containers please contact developer or proceed at your own risk.')
     parser_sub_rerun.add_argument('--reference','-r',help='Path to reference (.gbk or .fa)', default = '')
     parser_sub_rerun.add_argument('--mask','-m',default = '', help='Path to mask file if used (.bed)')
-    parser_sub_rerun.add_argument('--cpus','-c',help='Number of CPU cores to run, will define how many rules are run at a time', default=36)
+    parser_sub_rerun.add_argument('--cpus','-c',help='Number of CPU cores to run, will define how many rules are run at a time. Cores that are already busy on the machine are not used, and the threads and memory of each rule are set from the cores and memory free and the number of isolates', default=36)
+    parser_sub_rerun.add_argument('--max_depth', help='Subsample reads to this estimated depth before SNP calling and assembly, 0 will use all reads. If not set the depth from the previous run is used', default=None, type=non_negative_int)
+    parser_sub_rerun.add_argument('--core_builder', default = None, choices=['snippy', 'bohra'], help='Tool used to build the core alignment. If not set the tool from the previous run is used')
+    parser_sub_rerun.add_argument('--snp_thresholds', help='Comma separated snp thresholds for single linkage clusters. If not set the thresholds from the previous run are used', default=None, type=snp_thresholds)
+    parser_sub_rerun.add_argument('--tree_mode', default = None, choices=['ml', 'quick'], help='ml builds the tree with iqtree, quick builds a neighbour joining tree from the snp distances. If not set the mode from the previous run is used')
+    parser_sub_rerun.add_argument('--tree_update', help='New isolates are placed on the previous tree and only a short tree search is run, unless more than this fraction of isolates are new. 0 will always build the tree from scratch. If not set the fraction from the previous run is used', default=None, type=non_negative_float)
     parser_sub_rerun.add_argument('-workdir','-w', default = f"{pathlib.Path.cwd().absolute()}", help='Working directory, default is current directory')
     parser_sub_rerun.add_argument('--kraken_db', '-k', env_var="KRAKEN2_DEFAULT_DB", help="Path to DB for use with kraken2, if no DB present speciation will not be performed.")
     parser_sub_rerun.add_argument('-resources','-s', default = f"{pathlib.Path(__file__).parent / 'templates'}", help='Directory where templates are stored')
     parser_sub_rerun.add_argument('-dry-run','-n', action="store_true", help = "If you would like to see a dry run of commands to be executed.")
+    parser_sub_rerun.add_argument('--preflight', action="store_true", help = "Check that all read files are complete gzip files and that R1 and R2 are correctly paired before starting. Results are cached so unchanged files are only checked once.")
     # parser_sub_rerun.add_argument('--gubbins','-g', action="store_true", help = "If you would like to run gubbins. NOT IN USE YET - PLEASE DO NOT USE")
     parser_sub_rerun.add_argument('-keep', action= 'store_true', help="Keep report from previous run")
     parser_sub_rerun.add_argument('-cluster', action="store_true", help = "If you are running Bohra on a cluster. Note if set you will need to provide a cluster.json file and a run_snakemake.sh, you can see examples on the documentation page.")
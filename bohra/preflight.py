@@ -0,0 +1,125 @@
+import pathlib, gzip, zlib, hashlib, json, concurrent.futures
+
+# number of decompressed bytes read at a time
+CHUNK_SIZE = 1 << 24
+
+
+def file_key(path):
+    '''
+    key used to cache the result of checking a file - if the file changes the key changes
+    input:
+        :path: pathlib.Path to the read file
+    output:
+        a string of the resolved path, size and modification time
+    '''
+    p = pathlib.Path(path).resolve()
+    s = p.stat()
+    return(f"{p}:{s.st_size}:{s.st_mtime_ns}")
+
+
+def read_name(header):
+    '''
+    the name of a read from its header line, without the comment or a /1 /2 suffix, so R1 and R2 names match
+    '''
+    name = header.split(maxsplit = 1)[0] if header.strip() else b''
+    if name[-2:] in [b'/1', b'/2']:
+        name = name[:-2]
+    return(name)
+
+
+def check_read_file(path):
+    '''
+    decompress a gzipped fastq to the end, which checks the gzip CRC and length trailer,
+    counting records and generating a digest of the read names (in order) for comparing pairs
+    input:
+        :path: path to the read file
+    output:
+        a dictionary with the result of the check
+    '''
+    result = {'path': f"{path}", 'key': file_key(path), 'ok': False, 'error': '', 'records': 0, 'names': ''}
+    digest = hashlib.md5()
+    lines = 0
+    leftover = b''
+    try:
+        with gzip.open(path, 'rb') as f:
+            while True:
+                data = f.read(CHUNK_SIZE)
+                if not data:
+                    break
+                chunk = (leftover + data).split(b'\n')
+                leftover = chunk.pop()
+                # headers are every 4th line counting from where this chunk starts in the file
+                first = (-lines) % 4
+                for header in chunk[first::4]:
+                    digest.update(read_name(header) + b'\n')
+                lines += len(chunk)
+        if leftover:
+            if lines % 4 == 0:
+                digest.update(read_name(leftover) + b'\n')
+            lines += 1
+    except (OSError, EOFError, zlib.error) as e:
+        result['error'] = f"{e}" if f"{e}" else 'the file is truncated'
+        return(result)
+    if lines % 4 != 0:
+        result['error'] = f"the last record is incomplete ({lines} lines)"
+        return(result)
+    result['ok'] = True
+    result['records'] = lines // 4
+    result['names'] = digest.hexdigest()
+    return(result)
+
+
+def load_cache(cache_path):
+    '''
+    load the results of previous checks
+    '''
+    cache_path = pathlib.Path(cache_path)
+    if cache_path.exists():
+        try:
+            return(json.loads(cache_path.read_text()))
+        except json.decoder.JSONDecodeError:
+            return({})
+    return({})
+
+
+def check_reads(pairs, cache_path, workers = 1):
+    '''
+    check all read files in a process pool, skipping any that were checked before and have not changed since
+    input:
+        :pairs: a list of (isolate, path to R1, path to R2)
+        :cache_path: path to the json file where results are kept
+        :workers: number of processes to use
+    output:
+        a list of problems found, empty if all reads are ok
+    '''
+    cache = load_cache(cache_path)
+    results = {}
+    to_check = []
+    for _, r1, r2 in pairs:
+        for r in [r1, r2]:
+            key = file_key(r)
+            if key in cache:
+                results[f"{r}"] = cache[key]
+            elif f"{r}" not in to_check:
+                to_check.append(f"{r}")
+    if to_check:
+        with concurrent.futures.ProcessPoolExecutor(max_workers = max(1, int(workers))) as pool:
+            for r, result in zip(to_check, pool.map(check_read_file, to_check)):
+                results[r] = result
+                # only keep passing files, a failed file should be checked again once replaced
+                if result['ok']:
+                    cache[result['key']] = result
+        pathlib.Path(cache_path).write_text(json.dumps(cache, indent = 1))
+
+    problems = []
+    for isolate, r1, r2 in pairs:
+        res1, res2 = results[f"{r1}"], results[f"{r2}"]
+        for res in [res1, res2]:
+            if not res['ok']:
+                problems.append(f"{isolate}: {res['path']} failed the integrity check - {res['error']}")
+        if res1['ok'] and res2['ok']:
+            if res1['records'] != res2['records']:
+                problems.append(f"{isolate}: R1 has {res1['records']} reads but R2 has {res2['records']} reads")
+            elif res1['names'] != res2['names']:
+                problems.append(f"{isolate}: the read names in R1 and R2 are not paired")
+    return(problems)
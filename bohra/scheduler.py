@@ -0,0 +1,69 @@
+import os, pathlib, psutil
+
+# rules run for each isolate - the threads each can use (fewest, most), the memory (mb) it needs and the extra memory
+# for each gb of compressed reads of the largest isolate
+ISOLATE_RULES = {'snippy': {'threads': (2, 8), 'mem_mb': 2000, 'mb_per_gb': 1000},
+                 'assemble': {'threads': (4, 16), 'mem_mb': 8000, 'mb_per_gb': 4000},
+                 'run_prokka': {'threads': (1, 8), 'mem_mb': 2000, 'mb_per_gb': 0}}
+# rules run once for the job - the threads each can use (None for all of the cores) and the memory (mb) it needs
+JOB_RULES = {'qc_snippy': {'threads': None, 'mem_mb': 2000},
+             'run_snippy_core': {'threads': None, 'mem_mb': 8000},
+             'pack_core': {'threads': 1, 'mem_mb': 4000},
+             'run_snpdists': {'threads': None, 'mem_mb': 4000},
+             'run_iqtree_core': {'threads': None, 'mem_mb': 8000},
+             'assembly_statistics': {'threads': None, 'mem_mb': 2000},
+             'run_roary': {'threads': None, 'mem_mb': 8000}}
+# fraction of the free memory that jobs are given
+MEM_FRACTION = 0.9
+
+
+def host_resources(cpus):
+    '''
+    the cores and memory the pipeline can use, the cores asked for less any that are already busy - the load and free
+    memory are read once when the job is set up, so this is a snapshot for planning and is not checked while it runs
+    input:
+        :cpus: the number of cpus asked for
+    output:
+        the number of cores and the memory in mb
+    '''
+    total = psutil.cpu_count() or 1
+    load = psutil.getloadavg()[0]
+    cores = max(1, min(int(cpus), int(total - load)))
+    mem_mb = max(1, int(psutil.virtual_memory().available / 2**20 * MEM_FRACTION))
+    return(cores, mem_mb)
+
+
+def reads_gb(reads):
+    '''
+    size of the compressed reads of the isolate with the most reads
+    input:
+        :reads: a list of the read files of each isolate
+    output:
+        the size in gb, 0 if there are no reads
+    '''
+    sizes = [sum([os.stat(r).st_size for r in files if pathlib.Path(r).exists()]) for files in reads]
+    return(max(sizes, default = 0) / 1e9)
+
+
+def plan_resources(cores, mem_mb, isolates, gb = 0):
+    '''
+    the threads and memory of each rule, isolates are given enough threads to use all of the cores when as many isolates
+    run at once as there are isolates or as fit in the memory
+    input:
+        :cores: the number of cores the pipeline can use
+        :mem_mb: the memory the pipeline can use in mb
+        :isolates: the number of isolates
+        :gb: size of the compressed reads of the largest isolate
+    output:
+        a dictionary of the threads and mem_mb of each rule, the assembler is also given its memory in gb as ram
+    '''
+    plan = {}
+    for rule, r in ISOLATE_RULES.items():
+        mem = min(mem_mb, r['mem_mb'] + int(r['mb_per_gb'] * gb))
+        low, high = r['threads']
+        concurrent = max(1, min(int(isolates), mem_mb // mem))
+        plan[rule] = {'threads': max(1, min(cores, high, max(low, cores // concurrent))), 'mem_mb': mem}
+    for rule, r in JOB_RULES.items():
+        plan[rule] = {'threads': min(cores, r['threads'] or cores), 'mem_mb': min(mem_mb, r['mem_mb'])}
+    plan['assemble']['ram'] = max(1, plan['assemble']['mem_mb'] // 1024)
+    return(plan)
@@ -1,9 +1,10 @@
-import sys, pathlib, pandas, pytest, numpy
+import sys, pathlib, argparse, pandas, pytest, numpy
 
 from unittest.mock import patch
 
 from bohra.SnpDetection import RunSnpDetection
 from bohra.ReRunSnpDetection import ReRunSnpDetection
+from bohra.bohra import non_negative_int, non_negative_float, snp_thresholds
 
 
 
@@ -107,3 +108,96 @@ def test_path_exists():
                 detect_obj = RunSnpDetection()
                 assert detect_obj.path_exists(p)
 
+
+
+def test_preflight_reads(tmp_path):
+        '''
+        corrupt and unpaired reads are reported, good reads are cached
+        '''
+        import gzip
+        from bohra.preflight import check_reads, load_cache
+        def fastq(name, suffix, n):
+                p = tmp_path / name
+                with gzip.open(p, 'wt') as f:
+                        for i in range(n):
+                                f.write(f"@read{i}/{suffix} comment\nACGT\n+\nIIII\n")
+                return p
+        good1, good2 = fastq('g1.fq.gz', 1, 50), fastq('g2.fq.gz', 2, 50)
+        short = fastq('s2.fq.gz', 2, 49)
+        truncated = fastq('t1.fq.gz', 1, 50)
+        truncated.write_bytes(truncated.read_bytes()[:-10])
+        cache = tmp_path / 'preflight.json'
+        assert check_reads([('A', good1, good2)], cache_path = cache) == []
+        assert len(load_cache(cache)) == 2
+        problems = check_reads([('A', good1, good2), ('B', good1, short), ('C', truncated, good2)], cache_path = cache)
+        assert len(problems) == 2
+        assert problems[0].startswith('B:') and problems[1].startswith('C:')
+
+
+def test_plan_resources():
+        '''
+        isolates share the cores without going over the memory, and a job with few isolates gives each more threads
+        '''
+        from bohra.scheduler import plan_resources
+        plan = plan_resources(cores = 36, mem_mb = 64000, isolates = 200, gb = 1)
+        assert plan['snippy'] == {'threads': 2, 'mem_mb': 3000}
+        # only 5 assemblies fit in the memory at once so each gets 7 threads
+        assert plan['assemble'] == {'threads': 7, 'mem_mb': 12000, 'ram': 11}
+        assert plan['run_roary']['threads'] == 36
+        # iqtree has all of the cores and its memory reserved, packing the core is single threaded
+        assert plan['run_iqtree_core'] == {'threads': 36, 'mem_mb': 8000}
+        assert plan['pack_core'] == {'threads': 1, 'mem_mb': 4000}
+        plan = plan_resources(cores = 36, mem_mb = 64000, isolates = 2)
+        assert plan['snippy']['threads'] == 8 and plan['assemble']['threads'] == 16
+        # a small host still runs one isolate at a time
+        plan = plan_resources(cores = 2, mem_mb = 4000, isolates = 10, gb = 2)
+        assert plan['assemble'] == {'threads': 2, 'mem_mb': 4000, 'ram': 3} and plan['run_snippy_core']['mem_mb'] == 4000
+
+def test_non_negative_int():
+        '''
+        --max_depth is read as a whole number and negative values are refused
+        '''
+        assert non_negative_int('80') == 80
+        for value in ['-5', '8.5', 'deep']:
+                with pytest.raises(argparse.ArgumentTypeError):
+                        non_negative_int(value)
+
+
+def test_non_negative_float():
+        '''
+        --tree_update is read as a number and negative values are refused
+        '''
+        assert non_negative_float('0.25') == 0.25 and non_negative_float('0') == 0
+        for value in ['-0.1', 'some', 'nan']:
+                with pytest.raises(argparse.ArgumentTypeError):
+                        non_negative_float(value)
+
+
+def test_remove_subsampled(tmp_path):
+        '''
+        a new subsampling depth on rerun removes the subsampled reads and the snippy and assembly outputs made from them
+        '''
+        with patch.object(ReRunSnpDetection, "__init__", lambda x: None):
+                detect_obj = ReRunSnpDetection()
+        detect_obj.workdir, detect_obj.job_id = tmp_path, 'job'
+        job = tmp_path / 'job'
+        for f in ['SUBSAMPLED/A/R1.fq.gz', 'A/snps.vcf', 'A/snps.aligned.fa', 'A/A.fa', 'A/resistome.tab', 'report/report.html']:
+                (job / f).parent.mkdir(parents = True, exist_ok = True)
+                (job / f).write_text('')
+        detect_obj.original_max_depth, detect_obj.max_depth = 80, 80
+        detect_obj.remove_subsampled()
+        assert (job / 'A' / 'snps.vcf').exists()
+        detect_obj.max_depth = 0
+        detect_obj.remove_subsampled()
+        assert sorted(f"{p.relative_to(job)}" for p in job.rglob('*') if p.is_file()) == ['A/resistome.tab', 'report/report.html']
+
+
+def test_snp_thresholds():
+        '''
+        snp thresholds are whole numbers above 0, given back sorted without repeats
+        '''
+        assert snp_thresholds('25,5, 10,5') == '5,10,25'
+        assert snp_thresholds('10') == '10'
+        for value in ['a,b', '5,,10', '0,5', '-5', '2.5']:
+                with pytest.raises(argparse.ArgumentTypeError):
+                        snp_thresholds(value)
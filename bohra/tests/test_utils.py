@@ -0,0 +1,588 @@
+import gzip, pathlib, io, os, json, pytest, numpy
+
+from bohra.utils import read_stats, subsample, assembly_stat, alignment_qc, snp_dists, core_builder, alignment_pack, iqtree_command, quick_tree, snp_clusters, write_report, tool_manifest
+
+
+def write_fastq(path, records):
+        '''
+        write a gzipped fastq from a list of (name, seq, qual)
+        '''
+        with gzip.open(path, 'wt') as f:
+                for name, seq, qual in records:
+                        f.write(f"@{name}\n{seq}\n+\n{qual}\n")
+        return path
+
+
+def test_read_stats(tmp_path):
+        '''
+        check read counts, yield, GC, lengths and quality are calculated over both reads
+        '''
+        r1 = write_fastq(tmp_path / 'R1.fq.gz', [('r1/1', 'ACGT', 'IIII'), ('r2/1', 'GGCCA', '!!!!!')])
+        r2 = write_fastq(tmp_path / 'R2.fq.gz', [('r1/2', 'AAAAAA', '++++++'), ('r2/2', 'CC', 'II')])
+        stats = read_stats.get_stats([r1, r2], chunk_size = 7)
+        assert stats['Reads'] == 4
+        assert stats['bases'] == 17
+        assert stats['GC content'] == round(100 * 8 / 17, 2)
+        assert (stats['min_len'], stats['max_len'], stats['med_len']) == (2, 6, 4)
+        assert stats['avgQ'] == round((6 * 40 + 6 * 10) / 17, 1)
+
+
+def test_read_stats_one_read(tmp_path):
+        '''
+        the median length of a single read is its length
+        '''
+        r1 = write_fastq(tmp_path / 'R1.fq.gz', [('r1/1', 'ACGTA', 'IIIII')])
+        stats = read_stats.get_stats([r1], depth = False)
+        assert (stats['min_len'], stats['max_len'], stats['med_len']) == (5, 5, 5)
+
+
+def test_read_stats_truncated(tmp_path):
+        '''
+        an incomplete final record should raise an error
+        '''
+        r1 = tmp_path / 'R1.fq.gz'
+        with gzip.open(r1, 'wt') as f:
+                f.write("@r1\nACGT\n+\nIIII\n@r2\nACGT\n")
+        with pytest.raises(ValueError):
+                read_stats.get_stats([r1])
+
+
+def test_canonical_kmers():
+        '''
+        k-mers are the smaller of the forward and reverse complement and are broken by N
+        '''
+        seq = 'ACGTTGCANACGGT'
+        codes = read_stats.BASE_CODES[numpy.frombuffer(seq.encode(), dtype = numpy.uint8)]
+        revcomp = lambda s: s[::-1].translate(str.maketrans('ACGT', 'TGCA'))
+        value = lambda s: int(s.translate(str.maketrans('ACGT', '0123')), 4)
+        expected = [min(value(seq[i:i+5]), value(revcomp(seq[i:i+5]))) for i in range(len(seq) - 4) if 'N' not in seq[i:i+5]]
+        assert list(read_stats.canonical_kmers(codes, k = 5)) == expected
+
+
+def test_kmer_depth():
+        '''
+        genome size and depth are estimated from a repeated random genome
+        '''
+        rng = numpy.random.default_rng(42)
+        genome = rng.choice(numpy.frombuffer(b'ACGT', dtype = numpy.uint8), 20000)
+        reads = numpy.concatenate([numpy.append(genome[s:s + 100], 10) for s in range(0, 19900, 10)]).astype(numpy.uint8)
+        kmers = read_stats.KmerDepth(scale = 1)
+        kmers.update(reads)
+        size, depth = kmers.estimate()
+        assert abs(size - 20000) < 500
+        assert 5 < depth < 10
+
+
+def test_subsample_pairs(tmp_path):
+        '''
+        subsampled pairs stay in sync and the same seed gives the same reads
+        '''
+        r1 = write_fastq(tmp_path / 'R1.fq.gz', [(f"r{i}/1", 'ACGT', 'IIII') for i in range(1000)])
+        r2 = write_fastq(tmp_path / 'R2.fq.gz', [(f"r{i}/2", 'TTGG', 'IIII') for i in range(1000)])
+        names = []
+        for run in ['a', 'b']:
+                outdir = tmp_path / run
+                outdir.mkdir()
+                outputs = [outdir / 'R1.fq.gz', outdir / 'R2.fq.gz']
+                total, kept = subsample.subsample_pairs([r1, r2], outputs, 0.25, seed = 7)
+                read_names = [[l.split('/')[0] for l in gzip.open(o, 'rt').read().split('\n')[0::4] if l] for o in outputs]
+                assert read_names[0] == read_names[1]
+                assert total == 1000 and len(read_names[0]) == kept
+                names.append(read_names[0])
+        assert names[0] == names[1]
+        assert 150 < len(names[0]) < 350
+
+
+def test_assembly_stat(tmp_path):
+        '''
+        wrapped contigs are counted, short contigs excluded and N50 is taken longest first
+        '''
+        asm = tmp_path / 'isolate.fa'
+        contigs = {'c1': 'GC' * 1000, 'c2': 'AT' * 300 + 'NN--', 'c3': 'A' * 100, 'c4': 'ACGT' * 250}
+        asm.write_text(''.join(f">{n} info\n" + '\n'.join(s[i:i + 60] for i in range(0, len(s), 60)) + '\n' for n, s in contigs.items()))
+        cache = tmp_path / 'cache.json'
+        for _ in range(2):
+                data = assembly_stat.get_fa_stat([asm], 500, False, genome_size = 8000, cache = cache)[0]
+                assert data['Name'] == 'isolate'
+                assert (data['bp'], data['# Contigs'], data['Ns'], data['# Gaps']) == (3604, 3, 2, 2)
+                assert (data['Min Contig size'], data['Max Contig size']) == (604, 2000)
+                assert (data['N50'], data['L50'], data['NG50'], data['LG50']) == (2000, 1, 0, 0)
+                assert data['GC content'] == round(100 * 2500 / 3600, 2)
+        # a last header with no sequence and no newline is an empty contig
+        (tmp_path / 'ends.fa').write_text('>c1\nACGT\n>c2')
+        assert assembly_stat.contig_counts(assembly_stat.read_fasta(tmp_path / 'ends.fa'))[:, ord('A')].tolist() == [1, 0]
+
+
+def test_alignment_qc(tmp_path):
+        '''
+        percent alignment is calculated per contig and over the whole reference, and only changed isolates are read again
+        '''
+        paths = []
+        for isolate, chrom, plasmid in [('good', 'ACGT' * 20, 'AAAA'), ('poor', '-' * 40 + 'N' * 20 + 'ACGTnnnnnnnn' + 'ACGT' * 2, 'AA--')]:
+                (tmp_path / isolate).mkdir()
+                aln = tmp_path / isolate / 'snps.aligned.fa'
+                aln.write_text(f">chrom snippy\n{chrom[:60]}\n{chrom[60:]}\n>plasmid\n{plasmid}\n")
+                paths.append(aln)
+        cache = tmp_path / 'cache.json'
+        results = alignment_qc.get_qc(paths, cache = cache)
+        assert [r['% Aligned'] for r in results] == [100.0, round(100 * 14 / 84, 2)]
+        assert results[1]['contigs'] == [['chrom', 80, 68, 15.0], ['plasmid', 4, 2, 50.0]]
+        paths[0].write_text(">chrom\n" + '-' * 84 + "\n")
+        results = alignment_qc.get_qc(paths, cache = cache)
+        assert results[0]['% Aligned'] == 0.0 and results[1]['contigs'][1] == ['plasmid', 4, 2, 50.0]
+
+
+def test_snp_dists(tmp_path, monkeypatch):
+        '''
+        distances match a direct comparison, ignoring or counting ambiguous bases, in the snp-dists format
+        '''
+        rng = numpy.random.default_rng(1)
+        seqs = rng.choice(numpy.frombuffer(b'ACGTNacgt-', dtype = numpy.uint8), (23, 150))
+        aln = tmp_path / 'core.aln'
+        aln.write_text(''.join(f">s{i}\n{s[:100].tobytes().decode()}\n{s[100:].tobytes().decode()}\n" for i, s in enumerate(seqs)))
+        names, upper = snp_dists.read_alignment(aln)
+        acgt = numpy.isin(upper, numpy.frombuffer(b'ACGT', dtype = numpy.uint8))
+        differ = upper[:, None] != upper[None, :]
+        monkeypatch.setattr(snp_dists, 'TILE_WORDS', 8)
+        for all_chars, expected in [(False, (differ & acgt[:, None] & acgt[None, :]).sum(axis = 2)), (True, differ.sum(axis = 2))]:
+                for threads in [1, 2]:
+                        assert (snp_dists.distances(upper, all_chars = all_chars, threads = threads) == expected).all()
+        out = io.StringIO()
+        snp_dists.write_matrix(names[:2], numpy.array([[0, 3], [3, 0]]), out = out)
+        assert out.getvalue() == "snp-dists 0.7.0\ts0\ts1\ns0\t0\t3\ns1\t3\t0\n"
+
+
+def test_snp_dists_incremental(tmp_path):
+        '''
+        distances updated from a previous run, after isolates and core sites are added and removed, match a full calculation
+        '''
+        rng = numpy.random.default_rng(5)
+        bases = numpy.frombuffer(b'ACGTN-', dtype = numpy.uint8)
+        aln = rng.choice(bases, (30, 200))
+        columns = numpy.array([f"chrom:{i}:A" for i in range(200)])
+        names = [f"s{i}" for i in range(30)]
+        store = tmp_path / 'distances.npz'
+        assert snp_dists.incremental_distances(names, aln, columns, store)[1] == 30
+        assert snp_dists.incremental_distances(names, aln, columns, store)[1] == 0
+        # drop two isolates and some sites, then add two isolates and some sites
+        aln2 = numpy.vstack([numpy.delete(aln, [3, 7], axis = 0), rng.choice(bases, (2, 200))])[:, 20:]
+        aln2 = numpy.hstack([aln2, rng.choice(bases, (30, 15))])
+        columns2 = numpy.concatenate([columns[20:], [f"plasmid:{i}:C" for i in range(15)]])
+        names2 = [n for n in names if n not in ['s3', 's7']] + ['new1', 'new2']
+        matrix, calculated = snp_dists.incremental_distances(names2, aln2, columns2, store)
+        assert calculated == 2
+        assert (matrix == snp_dists.distances(aln2)).all()
+        # when more than half of the core columns change the distances are worked out again
+        aln3 = numpy.hstack([aln2[:, :100], rng.choice(bases, (30, 60))])
+        columns3 = numpy.concatenate([columns2[:100], [f"chrom:{i}:G" for i in range(60)]])
+        matrix, calculated = snp_dists.incremental_distances(names2, aln3, columns3, store)
+        assert calculated == 30
+        assert (matrix == snp_dists.distances(aln3)).all()
+
+
+def test_alignment_pack(tmp_path):
+        '''
+        a packed core alignment gives back the alignment and site positions, and the same distances as the fasta
+        '''
+        rng = numpy.random.default_rng(11)
+        seqs = rng.choice(numpy.frombuffer(b'ACGTNn-acgt', dtype = numpy.uint8), (5, 13))
+        names = ['Reference', 's1', 's2', 's3', 's4']
+        (tmp_path / 'core.aln').write_text(''.join(f">{n}\n{s.tobytes().decode()}\n" for n, s in zip(names, seqs)))
+        (tmp_path / 'ref.fa.fai').write_text("chrom\t1000\t7\t60\t61\nplasmid\t200\t1030\t60\t61\n")
+        sites = [('chrom', 1 + 10 * i) for i in range(8)] + [('plasmid', 5 + i) for i in range(5)]
+        (tmp_path / 'core.tab').write_text('CHR\tPOS\tREF\n' + ''.join(f"{c}\t{p}\tA\n" for c, p in sites))
+        alignment_pack.main(tmp_path / 'core.aln', tmp_path / 'core.tab', tmp_path / 'ref.fa.fai', tmp_path / 'core.pack')
+        assert alignment_pack.is_pack(tmp_path / 'core.pack') and not alignment_pack.is_pack(tmp_path / 'core.aln')
+        pack = alignment_pack.read_pack(tmp_path / 'core.pack')
+        upper = alignment_pack.upper_case(seqs)
+        assert pack['isolates'] == names
+        assert (alignment_pack.unpack(pack) == seqs).all()
+        assert (alignment_pack.unpack(pack, rows = [2, 4]) == seqs[[2, 4]]).all()
+        assert alignment_pack.positions(pack).tolist() == [10 * i for i in range(8)] + [1004 + i for i in range(5)]
+        packed_names, aln, columns = snp_dists.read_packed(tmp_path / 'core.pack')
+        assert columns[8] == f"plasmid:5:{chr(upper[0, 8])}"
+        assert (snp_dists.distances(aln) == snp_dists.distances(snp_dists.read_alignment(tmp_path / 'core.aln')[1])).all()
+        # a pack from an older version of the format is refused rather than read wrongly
+        (tmp_path / 'old.pack').write_bytes(b'BOHRAPK1' + (tmp_path / 'core.pack').read_bytes()[8:])
+        assert alignment_pack.is_pack(tmp_path / 'old.pack')
+        with pytest.raises(ValueError):
+                alignment_pack.read_pack(tmp_path / 'old.pack')
+
+
+
+def test_alignment_pack_parity(tmp_path):
+        '''
+        distances from core.pack match those from core.aln for every setting of -k and -a, on a mixed case alignment with ambiguity codes
+        '''
+        rng = numpy.random.default_rng(13)
+        seqs = rng.choice(numpy.frombuffer(b'ACGTacgtNn-XRYSWKMBDHVrykm*', dtype = numpy.uint8), (6, 41))
+        names = ['Reference'] + [f"s{i}" for i in range(1, 6)]
+        (tmp_path / 'core.aln').write_text(''.join(f">{n}\n{s.tobytes().decode()}\n" for n, s in zip(names, seqs)))
+        (tmp_path / 'ref.fa.fai').write_text("chrom\t1000\t7\t60\t61\n")
+        (tmp_path / 'core.tab').write_text('CHR\tPOS\tREF\n' + ''.join(f"chrom\t{1 + 20 * i}\tA\n" for i in range(41)))
+        alignment_pack.main(tmp_path / 'core.aln', tmp_path / 'core.tab', tmp_path / 'ref.fa.fai', tmp_path / 'core.pack')
+        assert (alignment_pack.unpack(alignment_pack.read_pack(tmp_path / 'core.pack'), rows = [5, 1]) == seqs[[5, 1]]).all()
+        for keep_case in [False, True]:
+                packed_names, packed, columns = snp_dists.read_packed(tmp_path / 'core.pack', keep_case = keep_case)
+                fasta_names, fasta = snp_dists.read_alignment(tmp_path / 'core.aln', keep_case = keep_case)
+                assert packed_names == fasta_names and (packed == fasta).all()
+                for all_chars in [False, True]:
+                        assert (snp_dists.distances(packed, all_chars = all_chars) == snp_dists.distances(fasta, all_chars = all_chars)).all()
+
+def write_aligned(path, contigs, width):
+        '''
+        write a wrapped fasta from a dictionary of contig name and numpy uint8 sequence
+        '''
+        path.parent.mkdir(exist_ok = True)
+        text = [f">{name}\n" + '\n'.join(seq[i:i + width].tobytes().decode() for i in range(0, len(seq), width)) + '\n' for name, seq in contigs.items()]
+        path.write_text(''.join(text))
+        return path
+
+
+def test_core_builder(tmp_path, monkeypatch):
+        '''
+        the core alignment has the masked, variable sites where every isolate has a base, and isolates can be added and removed using the saved state
+        '''
+        monkeypatch.chdir(tmp_path)
+        monkeypatch.setattr(core_builder, 'BLOCK_SIZE', 500)
+        rng = numpy.random.default_rng(0)
+        bases = numpy.frombuffer(b'ACGT', dtype = numpy.uint8)
+        reference = {'chrom': rng.choice(bases, 1200), 'plasmid': rng.choice(bases, 317)}
+        write_aligned(tmp_path / 'ref.fa', reference, 70)
+        ref = numpy.concatenate(list(reference.values()))
+        isolates = {}
+        for i in range(5):
+                seq = ref.copy()
+                seq[rng.random(len(seq)) < 0.02] = rng.choice(bases)
+                seq[rng.random(len(seq)) < 0.01] = rng.choice(numpy.frombuffer(b'-Nn', dtype = numpy.uint8))
+                isolates[f"s{i}"] = seq
+                write_aligned(tmp_path / f"s{i}" / 'snps.aligned.fa', {'chrom': seq[:1200], 'plasmid': seq[1200:]}, 60)
+        (tmp_path / 'mask.bed').write_text("chrom\t100\t300\nplasmid\t0\t50\n")
+        masked = numpy.zeros(len(ref), dtype = bool)
+        masked[100:300] = masked[1200:1250] = True
+        for names in [['s0', 's1', 's2'], ['s0', 's2', 's3', 's4']]:
+                core_builder.main(names, 'ref.fa', 'mask.bed', 'core', 'cache/core_state.npz', 1)
+                aln = numpy.vstack([isolates[n] for n in names])
+                sites = numpy.flatnonzero(core_builder.IS_BASE[aln].all(axis = 0) & (aln != ref).any(axis = 0) & ~masked)
+                lines = (tmp_path / 'core.aln').read_text().split('\n')
+                assert lines[1] == ref[sites].tobytes().decode()
+                assert lines[3::2][:len(names)] == [aln[i, sites].tobytes().decode() for i in range(len(names))]
+                tab = (tmp_path / 'core.tab').read_text().split('\n')
+                assert len(tab) == len(sites) + 2 and tab[0].split('\t') == ['CHR', 'POS', 'REF'] + names
+                txt = (tmp_path / 'core.txt').read_text().split('\n')
+                assert txt[1].split('\t') == ['Reference', '1517', f"{1517 - 250}", '0', '0', '0', '250', '0']
+        # changing the mask only updates the full alignment kept from the previous run
+        (tmp_path / 'mask2.bed').write_text("chrom\t250\t400\nchrom\t1190\t1200\nplasmid\t300\t317\n")
+        (tmp_path / 'core.full.aln').rename(tmp_path / 'cache' / 'core.full.aln')
+        core_builder.main(names, 'ref.fa', 'mask2.bed', 'core', 'cache/core_state.npz', 1, full_cache = 'cache/core.full.aln')
+        core_builder.main(names, 'ref.fa', 'mask2.bed', 'fresh', None, 1)
+        for ext in ['full.aln', 'txt', 'aln', 'tab']:
+                assert (tmp_path / f"core.{ext}").read_text() == (tmp_path / f"fresh.{ext}").read_text()
+        assert not (tmp_path / 'cache' / 'core.full.aln').exists()
+
+
+def test_mask_index(tmp_path):
+        '''
+        overlapping bed regions are merged per contig and looked up across contigs
+        '''
+        (tmp_path / 'mask.bed').write_text("chrom\t10\t20\nchrom\t15\t30\nplasmid\t0\t5\nother\t0\t5\nplasmid\t8\t100\n")
+        mask = core_builder.MaskIndex.from_bed(tmp_path / 'mask.bed', ['chrom', 'plasmid'], numpy.array([50, 10]))
+        assert mask.starts.tolist() == [10, 50, 58] and mask.ends.tolist() == [30, 55, 60]
+        assert mask.masked(numpy.array([9, 10, 29, 30, 50, 57, 59])).tolist() == [False, True, True, False, True, False, True]
+        assert numpy.flatnonzero(mask.block(25, 55)).tolist() == [0, 1, 2, 3, 4, 25, 26, 27, 28, 29]
+        assert mask.total() == 27
+
+
+def test_iqtree_command(tmp_path):
+        '''
+        constant sites are counted without masked regions and cached on the content of the reference
+        '''
+        ref = tmp_path / 'ref.fa'
+        ref.write_text(">chrom\nAACCG\ngTTN\n>plasmid\nAAAC\n")
+        bed = tmp_path / 'mask.bed'
+        bed.write_text("chrom\t1\t3\nplasmid\t0\t2\n")
+        assert iqtree_command.count_constant(ref) == [5, 3, 2, 2]
+        assert iqtree_command.count_constant(ref, mask = bed) == [2, 2, 2, 2]
+        cache = tmp_path / 'const_sites.json'
+        assert iqtree_command.get_constant(ref, mask = bed, cache = cache) == [2, 2, 2, 2]
+        json_text = cache.read_text()
+        assert iqtree_command.get_constant(ref, mask = bed, cache = cache) == [2, 2, 2, 2]
+        # the same reference at another path is found in the cache, a different mask is counted again
+        (tmp_path / 'copy.fa').write_text(ref.read_text())
+        assert iqtree_command.get_constant(tmp_path / 'copy.fa', mask = bed, cache = cache) == [2, 2, 2, 2]
+        assert cache.read_text() == json_text
+        bed.write_text("chrom\t1\t3\n")
+        assert iqtree_command.get_constant(ref, mask = bed, cache = cache) == [4, 2, 2, 2]
+        assert len(json.loads(cache.read_text())) == 2
+        assert [f.name for f in tmp_path.iterdir() if f.suffix == '.tmp'] == []
+
+
+def test_constant_cache_shared(tmp_path, monkeypatch):
+        '''
+        jobs in different directories share one cache of constant sites, and counts written by another job while one
+        is counting are kept
+        '''
+        cache = tmp_path / 'const_sites.json'
+        for job, seq in [('job1', 'AACCGT'), ('job2', 'GGGTTA')]:
+                (tmp_path / job).mkdir()
+                (tmp_path / job / 'ref.fa').write_text(f">chrom\n{seq}\n")
+        assert iqtree_command.get_constant(tmp_path / 'job1' / 'ref.fa', cache = cache) == [2, 2, 1, 1]
+        count_constant = iqtree_command.count_constant
+        def other_job(reference, mask = None):
+                # another job adds its counts to the cache while this one is counting
+                cache.write_text(json.dumps(dict(json.loads(cache.read_text()), other = [1, 1, 1, 1])))
+                return(count_constant(reference, mask))
+        monkeypatch.setattr(iqtree_command, 'count_constant', other_job)
+        assert iqtree_command.get_constant(tmp_path / 'job2' / 'ref.fa', cache = cache) == [1, 0, 3, 2]
+        cached = json.loads(cache.read_text())
+        assert len(cached) == 3 and cached['other'] == [1, 1, 1, 1]
+        # the first job's reference, copied to another job, is read from the cache
+        (tmp_path / 'job2' / 'copy.fa').write_text((tmp_path / 'job1' / 'ref.fa').read_text())
+        monkeypatch.setattr(iqtree_command, 'count_constant', None)
+        assert iqtree_command.get_constant(tmp_path / 'job2' / 'copy.fa', cache = cache) == [2, 2, 1, 1]
+        assert iqtree_command.iqtree_command([2, 2, 2, 2], 'core.aln', 'core', 4) == "iqtree -fconst 2,2,2,2 -m GTR+G4 -bb 1000 -alrt 1000 -ntmax 4 -nt AUTO -st DNA -s core.aln -pre core"
+
+
+def test_place_isolates(tmp_path, capsys):
+        '''
+        new isolates go next to their nearest isolate on the previous tree, removed isolates are pruned and
+        too many new isolates means building the tree from scratch
+        '''
+        (tmp_path / 'previous.treefile').write_text("(Reference:0.1,(s1:0.1,s2:0.1)90/95:0.2,(s3:0.1,gone:0.1)80/85:0.1);\n")
+        seqs = {'Reference': 'AAAAAAAAAA', 's1': 'CCAAAAAAAA', 's2': 'CCCAAAAAAA', 's3': 'AAAAAAAGGG', 'new': 'AAAAAAAGGT'}
+        (tmp_path / 'core.aln').write_text(''.join(f">{n}\n{s}\n" for n, s in seqs.items()))
+        tree = iqtree_command.place_isolates(tmp_path / 'previous.treefile', tmp_path / 'core.aln', 0.25)
+        assert sorted(leaf.name for leaf in tree.get_terminals()) == sorted(seqs)
+        assert tree.common_ancestor('new', 's3').count_terminals() == 2
+        assert iqtree_command.place_isolates(tmp_path / 'previous.treefile', tmp_path / 'core.aln', 0.1) is None
+        assert iqtree_command.place_isolates(tmp_path / 'missing.treefile', tmp_path / 'core.aln', 0.25) is None
+        # the script written takes the threads to use as its first argument
+        (tmp_path / 'ref.fa').write_text(">chrom\nAAAAAAAAAA\n")
+        iqtree_command.main(tmp_path / 'ref.fa', tmp_path / 'core.aln', 'core', 4, None, None, None, 0.25)
+        assert capsys.readouterr().out.strip().endswith("-ntmax ${1:-4} -nt AUTO -st DNA -s " + f"{tmp_path / 'core.aln'} -pre core")
+        # a short search from the starting tree has SH-aLRT support only, not ultrafast bootstrap
+        assert iqtree_command.iqtree_command([1, 2, 3, 4], 'core.aln', 'core', 4, start = 'core.start.tree') == "iqtree -fconst 1,2,3,4 -m GTR+G4 -alrt 1000 -ntmax 4 -nt AUTO -st DNA -s core.aln -pre core -t core.start.tree -n 10"
+
+
+def test_quick_tree(tmp_path, monkeypatch):
+        '''
+        neighbour joining gives back a tree from its own path lengths, whatever the block size of the Q matrix
+        '''
+        from Bio import Phylo
+        tree = Phylo.read(io.StringIO("((a:2,b:3):1,(c:4,(d:1,e:2):3):2,(f:5,g:1):2);"), 'newick')
+        names = [leaf.name for leaf in tree.get_terminals()]
+        matrix = numpy.array([[tree.distance(x, y) if x != y else 0 for y in names] for x in names])
+        with open(tmp_path / 'distances.tab', 'w') as f:
+                snp_dists.write_matrix(names, matrix.astype(int), out = f)
+        read_names, read_matrix = quick_tree.read_distances(tmp_path / 'distances.tab')
+        assert read_names == names and (read_matrix == matrix).all()
+        for block in [8, 1 << 16]:
+                monkeypatch.setattr(quick_tree, 'BLOCK_SIZE', block)
+                nj = Phylo.read(io.StringIO(quick_tree.neighbour_joining(names, matrix)), 'newick')
+                assert all(nj.distance(x, y) == tree.distance(x, y) for x in names for y in names if x != y)
+        assert quick_tree.neighbour_joining(['a', 'b'], numpy.array([[0, 4], [4, 0]])) == "(a:2,b:2);"
+
+
+def test_snp_clusters(tmp_path):
+        '''
+        single linkage clusters chain through isolates within the threshold, the reference is left out, and
+        clusters are numbered in the order they are first seen
+        '''
+        names = ['Reference', 'a', 'b', 'c', 'd', 'e']
+        matrix = numpy.array([[0, 1, 1, 1, 1, 1],
+                              [1, 0, 4, 9, 30, 30],
+                              [1, 4, 0, 6, 30, 30],
+                              [1, 9, 6, 0, 24, 30],
+                              [1, 30, 30, 24, 0, 40],
+                              [1, 30, 30, 30, 40, 0]])
+        with open(tmp_path / 'distances.tab', 'w') as f:
+                snp_dists.write_matrix(names, matrix, out = f)
+        thresholds = [5, 10, 25]
+        isolates, clusters = snp_clusters.cluster(tmp_path / 'distances.tab', thresholds)
+        assert isolates == names[1:]
+        assert clusters.tolist() == [[1, 1, 1], [1, 1, 1], [2, 1, 1], [3, 2, 1], [4, 3, 2]]
+        snp_clusters.write_table(isolates, clusters, thresholds, tmp_path / 'clusters.tab')
+        lines = (tmp_path / 'clusters.tab').read_text().split('\n')
+        assert lines[0] == 'Isolate\tCluster code\tCluster 25 SNPs\tCluster 10 SNPs\tCluster 5 SNPs'
+        assert lines[3] == 'c\t1.1.2\t1\t1\t2'
+
+
+def test_write_tables(tmp_path):
+        '''
+        table rows are given the class for the table and are read again each time the body is written
+        '''
+        (tmp_path / 'summary_table.tab').write_text("Isolate\tST\ns1\t5\ns2\t7\n")
+        (tmp_path / 'other.tab').write_text("A\tB\n1\t2\n")
+        head, body = write_report.Report().write_tables(reportdir = tmp_path, table = 'summary_table.tab')
+        assert head == "<th>Isolate</th>\n<th>ST</th>"
+        rows = list(body)
+        assert rows[0] == "<tr class='s1 tiplab'><td align=\"center\">s1</td><td align=\"center\">5</td></tr>\n"
+        assert list(body) == rows and f"{body}" == ''.join(rows)
+        assert list(write_report.Report().write_tables(reportdir = tmp_path, table = 'other.tab')[1]) == ["<tr><td align=\"center\">1</td><td align=\"center\">2</td></tr>\n"]
+
+
+def test_plot_distances(tmp_path):
+        '''
+        the distance matrix is packed as its upper triangle, uint32 only when a distance does not fit in uint16,
+        with a histogram and the nearest isolate to each isolate
+        '''
+        import base64
+        names = ['Reference', 'a', 'b', 'c']
+        for top, dtype, width in [(9, 'uint16', '<u2'), (70000, 'uint32', '<u4')]:
+                matrix = numpy.array([[0, 1, 2, 3], [1, 0, 4, 5], [2, 4, 0, top], [3, 5, top, 0]])
+                with open(tmp_path / 'distances.tab', 'w') as f:
+                        snp_dists.write_matrix(names, matrix, out = f)
+                payload = write_report.Report().plot_distances(reportdir = tmp_path)
+                assert payload['names'] == names and payload['dtype'] == dtype
+                assert numpy.frombuffer(base64.b64decode(payload['data']), dtype = width).tolist() == matrix[numpy.triu_indices(4, 1)].tolist()
+                # the reference is left out of the histogram and nearest isolates
+                size = payload['histogram']['size']
+                assert size == max(1, -(-(top + 1) // 100))
+                assert sum(payload['histogram']['counts']) == 3 and payload['histogram']['counts'][top // size] == 1
+                assert payload['isolates'][0] == ['a', 'b', 4, 4.2, 4.5, 4.8]
+                assert payload['isolates'][2][:3] == ['c', 'a', 5]
+
+
+def test_plot_snpdensity(tmp_path, monkeypatch):
+        '''
+        snps are counted in windows across the genome the same from core.pack and from core.tab
+        '''
+        rng = numpy.random.default_rng(4)
+        sites = [('chrom', p) for p in sorted(rng.choice(numpy.arange(1, 1001), 30, replace = False))] + [('plasmid', p) for p in [3, 150, 190]]
+        seqs = rng.choice(numpy.frombuffer(b'ACGT', dtype = numpy.uint8), (4, len(sites)))
+        names = ['Reference', 's1', 's2', 's3']
+        (tmp_path / 'ref.fa.fai').write_text("chrom\t1000\t7\t60\t61\nplasmid\t200\t1030\t60\t61\n")
+        (tmp_path / 'core.aln').write_text(''.join(f">{n}\n{s.tobytes().decode()}\n" for n, s in zip(names, seqs)))
+        rows = ['\t'.join(['CHR', 'POS', 'REF'] + names[1:])]
+        rows += ['\t'.join([c, f"{p}"] + [chr(b) for b in seqs[:, i]]) for i, (c, p) in enumerate(sites)]
+        (tmp_path / 'core.tab').write_text('\n'.join(rows) + '\n')
+        monkeypatch.setattr(write_report, 'DENSITY_BINS', 12)
+        report = write_report.Report()
+        from_tab = report.plot_snpdensity(reportdir = tmp_path, workdir = tmp_path)
+        alignment_pack.main(tmp_path / 'core.aln', tmp_path / 'core.tab', tmp_path / 'ref.fa.fai', tmp_path / 'core.pack')
+        from_pack = report.plot_snpdensity(reportdir = tmp_path, workdir = tmp_path)
+        assert from_tab == from_pack
+        assert from_tab['breaks'] == [1.0] and from_tab['window'] == 0.1
+        assert sum(from_tab['counts']) == (seqs[1:] != seqs[0]).sum()
+        assert from_tab['counts'][10:] == [(seqs[1:, 30] != seqs[0, 30]).sum(), (seqs[1:, 31:] != seqs[0, 31:]).sum()]
+
+
+def test_tree_layout(tmp_path):
+        '''
+        a deep ladder tree is drawn without recursion, and clades close to their tips are drawn as one row once the tree has enough tips
+        '''
+        depth = 3000
+        newick = 't0:1'
+        for i in range(1, depth):
+                newick = f"({newick},t{i}:1):1"
+        (tmp_path / 'ladder.nwk').write_text(f"{newick};\n")
+        svg = write_report.Tree().main(tmp_path / 'ladder.nwk', tmp_path / 'ladder.svg')
+        lines = list(svg)
+        assert sum('tiplab' in l for l in lines) == depth
+        assert str(svg).startswith('<svg')
+        (tmp_path / 'small.nwk').write_text("(((a:0.001,b:0.001)90:0.001,c:1)100:1,d:1);\n")
+        tree = write_report.Tree()
+        full = tree.layout(tree.read_treefile(tmp_path / 'small.nwk'), collapse = 0.01, max_tips = 4)
+        assert not full['hidden'].any() and full['size'][0] == 7
+        collapsed = tree.layout(tree.read_treefile(tmp_path / 'small.nwk'), collapse = 0.01)
+        assert [c.name for c, h in zip(collapsed['clades'], collapsed['hidden']) if h] == ['a', 'b']
+        text = ''.join(tree.svg_lines(collapsed))
+        assert '<title>a, b</title>2 isolates' in text and 'None' not in text and 'tiplab a' not in text
+
+
+def test_tool_manifest(tmp_path, monkeypatch):
+        '''
+        tool versions are found from stdout or stderr, cached until the tool changes and read by the report from the manifest
+        '''
+        bindir = tmp_path / 'bin'
+        bindir.mkdir()
+        calls = tmp_path / 'calls'
+        for tool, stream in [('snippy', '>&2'), ('iqtree', '')]:
+                (bindir / tool).write_text(f"#!/bin/sh\necho {tool} >> {calls}\necho '{tool} 4.6.0 (build)' {stream}\n")
+                (bindir / tool).chmod(0o755)
+        monkeypatch.setenv('PATH', f"{bindir}")
+        cache = tmp_path / 'cache.json'
+        manifest = tool_manifest.build_manifest(['snippy', 'iqtree', 'snippy-core'], cache_path = cache)
+        assert [manifest[t]['version'] for t in manifest] == ['4.6.0', '4.6.0', '']
+        assert not manifest['snippy-core']['found']
+        assert tool_manifest.build_manifest(['snippy', 'iqtree'], cache_path = cache) == {t: manifest[t] for t in ['snippy', 'iqtree']}
+        assert sorted(calls.read_text().split()) == ['iqtree', 'snippy']
+        (bindir / 'iqtree').write_text(f"#!/bin/sh\necho '2.0.3' \n")
+        os.utime(bindir / 'iqtree', ns = (1, 1))
+        assert tool_manifest.build_manifest(['iqtree'], cache_path = cache)['iqtree']['version'] == '2.0.3'
+        # the report reads versions from the manifest in the job directory
+        (tmp_path / 'report').mkdir()
+        tool_manifest.write_manifest(manifest, tmp_path / 'tool_manifest.json')
+        write_report.Report().get_software_file(reportdir = tmp_path / 'report', pipeline = 's', assembler = 'no_assembler')
+        assert (tmp_path / 'report' / 'software_versions.tab').read_text() == 'Software versions\nsnippy v.4.6.0\nsnippy-core not found\niqtree v.4.6.0'
+        # tools run in containers are not looked for on this machine, the containers are recorded instead
+        probed = calls.read_text()
+        tool_manifest.write_manifest(tool_manifest.container_manifest(tool_manifest.pipeline_tools('s', 'shovill'), 'shub://containers', 'singularity_01_01_26'), tmp_path / 'tool_manifest.json')
+        write_report.Report().get_software_file(reportdir = tmp_path / 'report', pipeline = 's', assembler = 'no_assembler')
+        assert (tmp_path / 'report' / 'software_versions.tab').read_text() == 'Software versions\nsnippy singularity_01_01_26\nsnippy-core singularity_01_01_26\niqtree singularity_01_01_26'
+        assert calls.read_text() == probed
+
+
+def test_report_fragments(tmp_path, monkeypatch):
+        '''
+        a section is rendered once for each version of its inputs and copied from the fragment otherwise, the data of
+        each section is in a script in the sections directory of the report
+        '''
+        reportdir = tmp_path / 'report'
+        reportdir.mkdir()
+        (reportdir / 'seqdata.tab').write_text('Isolate\tReads\na\t10\nb\t20\n')
+        report = write_report.Report()
+        cache = write_report.FragmentCache(tmp_path / 'cache' / 'report')
+        rendered = []
+        write_tables = report.write_tables
+        monkeypatch.setattr(report, 'write_tables', lambda reportdir, table: rendered.append(table) or write_tables(reportdir, table))
+        head = report.cached_table(cache, reportdir, 'seqdata.tab', 'sequence-data')
+        assert head == '<th>Isolate</th>\n<th>Reads</th>'
+        section = reportdir / 'sections' / 'sequence-data.js'
+        assert section.read_text() == 'bohraSection("sequence-data", {"columns": ["Isolate", "Reads"], "row_class": "{}-sequence-data"}, [\n["a", "10"],\n["b", "20"]]);\n'
+        section.unlink()
+        assert report.cached_table(cache, reportdir, 'seqdata.tab', 'sequence-data') == head and rendered == ['seqdata.tab']
+        assert section.exists()
+        (reportdir / 'seqdata.tab').write_text('Isolate\tReads\na\t10\nb\t20\nc\t5\n')
+        report.cached_table(cache, reportdir, 'seqdata.tab', 'sequence-data')
+        assert '["c", "5"]' in section.read_text()
+        assert rendered == ['seqdata.tab'] * 2
+        assert len(list(cache.path.iterdir())) == 1
+        calls = []
+        data = lambda: calls.append(1) or {'counts': [1, 2]}
+        for i in range(2):
+                report.cached_section(cache, reportdir, 'snp-density', [reportdir / 'core.tab'], data)
+        assert (reportdir / 'sections' / 'snp-density.js').read_text() == 'bohraSection("snp-density", {"counts": [1, 2]});\n' and calls == [1]
+        # the summary is only made again when a table it is made from changes, not the distances
+        summaries = []
+        generate_summary = report.generate_summary
+        monkeypatch.setattr(report, 'generate_summary', lambda reportdir: summaries.append(1) or generate_summary(reportdir))
+        (reportdir / 'seqdata.tab').write_text('Isolate\tEstimated depth\na\t10\nb\t20\n')
+        (reportdir / 'distances.tab').write_text('snp-dists 0.7.0\ta\tb\na\t0\t1\nb\t1\t0\n')
+        report.cached_summary(cache, reportdir)
+        (reportdir / 'distances.tab').write_text('snp-dists 0.7.0\ta\tb\na\t0\t2\nb\t2\t0\n')
+        report.cached_summary(cache, reportdir)
+        assert summaries == [1]
+        (reportdir / 'seqdata.tab').write_text('Isolate\tEstimated depth\na\t10\nb\t30\n')
+        report.cached_summary(cache, reportdir)
+        assert summaries == [1, 1] and '30' in (reportdir / 'summary_table.tab').read_text()
+
+
+def test_generate_summary(tmp_path):
+        '''
+        the summary is one join on the isolates of the job, isolates missing from a table are kept and rows that are
+        not isolates (the Reference in core_genome.tab, or a stray row) are left out
+        '''
+        (tmp_path / 'seqdata.tab').write_text('Isolate\tReads\tEstimated depth\na\t10\t45.50\nb\t20\t60\nc\t5\t12\n')
+        (tmp_path / 'mlst.tab').write_text('Isolate\tScheme\tST\na\tsaureus\t8\tarcC(3)\nb\tsaureus\t-\tarcC(1)\textra\n')
+        (tmp_path / 'core_genome.tab').write_text('Isolate\tLength\t% USED\nc\t100\t90.1\na\t100\t98.5\nb\t100\t97\nReference\t100\t100\n')
+        (tmp_path / 'clusters.tab').write_text('Isolate\tCluster code\tCluster 5 SNPs\na\t1.1\t1\nb\t1.2\t2\nc\t2.3\t3\n')
+        (tmp_path / 'species_identification.tab').write_text('Isolate\t#1 Match\t%1\na\tS. aureus\t90\nb\tS. aureus\t91\nd\tE. coli\t99\n')
+        write_report.Report().generate_summary(reportdir = tmp_path)
+        rows = [l.split('\t') for l in (tmp_path / 'summary_table.tab').read_text().strip('\n').split('\n')]
+        assert rows[0] == ['Isolate', 'Species', 'Estimated depth', 'ST', '% USED', 'Cluster code']
+        assert rows[1:] == [['a', 'S. aureus', '45.50', '8', '98.5', '1.1'], ['b', 'S. aureus', '60', '-', '97', '1.2'], ['c', '', '12', '', '90.1', '2.3']]
+        # without the read data the Reference is still left out
+        (tmp_path / 'seqdata.tab').unlink()
+        write_report.Report().generate_summary(reportdir = tmp_path)
+        assert 'Reference' not in (tmp_path / 'summary_table.tab').read_text()
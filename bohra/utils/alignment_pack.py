@@ -0,0 +1,176 @@
+import pathlib, json, argparse
+import numpy, pandas
+
+# first bytes of a packed alignment, the last byte is the version of the format
+MAGIC = b'BOHRAPK2'
+# the characters given a 4 bit code (their index), any other character is given ESCAPE and kept as it is in
+# a list of exceptions so that the alignment is unpacked exactly as it was written
+ALPHABET = b'-ACGTNnacgtXRYS'
+ESCAPE = len(ALPHABET)
+ENCODE = numpy.full(256, ESCAPE, dtype = numpy.uint8)
+ENCODE[numpy.frombuffer(ALPHABET, dtype = numpy.uint8)] = numpy.arange(len(ALPHABET), dtype = numpy.uint8)
+DECODE = numpy.frombuffer(ALPHABET + b'?', dtype = numpy.uint8)
+
+
+def upper_case(aln):
+    '''
+    an alignment with lower case letters converted to upper case
+    '''
+    return(numpy.where((aln >= 97) & (aln <= 122), aln - 32, aln).astype(numpy.uint8))
+
+
+def pack_codes(aln):
+    '''
+    pack an alignment two positions per byte
+    input:
+        :aln: numpy uint8 array (isolates x sites) of characters
+    output:
+        :packed: numpy uint8 array (isolates x ceil(sites / 2)), the first position of each pair in the high 4 bits
+        :escaped: index (isolate * sites + site) of each character that is not in ALPHABET
+        :chars: the characters at the escaped positions
+    '''
+    codes = ENCODE[aln]
+    escaped = numpy.flatnonzero(codes == ESCAPE)
+    chars = aln.reshape(-1)[escaped]
+    if codes.shape[1] % 2:
+        codes = numpy.pad(codes, ((0, 0), (0, 1)))
+    return((codes[:, 0::2] << 4) | codes[:, 1::2], escaped.astype(numpy.int64), chars.astype(numpy.uint8))
+
+
+def write_pack(path, isolates, aln, contigs, lengths, chrom, pos):
+    '''
+    write a packed alignment - a json header with the isolate and contig tables followed by the site index,
+    the 4 bit codes and the characters that have no code, each section starting on an 8 byte boundary so it can
+    be memory mapped
+    input:
+        :path: path to write to
+        :isolates: names of the isolates, in the order of the rows of aln
+        :aln: numpy uint8 array (isolates x sites) of characters
+        :contigs: names of the contigs of the reference
+        :lengths: lengths of the contigs
+        :chrom: index of the contig of each site
+        :pos: position (1 based) of each site in its contig
+    '''
+    lengths = numpy.asarray(lengths, dtype = numpy.int64)
+    codes, escaped, chars = pack_codes(aln)
+    sections = {'chrom': numpy.asarray(chrom, dtype = numpy.int32), 'pos': numpy.asarray(pos, dtype = numpy.int64), 'codes': codes,
+                'escaped': escaped, 'chars': chars}
+    header = {'isolates': list(isolates), 'contigs': list(contigs), 'contig_lengths': lengths.tolist(),
+              'contig_offsets': numpy.concatenate([[0], numpy.cumsum(lengths)[:-1]]).astype(int).tolist(),
+              'sites': int(aln.shape[1]), 'sections': {}}
+    for name, data in sections.items():
+        header['sections'][name] = [data.dtype.str, list(data.shape)]
+    text = json.dumps(header).encode()
+    text += b' ' * ((-len(text)) % 8)
+    with open(path, 'wb') as f:
+        f.write(MAGIC + numpy.uint64(len(text)).tobytes() + text)
+        for data in sections.values():
+            f.write(data.tobytes() + b'\0' * ((-data.nbytes) % 8))
+
+
+def is_pack(path):
+    '''
+    True if the file is a packed alignment, of this or an older version of the format
+    '''
+    with open(path, 'rb') as f:
+        return(f.read(len(MAGIC) - 1) == MAGIC[:-1])
+
+
+def read_pack(path):
+    '''
+    open a packed alignment, the site index, codes and escaped characters are memory mapped rather than read
+    output:
+        dictionary of the header with 'chrom', 'pos', 'codes', 'escaped' and 'chars' as numpy memmaps
+    '''
+    with open(path, 'rb') as f:
+        magic = f.read(len(MAGIC))
+        if magic[:-1] != MAGIC[:-1]:
+            raise ValueError(f"{path} is not a packed alignment")
+        if magic != MAGIC:
+            raise ValueError(f"{path} was written by an older version of bohra, remove it so it is packed again")
+        size = int(numpy.frombuffer(f.read(8), dtype = numpy.uint64)[0])
+        pack = json.loads(f.read(size))
+    # sections follow the header in order, each padded to 8 bytes
+    offset = len(MAGIC) + 8 + size
+    for name, (dtype, shape) in pack['sections'].items():
+        dtype = numpy.dtype(dtype)
+        nbytes = int(numpy.prod(shape)) * dtype.itemsize
+        pack[name] = numpy.memmap(path, dtype = dtype, mode = 'r', offset = offset, shape = tuple(shape)) if nbytes else numpy.zeros(shape, dtype = dtype)
+        offset += nbytes + (-nbytes) % 8
+    pack['contig_offsets'] = numpy.array(pack['contig_offsets'], dtype = numpy.int64)
+    return(pack)
+
+
+def unpack(pack, rows = None):
+    '''
+    the characters of the alignment, exactly as they were packed - decoded into a new array in memory
+    input:
+        :pack: from read_pack
+        :rows: indices of isolates to unpack, None for all
+    output:
+        numpy uint8 array (isolates x sites) of characters
+    '''
+    rows = numpy.arange(len(pack['isolates'])) if rows is None else numpy.asarray(rows, dtype = numpy.int64)
+    codes = pack['codes'][rows]
+    aln = numpy.empty((codes.shape[0], 2 * codes.shape[1]), dtype = numpy.uint8)
+    aln[:, 0::2] = DECODE[codes >> 4]
+    aln[:, 1::2] = DECODE[codes & 15]
+    aln = aln[:, :pack['sites']]
+    if len(pack['escaped']) and len(rows):
+        # row of the output for each isolate, -1 if it was not asked for
+        out = numpy.full(len(pack['isolates']), -1, dtype = numpy.int64)
+        out[rows] = numpy.arange(len(rows))
+        isolate, site = numpy.divmod(numpy.asarray(pack['escaped']), pack['sites'])
+        keep = out[isolate] >= 0
+        aln[out[isolate[keep]], site[keep]] = pack['chars'][keep]
+    return(numpy.ascontiguousarray(aln))
+
+
+def positions(pack):
+    '''
+    position (0 based) of each site across all contigs end to end
+    '''
+    return(pack['contig_offsets'][pack['chrom']] + pack['pos'] - 1)
+
+
+def read_fasta(path):
+    '''
+    the names and sequences of an alignment in fasta format
+    '''
+    names = []
+    seqs = []
+    for record in pathlib.Path(path).read_bytes().split(b'\n>'):
+        if not record.strip():
+            continue
+        header, _, seq = record.lstrip(b'>').partition(b'\n')
+        names.append(header.split()[0].decode() if header.split() else '')
+        seqs.append(b''.join(seq.split()))
+    if len(set(len(s) for s in seqs)) > 1:
+        raise ValueError(f"The sequences in {path} are not all the same length")
+    aln = numpy.frombuffer(b''.join(seqs), dtype = numpy.uint8).reshape(len(seqs), -1) if seqs else numpy.zeros((0, 0), dtype = numpy.uint8)
+    return(names, aln)
+
+
+def main(alignment, tab, fai, output):
+    names, aln = read_fasta(alignment)
+    idx = pandas.read_csv(fai, sep = '\t', header = None, usecols = [0, 1], names = ['contig', 'length'], dtype = {'contig': str})
+    sites = pandas.read_csv(tab, sep = '\t', usecols = ['CHR', 'POS'], dtype = {'CHR': str})
+    if len(sites) != aln.shape[1]:
+        raise ValueError(f"{tab} has {len(sites)} sites but {alignment} has {aln.shape[1]}")
+    chrom = sites['CHR'].map({c: i for i, c in enumerate(idx['contig'])}).to_numpy()
+    write_pack(output, names, aln, list(idx['contig']), idx['length'].to_numpy(), chrom, sites['POS'].to_numpy())
+
+
+def set_parsers():
+    parser = argparse.ArgumentParser(description='Pack a core alignment into a memory mappable file of 4 bit codes with an index of the sites, characters without a code are kept as they are',formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('alignment', help = 'core alignment (core.aln)')
+    parser.add_argument('-t', '--tab', help = 'core.tab with the CHR and POS of each site of the alignment', required = True)
+    parser.add_argument('-f', '--fai', help = 'fasta index of the reference', required = True)
+    parser.add_argument('-o', '--output', help = 'file to write to', default = 'core.pack')
+    args = parser.parse_args()
+    return(args)
+
+
+if __name__ == '__main__':
+    args = set_parsers()
+    main(args.alignment, args.tab, args.fai, args.output)
@@ -0,0 +1,157 @@
+import pathlib, mmap, json, argparse, datetime, concurrent.futures
+import numpy, pandas
+
+# bytes that are not counted as aligned in a snippy aligned fasta - no coverage, low coverage and heterozygous
+UNALIGNED = [ord('-'), ord('N'), ord('n')]
+
+
+def read_alignment(path):
+    '''
+    memory map an aligned fasta
+    input:
+        :path: path to the aligned fasta
+    output:
+        numpy uint8 array over the file (empty if the file is empty)
+    '''
+    with open(path, 'rb') as f:
+        if pathlib.Path(path).stat().st_size == 0:
+            return(numpy.empty(0, dtype = numpy.uint8))
+        mm = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+    return(numpy.frombuffer(mm, dtype = numpy.uint8))
+
+
+def contig_alignment(arr):
+    '''
+    the length and number of unaligned positions of each contig in an aligned fasta, in a single bincount per contig
+    input:
+        :arr: numpy uint8 array of the aligned fasta
+    output:
+        a list of (contig name, length, unaligned)
+    '''
+    newlines = numpy.flatnonzero(arr == 10)
+    line_starts = numpy.concatenate([[0], newlines + 1])
+    line_starts = line_starts[line_starts < len(arr)]
+    headers = line_starts[arr[line_starts] == 62]
+    header_ends = newlines[numpy.searchsorted(newlines, headers)] if len(newlines) else numpy.full(len(headers), len(arr))
+    seq_ends = numpy.append(headers[1:], len(arr))
+    contigs = []
+    for h, s, e in zip(headers, header_ends, seq_ends):
+        name = arr[h + 1:s].tobytes().decode().split()
+        counts = numpy.bincount(arr[s + 1:e], minlength = 256)
+        counts[[10, 13]] = 0
+        contigs.append((name[0] if name else '', int(counts.sum()), int(counts[UNALIGNED].sum())))
+    return(contigs)
+
+
+def qc_isolate(path):
+    '''
+    percent alignment to the reference of an isolate, overall and for each contig of the reference
+    input:
+        :path: path to {isolate}/snps.aligned.fa
+    output:
+        dictionary of the results for the isolate
+    '''
+    p = pathlib.Path(f"{path}")
+    contigs = contig_alignment(read_alignment(p))
+    length = sum(c[1] for c in contigs)
+    unaligned = sum(c[2] for c in contigs)
+    return({'Isolate': p.parts[-2], 'Length': length, 'Unaligned': unaligned,
+            '% Aligned': round(100 * (length - unaligned) / length, 2) if length else 0.0,
+            'contigs': [[name, l, u, round(100 * (l - u) / l, 2) if l else 0.0] for name, l, u in contigs]})
+
+
+def fingerprint(path):
+    '''
+    key for caching the result of an isolate - changes if the aligned fasta changes
+    '''
+    p = pathlib.Path(f"{path}").resolve()
+    s = p.stat()
+    return(f"{p}:{s.st_size}:{s.st_mtime_ns}")
+
+
+def get_qc(alignments, threads = 1, cache = None):
+    '''
+    qc each aligned fasta in a process pool, only isolates that are new or have changed since the last run are read
+    input:
+        :alignments: list of paths to snps.aligned.fa
+        :threads: number of processes
+        :cache: path to a json file to cache results in, None to not cache
+    output:
+        a list of dictionaries of results in the same order as alignments
+    '''
+    cached = {}
+    if cache and pathlib.Path(cache).exists():
+        try:
+            cached = json.loads(pathlib.Path(cache).read_text())
+        except json.decoder.JSONDecodeError:
+            cached = {}
+    keys = [fingerprint(a) for a in alignments]
+    todo = [(a, k) for a, k in zip(alignments, keys) if k not in cached]
+    if todo:
+        with concurrent.futures.ProcessPoolExecutor(max_workers = max(1, int(threads))) as pool:
+            for (_, k), result in zip(todo, pool.map(qc_isolate, [a for a, _ in todo])):
+                cached[k] = result
+        if cache:
+            pathlib.Path(cache).parent.mkdir(parents = True, exist_ok = True)
+            pathlib.Path(cache).write_text(json.dumps({k: cached[k] for k in keys}))
+    return([cached[k] for k in keys])
+
+
+def write_table(results, path):
+    '''
+    write the percent alignment of each contig of the reference for each isolate
+    '''
+    rows = [[r['Isolate'], 'All', r['Length'], r['Unaligned'], r['% Aligned']] for r in results]
+    for r in results:
+        rows.extend([[r['Isolate']] + c for c in r['contigs']])
+    df = pandas.DataFrame(rows, columns = ['Isolate', 'Contig', 'Length', 'Unaligned', '% Aligned'])
+    df.to_csv(path, sep = '\t', index = False)
+
+
+def update_log(excluded, min_aln, logpath, day):
+    '''
+    record isolates that failed alignment in the isolates.log
+    '''
+    logpath = pathlib.Path(logpath)
+    if excluded and logpath.exists():
+        lf = pandas.read_csv(logpath, sep = '\t', index_col = False)
+        failed = lf['Isolate'].isin([e.strip('#') for e in excluded])
+        lf.loc[failed, 'Status'] = f"(FAILED ALIGNMENT (<{min_aln}% ALIGNMENT))"
+        lf.loc[failed, 'Date'] = f"{day}"
+        lf.to_csv(logpath, sep = '\t', index = False)
+
+
+def main(alignments, min_aln, output, table, threads, cache, log, day):
+    results = get_qc(alignments, threads = threads, cache = cache)
+    included = []
+    excluded = []
+    for r in results:
+        # an isolate is included if the percent of the whole reference it aligns to is greater than the min alignment
+        if r['% Aligned'] > min_aln:
+            included.append(r['Isolate'])
+        else:
+            excluded.append(r['Isolate'])
+            print(f"{r['Isolate']} has been excluded from the analysis due to poor alignement with reference")
+    pathlib.Path(output).write_text('\n'.join(included))
+    if table:
+        write_table(results, table)
+    update_log(excluded, min_aln, log, day)
+
+
+def set_parsers():
+    parser = argparse.ArgumentParser(description='Percent alignment of snippy aligned fasta to the reference',formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('alignments', help = 'white space separated list of snps.aligned.fa', nargs = '+')
+    parser.add_argument('-m', '--min_aln', help = 'minimum percent alignment for an isolate to be included in the core', type = float, default = 0)
+    parser.add_argument('-o', '--output', help = 'file to write the list of included isolates to', default = 'core_isolates.txt')
+    parser.add_argument('-t', '--table', help = 'file to write the percent alignment of each contig to', default = None)
+    parser.add_argument('-j', '--threads', help = 'number of isolates to process at the same time', type = int, default = 1)
+    parser.add_argument('-c', '--cache', help = 'json file to cache results in, unchanged isolates are not read again', default = None)
+    parser.add_argument('-l', '--log', help = 'isolates.log to record failed isolates in', default = 'isolates.log')
+    parser.add_argument('-d', '--day', help = 'date recorded for failed isolates', default = datetime.datetime.today().strftime("%d_%m_%y"))
+    args = parser.parse_args()
+    return(args)
+
+
+if __name__ == '__main__':
+    args = set_parsers()
+    main(args.alignments, args.min_aln, args.output, args.table, args.threads, args.cache, args.log, args.day)
@@ -1,55 +1,156 @@
-from Bio import SeqIO
-import pathlib
-import pandas, argparse
-
-
-
-def fa(path, min_size, full_path):
+import pathlib, mmap, json, sys, argparse, concurrent.futures
+import numpy
+
+# the columns written for each assembly
+COLNAMES = ['Name','bp','# Contigs','Ns','# Gaps','Min Contig size','Max Contig size','Avg Contig size','N50','L50','GC content']
+# upper bounds of the contig size bins reported with --distribution
+SIZE_BINS = [1000, 5000, 10000, 50000, 100000]
+
+
+def read_fasta(path):
+    '''
+    memory map a fasta file
+    input:
+        :path: path to fasta
+    output:
+        numpy uint8 array over the file (empty if the file is empty)
+    '''
+    with open(path, 'rb') as f:
+        if pathlib.Path(path).stat().st_size == 0:
+            return(numpy.empty(0, dtype = numpy.uint8))
+        mm = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+    return(numpy.frombuffer(mm, dtype = numpy.uint8))
+
+
+def contig_counts(arr):
+    '''
+    count each byte value in every contig of a fasta
+    input:
+        :arr: numpy uint8 array of the fasta file
+    output:
+        numpy array (contigs x 256) of byte counts for the sequence of each contig (headers excluded)
+    '''
+    newlines = numpy.flatnonzero(arr == 10)
+    # a record starts with '>' at the start of the file or after a newline
+    line_starts = numpy.concatenate([[0], newlines + 1])
+    line_starts = line_starts[line_starts < len(arr)]
+    headers = line_starts[arr[line_starts] == 62]
+    # end of each header line is the first newline after the '>', or the end of the file for a last header with no newline
+    header_ends = numpy.append(newlines, len(arr))[numpy.searchsorted(newlines, headers)]
+    seq_starts = header_ends + 1
+    seq_ends = numpy.append(headers[1:], len(arr))
+    counts = numpy.zeros((len(headers), 256), dtype = numpy.int64)
+    for i, (s, e) in enumerate(zip(seq_starts, seq_ends)):
+        counts[i] = numpy.bincount(arr[s:e], minlength = 256)
+    # line endings are not sequence
+    counts[:, [10, 13]] = 0
+    return(counts)
+
+
+def nx(lengths, target):
+    '''
+    the N50 style statistic - the length of the contig (and how many contigs) at which the
+    cumulative length of contigs, longest first, reaches target
+    input:
+        :lengths: contig lengths sorted longest first
+        :target: the length to reach (half the assembly for N50, half the genome size for NG50)
+    output:
+        (length, number of contigs), (0, 0) if the target is never reached
+    '''
+    cumulative = numpy.cumsum(lengths)
+    idx = numpy.searchsorted(cumulative, target)
+    if idx >= len(lengths):
+        return(0, 0)
+    return(int(lengths[idx]), int(idx + 1))
+
+
+def fa(path, min_size, full_path, genome_size = 0):
     p = pathlib.Path(f"{path}")
     isolate = f"{p}" if full_path else p.name.split('.')[0]
-    min_len = 1.0e+10
-    max_len = 0
-    contig_length = []
-    Ns = 0
-    gaps = 0
-    contigs_less_than_min = 0
     min_size = int(min_size)
-    no = 0
-    for i in SeqIO.parse(f"{p}", 'fasta'):
-            contig_length.append(len(i.seq))
-            if len(i.seq) < min_size:
-                    contigs_less_than_min += 1
-            else:   
-                    min_len = len(i.seq) if len(i.seq) < min_len else min_len
-                    max_len = len(i.seq) if len(i.seq) > max_len else max_len
-                    Ns = Ns + i.seq.lower().count('n')
-                    gaps = gaps + i.seq.count('-')
-                    no += 1
-    length = sum([c for c in contig_length if c > min_size])
-    len_sorted = sorted([c for c in contig_length if c > min_size])
-    avg_len = int(length/ len([c for c in contig_length if c > min_size]))
-    cum = 0 
-    N50 = 0
-    for c in len_sorted:
-            # print(c)
-            cum += c
-            # print(cum)
-            if cum >= length/2:
-                    N50 = c
-                    break
-
-    data = {'Name': isolate, 'bp':length, '# Contigs':no, 'Ns':Ns, '# Gaps':gaps, 'Min Contig size':min_len, 'Max Contig size':max_len,  'Avg Contig size':avg_len, 'N50':N50}
+    counts = contig_counts(read_fasta(p))
+    lengths = counts.sum(axis = 1)
+    # only contigs at least min_size are included in calculations
+    keep = lengths >= min_size
+    counts = counts[keep]
+    lengths = numpy.sort(lengths[keep])[::-1]
+    length = int(lengths.sum())
+    no = len(lengths)
+    lower = counts[:, [ord(c) for c in 'acgt']] + counts[:, [ord(c) for c in 'ACGT']]
+    acgt = int(lower.sum())
+    gc = int(lower[:, 1:3].sum())
+    N50, L50 = nx(lengths, length / 2)
+    data = {'Name': isolate, 'bp':length, '# Contigs':no,
+            'Ns':int(counts[:, [ord('n'), ord('N')]].sum()), '# Gaps':int(counts[:, ord('-')].sum()),
+            'Min Contig size':int(lengths[-1]) if no else 0, 'Max Contig size':int(lengths[0]) if no else 0,
+            'Avg Contig size':int(length / no) if no else 0, 'N50':N50, 'L50':L50,
+            'GC content': round(100 * gc / acgt, 2) if acgt else 0.0}
+    if genome_size:
+        data['NG50'], data['LG50'] = nx(lengths, int(genome_size) / 2)
+    # number of contigs in each size bin
+    bins = numpy.searchsorted(SIZE_BINS, lengths, side = 'right')
+    data['distribution'] = numpy.bincount(bins, minlength = len(SIZE_BINS) + 1).tolist()
     return(data)
 
-def get_fa_stat(assemblies, minsize, full_path):
-    colnames = ['Name','bp','# Contigs','Ns','# Gaps','Min Contig size','Max Contig size','Avg Contig size','N50']
-    # print(colnames)
-    print('\t'.join(colnames))
-    for a in assemblies:
-        data = fa(path=a, min_size = minsize, full_path = full_path)
-        # print(data)
-        print('\t'.join([f"{data[x]}" for x in colnames]))
-        
+
+def fingerprint(path, min_size, genome_size):
+    '''
+    key for caching the statistics of an assembly - changes if the file or settings change
+    '''
+    p = pathlib.Path(f"{path}").resolve()
+    s = p.stat()
+    return(f"{p}:{s.st_size}:{s.st_mtime_ns}:{min_size}:{genome_size}")
+
+
+def get_fa_stat(assemblies, minsize, full_path, genome_size = 0, threads = 1, cache = None):
+    '''
+    calculate statistics for each assembly, spread across a process pool, reusing cached results for unchanged files
+    input:
+        :assemblies: list of paths to assemblies
+        :minsize: min contig size to be included in calculations
+        :full_path: use the full path as the isolate identifier
+        :genome_size: expected genome size for NG50, 0 to skip
+        :threads: number of processes
+        :cache: path to a json file to cache results in, None to not cache
+    output:
+        a list of dictionaries of statistics in the same order as assemblies
+    '''
+    cached = {}
+    if cache and pathlib.Path(cache).exists():
+        try:
+            cached = json.loads(pathlib.Path(cache).read_text())
+        except json.decoder.JSONDecodeError:
+            cached = {}
+    keys = [fingerprint(a, minsize, genome_size) for a in assemblies]
+    todo = [(a, k) for a, k in zip(assemblies, keys) if k not in cached]
+    if todo:
+        with concurrent.futures.ProcessPoolExecutor(max_workers = max(1, int(threads))) as pool:
+            jobs = [pool.submit(fa, a, minsize, full_path, genome_size) for a, _ in todo]
+            for (_, k), j in zip(todo, jobs):
+                cached[k] = j.result()
+        if cache:
+            pathlib.Path(cache).parent.mkdir(parents = True, exist_ok = True)
+            pathlib.Path(cache).write_text(json.dumps({k: cached[k] for k in keys}))
+    return([cached[k] for k in keys])
+
+
+def write_table(results, genome_size = 0, out = sys.stdout):
+    colnames = COLNAMES + ['NG50', 'LG50'] if genome_size else COLNAMES
+    print('\t'.join(colnames), file = out)
+    for data in results:
+        print('\t'.join([f"{data[x]}" for x in colnames]), file = out)
+
+
+def write_distribution(results, path):
+    '''
+    write the number of contigs in each size bin for each assembly
+    '''
+    edges = [0] + SIZE_BINS
+    colnames = [f"{edges[i]}-{edges[i + 1] - 1}" for i in range(len(SIZE_BINS))] + [f">={SIZE_BINS[-1]}"]
+    with open(path, 'w') as f:
+        print('\t'.join(['Name'] + colnames), file = f)
+        for data in results:
+            print('\t'.join([data['Name']] + [f"{d}" for d in data['distribution']]), file = f)
 
 
 def set_parsers():
@@ -58,8 +159,10 @@ def set_parsers():
     parser.add_argument('assemblies', help = 'white space separated list of assemblies', nargs='+')
     parser.add_argument('-m', '--minsize', help = 'min contig size to be included in calculations', default = 500)
     parser.add_argument('-f', '--full_path',action = 'store_true', help = 'Set if you would like to use the full path as the isolate identifer - default to the name of the fasta file')
-    
-
+    parser.add_argument('-g', '--genome_size', help = 'expected genome size, if set NG50 and LG50 are also reported', type = int, default = 0)
+    parser.add_argument('-j', '--threads', help = 'number of assemblies to process at the same time', type = int, default = 1)
+    parser.add_argument('-c', '--cache', help = 'json file to cache results in, unchanged assemblies are not read again', default = None)
+    parser.add_argument('-d', '--distribution', help = 'write the number of contigs in each size range to this file', default = None)
 
     args = parser.parse_args()
     return(args)
@@ -70,13 +173,11 @@ def main():
     if vars(args) == {}:
         parser.print_help(sys.stderr)
     else:
-        assemblies = args.assemblies
-        full_path = args.full_path
-        minsize = args.minsize
-        get_fa_stat(assemblies, minsize, full_path)
+        results = get_fa_stat(args.assemblies, args.minsize, args.full_path, genome_size = args.genome_size, threads = args.threads, cache = args.cache)
+        write_table(results, genome_size = args.genome_size)
+        if args.distribution:
+            write_distribution(results, args.distribution)
 
 
 if __name__ == '__main__':
     main()
-
-
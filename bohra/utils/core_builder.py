@@ -0,0 +1,480 @@
+import pathlib, mmap, hashlib, os, argparse, concurrent.futures
+import numpy
+
+# number of genome positions read from each aligned fasta at a time
+BLOCK_SIZE = 1 << 22
+# character used for masked positions in the full alignment
+MASK_CHAR = ord('X')
+# bytes that are a base call
+IS_BASE = numpy.zeros(256, dtype = bool)
+IS_BASE[numpy.frombuffer(b'ACGT', dtype = numpy.uint8)] = True
+# columns of the core.txt, the value for each is counted over the masked full alignment
+STATS = ['LENGTH', 'ALIGNED', 'UNALIGNED', 'VARIANT', 'HET', 'MASKED', 'LOWCOV']
+
+
+def read_reference(path):
+    '''
+    read the reference
+    input:
+        :path: path to the reference in fasta format
+    output:
+        list of contig names, numpy array of contig lengths and a numpy uint8 array of the (upper case) sequence of all contigs
+    '''
+    names = []
+    seqs = []
+    for record in pathlib.Path(path).read_bytes().split(b'\n>'):
+        if not record.strip():
+            continue
+        header, _, seq = record.lstrip(b'>').partition(b'\n')
+        names.append(header.split()[0].decode())
+        seqs.append(b''.join(seq.split()).upper())
+    lengths = numpy.array([len(s) for s in seqs], dtype = numpy.int64)
+    return(names, lengths, numpy.frombuffer(b''.join(seqs), dtype = numpy.uint8))
+
+
+def reference_key(names, seq):
+    '''
+    digest of the reference, saved counts are only reused with the same reference
+    '''
+    digest = hashlib.md5(' '.join(names).encode())
+    digest.update(seq.tobytes())
+    return(digest.hexdigest())
+
+
+def file_key(path):
+    '''
+    key of an aligned fasta - if the file changes the key changes
+    '''
+    p = pathlib.Path(path).resolve()
+    s = p.stat()
+    return(f"{p}:{s.st_size}:{s.st_mtime_ns}")
+
+
+def layout(path, lengths):
+    '''
+    memory map an aligned fasta and find where the sequence of each contig starts, the aligned fasta
+    has the same contigs as the reference in the same order with a fixed line width
+    input:
+        :path: path to the aligned fasta
+        :lengths: numpy array of the contig lengths of the reference
+    output:
+        numpy uint8 array over the file, numpy arrays of the offset of the start of each contig sequence and of the line width of each contig
+    '''
+    with open(path, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+    arr = numpy.frombuffer(mm, dtype = numpy.uint8)
+    starts = numpy.zeros(len(lengths), dtype = numpy.int64)
+    widths = numpy.zeros(len(lengths), dtype = numpy.int64)
+    offset = 0
+    for i, length in enumerate(lengths):
+        if offset >= len(arr) or arr[offset] != 62:
+            raise ValueError(f"{path} does not have the same contigs as the reference")
+        starts[i] = mm.find(b'\n', offset) + 1
+        line_end = mm.find(b'\n', starts[i])
+        widths[i] = max(1, (line_end if line_end != -1 else len(arr)) - starts[i])
+        offset = starts[i] + length + -(-length // widths[i])
+    return(arr, starts, widths)
+
+
+def offsets(starts, widths, cumulative, positions):
+    '''
+    the offset in an aligned fasta of each position (0 based, across all contigs end to end)
+    '''
+    contig = numpy.searchsorted(cumulative, positions, side = 'right') - 1
+    local = positions - cumulative[contig]
+    return(starts[contig] + local + local // widths[contig])
+
+
+def read_positions(aln, cumulative, positions):
+    '''
+    the characters of an aligned fasta at positions
+    input:
+        :aln: (array, starts, widths) from layout
+        :cumulative: numpy array of the position each contig of the reference starts at
+        :positions: numpy array of positions
+    output:
+        numpy uint8 array of the characters
+    '''
+    arr, starts, widths = aln
+    return(arr[offsets(starts, widths, cumulative, positions)])
+
+
+def read_blocks(aln, cumulative, total):
+    '''
+    stream an aligned fasta BLOCK_SIZE positions at a time
+    output:
+        start of the block and a numpy uint8 array of its characters
+    '''
+    for start in range(0, total, BLOCK_SIZE):
+        yield(start, read_positions(aln, cumulative, numpy.arange(start, min(start + BLOCK_SIZE, total))))
+
+
+def count_isolates(paths, reference, lengths):
+    '''
+    count, at every position, the isolates without a base call and the isolates with a base different to the reference
+    input:
+        :paths: paths to aligned fasta
+        :reference: numpy uint8 array of the reference sequence
+        :lengths: numpy array of the contig lengths of the reference
+    output:
+        numpy uint32 arrays of uncalled and variant counts at each position
+    '''
+    cumulative = numpy.concatenate([[0], numpy.cumsum(lengths)[:-1]])
+    uncalled = numpy.zeros(len(reference), dtype = numpy.uint32)
+    variant = numpy.zeros(len(reference), dtype = numpy.uint32)
+    for path in paths:
+        aln = layout(path, lengths)
+        for start, block in read_blocks(aln, cumulative, len(reference)):
+            called = IS_BASE[block]
+            uncalled[start:start + len(block)] += ~called
+            variant[start:start + len(block)] += called & (block != reference[start:start + len(block)])
+    return(uncalled, variant)
+
+
+def count_all(paths, reference, lengths, threads = 1):
+    '''
+    count_isolates over groups of isolates in a process pool
+    '''
+    groups = [g for g in [paths[i::max(1, threads)] for i in range(max(1, threads))] if g]
+    uncalled = numpy.zeros(len(reference), dtype = numpy.uint32)
+    variant = numpy.zeros(len(reference), dtype = numpy.uint32)
+    if len(groups) == 1:
+        results = [count_isolates(groups[0], reference, lengths)]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers = len(groups)) as pool:
+            results = list(pool.map(count_isolates, groups, [reference] * len(groups), [lengths] * len(groups)))
+    for u, v in results:
+        uncalled += u
+        variant += v
+    return(uncalled, variant)
+
+
+class MaskIndex:
+    '''
+    sorted, merged intervals of masked positions (positions across all contigs end to end, so the ranges
+    of each contig stay separate), looked up by binary search rather than holding a flag per position
+    '''
+    def __init__(self, starts = (), ends = ()):
+        self.starts = numpy.asarray(starts, dtype = numpy.int64)
+        self.ends = numpy.asarray(ends, dtype = numpy.int64)
+
+    @classmethod
+    def from_bed(cls, bed, names, lengths):
+        '''
+        input:
+            :bed: path to a bed file of regions to mask, None for no mask
+            :names: contig names of the reference
+            :lengths: numpy array of the contig lengths of the reference
+        '''
+        if not bed:
+            return(cls())
+        cumulative = dict(zip(names, numpy.concatenate([[0], numpy.cumsum(lengths)[:-1]]).tolist()))
+        length = dict(zip(names, lengths.tolist()))
+        ranges = []
+        for line in pathlib.Path(bed).read_text().split('\n'):
+            fields = line.split()
+            if len(fields) < 3 or fields[0] not in cumulative:
+                continue
+            start, end = max(0, int(fields[1])), min(length[fields[0]], int(fields[2]))
+            if end > start:
+                ranges.append((cumulative[fields[0]] + start, cumulative[fields[0]] + end))
+        merged = []
+        for start, end in sorted(ranges):
+            if merged and start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+        return(cls([m[0] for m in merged], [m[1] for m in merged]))
+
+    def masked(self, positions):
+        '''
+        numpy boolean array, True for each of positions that is masked
+        '''
+        i = numpy.searchsorted(self.starts, positions, side = 'right') - 1
+        return((i >= 0) & (positions < self.ends[numpy.maximum(i, 0)]) if len(self.starts) else numpy.zeros(len(positions), dtype = bool))
+
+    def block(self, start, end):
+        '''
+        numpy boolean array, True for each position from start to end that is masked
+        '''
+        flags = numpy.zeros(end - start, dtype = bool)
+        first = numpy.searchsorted(self.ends, start, side = 'right')
+        last = numpy.searchsorted(self.starts, end, side = 'left')
+        for s, e in zip(self.starts[first:last], self.ends[first:last]):
+            flags[max(s, start) - start:min(e, end) - start] = True
+        return(flags)
+
+    def positions(self):
+        '''
+        numpy array of every masked position
+        '''
+        return(numpy.concatenate([numpy.arange(s, e) for s, e in zip(self.starts, self.ends)]) if len(self.starts) else numpy.zeros(0, dtype = numpy.int64))
+
+    def total(self):
+        return(int((self.ends - self.starts).sum()))
+
+
+def load_state(path, ref_key):
+    '''
+    load the counts saved by a previous run, None if there are none or they are for a different reference
+    '''
+    path = pathlib.Path(path) if path else None
+    if not path or not path.exists():
+        return(None)
+    with numpy.load(path, allow_pickle = False) as saved:
+        state = {k: saved[k] for k in saved.files}
+    if f"{state['reference']}" != ref_key:
+        return(None)
+    return(state)
+
+
+def save_state(path, state):
+    path = pathlib.Path(path)
+    path.parent.mkdir(parents = True, exist_ok = True)
+    tmp = path.with_name(f".{path.name}.tmp.npz")
+    numpy.savez(tmp, **state)
+    os.replace(tmp, path)
+
+
+def update(isolates, reference, names, lengths, state_path = None, threads = 1):
+    '''
+    count the isolates at each position and collect the bases of every isolate at the sites that are core
+    and variable before masking. Counts from a previous run are updated by removing and adding isolates.
+    input:
+        :isolates: dictionary of isolate name and path to its aligned fasta
+        :reference: numpy uint8 array of the reference sequence
+        :names: contig names of the reference
+        :lengths: numpy array of the contig lengths of the reference
+        :state_path: path to the counts saved by a previous run, None to start again
+        :threads: number of processes
+    output:
+        the state - a dictionary of the counts, the sites and the bases of each isolate at the sites
+    '''
+    ref_key = reference_key(names, reference)
+    keys = {i: file_key(p) for i, p in isolates.items()}
+    state = load_state(state_path, ref_key)
+    if state is not None:
+        saved = dict(zip(state['names'].tolist(), state['keys'].tolist()))
+        saved_paths = dict(zip(state['names'].tolist(), state['paths'].tolist()))
+        # counts can only be removed for an isolate whose aligned fasta is unchanged, otherwise start again
+        changed = [i for i in saved if i in isolates and keys[i] != saved[i]]
+        gone = [i for i in saved if i not in isolates and (not pathlib.Path(saved_paths[i]).exists() or file_key(saved_paths[i]) != saved[i])]
+        if changed or gone:
+            state = None
+    if state is None:
+        state = {'reference': numpy.array(ref_key), 'names': numpy.array([], dtype = str), 'keys': numpy.array([], dtype = str),
+                 'paths': numpy.array([], dtype = str), 'uncalled': numpy.zeros(len(reference), dtype = numpy.uint32),
+                 'variant': numpy.zeros(len(reference), dtype = numpy.uint32), 'sites': numpy.zeros(0, dtype = numpy.int64),
+                 'bases': numpy.zeros((0, 0), dtype = numpy.uint8)}
+    saved_names = state['names'].tolist()
+    removed = [i for i in saved_names if i not in isolates]
+    added = [i for i in isolates if i not in saved_names]
+    if removed:
+        u, v = count_all([state['paths'][saved_names.index(i)] for i in removed], reference, lengths, threads = threads)
+        state['uncalled'] -= u
+        state['variant'] -= v
+    if added:
+        u, v = count_all([isolates[i] for i in added], reference, lengths, threads = threads)
+        state['uncalled'] += u
+        state['variant'] += v
+    # sites where every isolate and the reference have a base and at least one isolate differs from the reference
+    sites = numpy.flatnonzero((state['uncalled'] == 0) & (state['variant'] > 0) & IS_BASE[reference])
+    cumulative = numpy.concatenate([[0], numpy.cumsum(lengths)[:-1]])
+    old_sites = {s: i for i, s in enumerate(state['sites'].tolist())}
+    known = numpy.array([s in old_sites for s in sites.tolist()], dtype = bool)
+    known_cols = numpy.array([old_sites[s] for s in sites[known].tolist()], dtype = numpy.int64)
+    bases = numpy.zeros((len(isolates), len(sites)), dtype = numpy.uint8)
+    for row, i in enumerate(isolates):
+        if i in saved_names:
+            old_row = saved_names.index(i)
+            bases[row, known] = state['bases'][old_row, known_cols]
+            # only the sites that have become core are read from the aligned fasta
+            if (~known).any():
+                bases[row, ~known] = read_positions(layout(isolates[i], lengths), cumulative, sites[~known])
+        elif len(sites):
+            bases[row] = read_positions(layout(isolates[i], lengths), cumulative, sites)
+    state.update({'names': numpy.array(list(isolates), dtype = str), 'keys': numpy.array([keys[i] for i in isolates], dtype = str),
+                  'paths': numpy.array([f"{isolates[i]}" for i in isolates], dtype = str), 'sites': sites, 'bases': bases})
+    return(state)
+
+
+def as_rows(cells):
+    '''
+    tab separated lines from a numpy uint8 array of single characters, without a python call per cell
+    '''
+    out = numpy.full((cells.shape[0], 2 * cells.shape[1]), 9, dtype = numpy.uint8)
+    out[:, 0::2] = cells
+    if out.size:
+        out[:, -1] = 10
+    return([r.tobytes().decode() for r in out])
+
+
+def write_core(prefix, state, names, lengths, reference, mask):
+    '''
+    write the core alignment of variable sites (.aln), the sites as a table (.tab) and as a vcf (.vcf)
+    '''
+    keep = ~mask.masked(state['sites'])
+    sites = state['sites'][keep]
+    bases = state['bases'][:, keep]
+    isolates = state['names'].tolist()
+    cumulative = numpy.concatenate([[0], numpy.cumsum(lengths)[:-1]])
+    contig = numpy.searchsorted(cumulative, sites, side = 'right') - 1
+    pos = sites - cumulative[contig] + 1
+    ref = reference[sites]
+    with open(f"{prefix}.aln", 'w') as f:
+        f.write(f">Reference\n{ref.tobytes().decode()}\n")
+        for i, row in zip(isolates, bases):
+            f.write(f">{i}\n{row.tobytes().decode()}\n")
+    chrom = [f"{names[c]}\t{p}\t" for c, p in zip(contig, pos)]
+    with open(f"{prefix}.tab", 'w') as f:
+        f.write('\t'.join(['CHR', 'POS', 'REF'] + isolates) + '\n')
+        for c, row in zip(chrom, as_rows(numpy.vstack([ref, bases]).T)):
+            f.write(c + row)
+    # alleles are numbered in the order A, C, G, T after the reference allele
+    acgt = numpy.frombuffer(b'ACGT', dtype = numpy.uint8)
+    present = (bases[:, :, None] == acgt).any(axis = 0) & (ref[:, None] != acgt)
+    allele = numpy.where(ref[:, None] == acgt, 0, numpy.cumsum(present, axis = 1))
+    code = numpy.zeros(256, dtype = numpy.int64)
+    code[acgt] = numpy.arange(4)
+    gt = numpy.take_along_axis(allele, code[bases].T, axis = 1) + ord('0')
+    with open(f"{prefix}.vcf", 'w') as f:
+        f.write("##fileformat=VCFv4.2\n##source=bohra core_builder\n")
+        f.write(''.join(f"##contig=<ID={n},length={l}>\n" for n, l in zip(names, lengths)))
+        f.write('##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">\n')
+        f.write('\t'.join(['#CHROM', 'POS', 'ID', 'REF', 'ALT', 'QUAL', 'FILTER', 'INFO', 'FORMAT'] + isolates) + '\n')
+        for j, row in enumerate(as_rows(gt.astype(numpy.uint8))):
+            alt = ','.join(chr(b) for b in acgt[present[j]])
+            f.write(f"{names[contig[j]]}\t{pos[j]}\t.\t{chr(ref[j])}\t{alt}\t.\t.\t.\tGT\t" + row)
+    return(len(sites))
+
+
+def count_stats(block, reference):
+    '''
+    the core.txt statistics of a block of the masked full alignment
+    '''
+    called = IS_BASE[block]
+    counts = numpy.bincount(block, minlength = 256)
+    return(numpy.array([len(block), called.sum(), counts[ord('-')], (called & (block != reference)).sum(),
+                        counts[ord('n')], counts[MASK_CHAR], counts[ord('N')]], dtype = numpy.int64))
+
+
+def write_full(prefix, state, isolates, lengths, reference, mask):
+    '''
+    stream the masked full alignment (.full.aln) one isolate and block at a time, counting the statistics for the .txt
+    output:
+        numpy array of the statistics of the reference and each isolate
+    '''
+    cumulative = numpy.concatenate([[0], numpy.cumsum(lengths)[:-1]])
+    stats = numpy.zeros((len(state['names']) + 1, len(STATS)), dtype = numpy.int64)
+    with open(f"{prefix}.full.aln", 'wb') as f:
+        masked_ref = numpy.where(mask.block(0, len(reference)), MASK_CHAR, reference).astype(numpy.uint8)
+        f.write(b">Reference\n" + masked_ref.tobytes() + b"\n")
+        stats[0] = count_stats(masked_ref, masked_ref)
+        for row, i in enumerate(state['names'].tolist()):
+            f.write(f">{i}\n".encode())
+            for start, block in read_blocks(layout(isolates[i], lengths), cumulative, len(reference)):
+                end = start + len(block)
+                block = numpy.where(mask.block(start, end), MASK_CHAR, block).astype(numpy.uint8)
+                stats[row + 1] += count_stats(block, reference[start:end])
+                f.write(block.tobytes())
+            f.write(b"\n")
+    return(stats)
+
+
+def patch_full(path, state, isolates, lengths, reference, mask):
+    '''
+    update a full alignment written with a different mask in place, only the positions where the mask has
+    changed are written - newly masked positions become X and unmasked positions are restored from the
+    reference or the aligned fasta of the isolate. The statistics are adjusted in the same way.
+    input:
+        :path: path to the full alignment written by a previous run
+        :state: the state, with the mask and statistics the full alignment was written with
+        :mask: the new MaskIndex
+    output:
+        numpy array of the statistics of the reference and each isolate
+    '''
+    previous = MaskIndex(state['mask_starts'], state['mask_ends'])
+    cumulative = numpy.concatenate([[0], numpy.cumsum(lengths)[:-1]])
+    newly = mask.positions()
+    newly = newly[~previous.masked(newly)]
+    restored = previous.positions()
+    restored = restored[~mask.masked(restored)]
+    stats = state['stats'].copy()
+    offset = 0
+    with open(path, 'r+b') as f:
+        mm = mmap.mmap(f.fileno(), 0)
+        arr = numpy.frombuffer(mm, dtype = numpy.uint8)
+        for row, i in enumerate(['Reference'] + state['names'].tolist()):
+            offset += len(f">{i}\n".encode())
+            if row == 0:
+                before, after = reference[newly], reference[restored]
+            else:
+                aln = layout(isolates[i], lengths)
+                before, after = read_positions(aln, cumulative, newly), read_positions(aln, cumulative, restored)
+            masked_new = numpy.full(len(newly), MASK_CHAR, dtype = numpy.uint8)
+            masked_old = numpy.full(len(restored), MASK_CHAR, dtype = numpy.uint8)
+            stats[row] += count_stats(masked_new, reference[newly]) - count_stats(before, reference[newly])
+            stats[row] += count_stats(after, reference[restored]) - count_stats(masked_old, reference[restored])
+            arr[offset + newly] = MASK_CHAR
+            arr[offset + restored] = after
+            offset += len(reference) + 1
+        del arr
+        mm.flush()
+        mm.close()
+    # the reference row is compared to itself, there are no variants
+    stats[0, STATS.index('VARIANT')] = 0
+    return(stats)
+
+
+def write_txt(prefix, names, stats):
+    '''
+    write the statistics of the reference and each isolate (.txt)
+    '''
+    with open(f"{prefix}.txt", 'w') as f:
+        f.write('\t'.join(['ID'] + STATS) + '\n')
+        for name, row in zip(['Reference'] + names, stats):
+            f.write('\t'.join([name] + [f"{r}" for r in row]) + '\n')
+
+
+def main(isolates, ref, mask, prefix, state_path, threads, full_cache = None):
+    names, lengths, reference = read_reference(ref)
+    isolates = {pathlib.Path(i).name: pathlib.Path(i) / 'snps.aligned.fa' for i in isolates}
+    mask = MaskIndex.from_bed(mask, names, lengths)
+    state = update(isolates, reference, names, lengths, state_path = state_path, threads = threads)
+    n = write_core(prefix, state, names, lengths, reference, mask)
+    # a full alignment from the previous run with the same isolates only needs the positions where the mask changed updated
+    previous = pathlib.Path(full_cache) if full_cache else None
+    if previous and previous.exists() and 'written' in state and state['written'].tolist() == state['names'].tolist() \
+        and f"{state['full_key']}" == f"{previous.stat().st_size}:{previous.stat().st_mtime_ns}":
+        stats = patch_full(previous, state, isolates, lengths, reference, mask)
+        os.replace(previous, f"{prefix}.full.aln")
+        print(f"Updated the mask of the full alignment from {previous}")
+    else:
+        if previous and previous.exists():
+            previous.unlink()
+        stats = write_full(prefix, state, isolates, lengths, reference, mask)
+    write_txt(prefix, state['names'].tolist(), stats)
+    full = pathlib.Path(f"{prefix}.full.aln").stat()
+    state.update({'written': state['names'], 'stats': stats, 'mask_starts': mask.starts, 'mask_ends': mask.ends,
+                  'full_key': numpy.array(f"{full.st_size}:{full.st_mtime_ns}")})
+    if state_path:
+        save_state(state_path, state)
+    print(f"{n} core variable sites in {len(isolates)} isolates, {mask.total()} positions masked")
+
+
+def set_parsers():
+    parser = argparse.ArgumentParser(description='Build a core genome alignment from snippy output, the output is the same as snippy-core',formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('isolates', help = 'white space separated list of snippy output directories', nargs = '+')
+    parser.add_argument('-r', '--ref', help = 'reference in fasta format', required = True)
+    parser.add_argument('-m', '--mask', help = 'bed file of regions to mask', default = None)
+    parser.add_argument('-p', '--prefix', help = 'prefix of output files', default = 'core')
+    parser.add_argument('-s', '--state', help = 'file to save counts in, isolates are added to or removed from a saved core without rebuilding it', default = None)
+    parser.add_argument('-j', '--threads', help = 'number of processes', type = int, default = 1)
+    parser.add_argument('-f', '--full_cache', help = 'full alignment kept from the previous run, if only the mask has changed it is updated in place rather than written again', default = None)
+    args = parser.parse_args()
+    return(args)
+
+
+if __name__ == '__main__':
+    args = set_parsers()
+    main(args.isolates, args.ref, args.mask, args.prefix, args.state, args.threads, full_cache = args.full_cache)
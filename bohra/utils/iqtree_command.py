@@ -0,0 +1,166 @@
+import pathlib, hashlib, json, sys, os, tempfile, argparse
+import numpy
+from Bio import Phylo
+from Bio.Phylo.Newick import Clade
+try:
+    from bohra.utils import core_builder, snp_dists
+except ImportError:
+    import core_builder, snp_dists
+
+# constant sites are added to the alignment for each of these bases, in this order
+BASES = b'ACGT'
+# number of tree search iterations when starting from the previous tree
+LOCAL_ITERATIONS = 10
+
+
+def content_key(reference, mask = None):
+    '''
+    digest of the reference (and mask), counts are only reused for the same content
+    '''
+    digest = hashlib.md5()
+    for path in [reference, mask]:
+        if path:
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 24), b''):
+                    digest.update(chunk)
+        digest.update(b'\0')
+    return(digest.hexdigest())
+
+
+def count_constant(reference, mask = None):
+    '''
+    count each base in the reference, leaving out masked regions, in a single pass
+    input:
+        :reference: path to the reference in fasta format
+        :mask: path to a bed file of regions to mask, None for no mask
+    output:
+        a list of the number of A, C, G and T
+    '''
+    names, lengths, seq = core_builder.read_reference(reference)
+    counts = numpy.bincount(seq, minlength = 256)
+    masked = core_builder.MaskIndex.from_bed(mask, names, lengths).positions()
+    if len(masked):
+        counts = counts - numpy.bincount(seq[masked], minlength = 256)
+    return([int(counts[b]) for b in BASES])
+
+
+def read_cache(cache):
+    '''
+    the counts in the cache, empty if there is no cache or it can not be read
+    '''
+    if cache and pathlib.Path(cache).exists():
+        try:
+            return(json.loads(pathlib.Path(cache).read_text()))
+        except json.decoder.JSONDecodeError:
+            return({})
+    return({})
+
+
+def get_constant(reference, mask = None, cache = None):
+    '''
+    the constant site counts for the reference, from the cache if the same reference and mask have been counted before
+    the cache can be shared by jobs running at the same time, so it is read again and merged just before it is written
+    and the new file is moved into place in one step
+    input:
+        :reference: path to the reference in fasta format
+        :mask: path to a bed file of regions to mask, None for no mask
+        :cache: path to a json file to cache counts in, None to not cache
+    output:
+        a list of the number of A, C, G and T
+    '''
+    key = content_key(reference, mask)
+    cached = read_cache(cache)
+    if key in cached:
+        return(cached[key])
+    counts = count_constant(reference, mask)
+    if cache:
+        folder = pathlib.Path(cache).parent
+        folder.mkdir(parents = True, exist_ok = True)
+        cached = read_cache(cache)
+        cached[key] = counts
+        with tempfile.NamedTemporaryFile('w', dir = folder, suffix = '.tmp', delete = False) as f:
+            f.write(json.dumps(cached))
+        os.replace(f.name, cache)
+    return(counts)
+
+
+def place_isolates(previous, alignment, fraction):
+    '''
+    put the isolates that are new since the previous run onto the previous tree, each next to the isolate
+    it has the fewest snps to, and drop isolates that are no longer in the alignment
+    input:
+        :previous: path to the tree from the previous run
+        :alignment: path to the core alignment
+        :fraction: the largest fraction of isolates that can be new
+    output:
+        the tree (Bio.Phylo) to start from, None if the tree should be built from scratch
+    '''
+    if not previous or not pathlib.Path(previous).exists() or fraction <= 0:
+        return(None)
+    tree = Phylo.read(f"{previous}", 'newick')
+    names, aln = snp_dists.read_alignment(alignment)
+    leaves = set(leaf.name for leaf in tree.get_terminals())
+    new = [i for i, name in enumerate(names) if name not in leaves]
+    kept = [name for name in names if name in leaves]
+    if len(kept) < 3 or len(new) > fraction * len(names):
+        return(None)
+    for leaf in tree.get_terminals():
+        if leaf.name not in names:
+            tree.prune(leaf)
+    if new:
+        # branch lengths are a starting point only, iqtree optimises them
+        dist = snp_dists.distances(aln, rows = new) / max(1, aln.shape[1])
+        placed = numpy.array([name in leaves for name in names])
+        for row, i in enumerate(new):
+            nearest = numpy.flatnonzero(placed)[numpy.argmin(dist[row][placed])]
+            clade = tree.find_any(name = names[nearest])
+            clade.clades = [Clade(branch_length = dist[row][nearest] / 2, name = clade.name), Clade(branch_length = dist[row][nearest] / 2, name = names[i])]
+            clade.name = None
+            placed[i] = True
+    return(tree)
+
+
+def iqtree_command(constant, alignment, prefix, cpus, start = None):
+    '''
+    the iqtree command, constant sites are added with -fconst (http://www.iqtree.org/doc/Command-Reference)
+    if there is a starting tree only a few rounds of tree search are run from it - ultrafast bootstrap is left out
+    as it samples trees during a full search, SH-aLRT is tested on the final tree so branch support is still given
+    '''
+    support = '-alrt 1000' if start else '-bb 1000 -alrt 1000'
+    cmd = f"iqtree -fconst {','.join([f'{c}' for c in constant])} -m GTR+G4 {support} -ntmax {cpus} -nt AUTO -st DNA -s {alignment} -pre {prefix}"
+    if start:
+        cmd = f"{cmd} -t {start} -n {LOCAL_ITERATIONS}"
+    return(cmd)
+
+
+def main(reference, alignment, prefix, cpus, mask, cache, previous, fraction):
+    constant = get_constant(reference, mask = mask, cache = cache)
+    tree = place_isolates(previous, alignment, fraction)
+    start = None
+    if tree:
+        start = f"{prefix}.start.tree"
+        Phylo.write(tree, start, 'newick')
+        print(f"Placing new isolates on the previous tree {previous}", file = sys.stderr)
+        # there is no bootstrap consensus tree without a full search, do not leave the one from the previous run
+        print(f"rm -f {prefix}.contree")
+    # the script is run with the threads snakemake gives the rule as its first argument, cpus if it is run without one
+    print(iqtree_command(constant, alignment, prefix, f"${{1:-{cpus}}}", start = start))
+
+
+def set_parsers():
+    parser = argparse.ArgumentParser(description='Write the iqtree command for a core alignment, with the constant sites of the reference',formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('reference', help = 'reference in fasta format')
+    parser.add_argument('alignment', help = 'core alignment (core.aln)')
+    parser.add_argument('-p', '--prefix', help = 'prefix for the iqtree output', default = 'core')
+    parser.add_argument('-n', '--cpus', help = 'maximum number of threads for iqtree if the script it writes is run without a number of threads', type = int, default = 1)
+    parser.add_argument('-m', '--mask', help = 'bed file of regions of the reference to leave out of the constant sites', default = None)
+    parser.add_argument('-c', '--cache', help = 'json file to cache constant site counts in, keyed on the content of the reference and mask, it can be shared by jobs', default = None)
+    parser.add_argument('-t', '--previous', help = 'tree from the previous run, new isolates are placed on it rather than building the tree from scratch', default = None)
+    parser.add_argument('-f', '--fraction', help = 'the tree is built from scratch if more than this fraction of isolates are not on the previous tree', type = float, default = 0.1)
+    args = parser.parse_args()
+    return(args)
+
+
+if __name__ == '__main__':
+    args = set_parsers()
+    main(args.reference, args.alignment, args.prefix, args.cpus, args.mask, args.cache, args.previous, args.fraction)
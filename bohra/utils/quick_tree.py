@@ -0,0 +1,104 @@
+import pathlib, argparse
+import numpy
+
+# number of Q matrix values calculated at a time
+BLOCK_SIZE = 1 << 16
+
+
+def read_distances(path):
+    '''
+    read a distance matrix in the snp-dists format
+    output:
+        a list of names and a numpy float64 array (isolates x isolates) of distances
+    '''
+    lines = [l.split('\t') for l in pathlib.Path(path).read_text().strip('\n').split('\n')]
+    names = [l[0] for l in lines[1:]]
+    matrix = numpy.array([l[1:] for l in lines[1:]], dtype = numpy.float64).reshape(len(names), len(names))
+    return(names, matrix)
+
+
+def closest_pair(active, r, buffer):
+    '''
+    the pair of nodes with the smallest value in the neighbour joining Q matrix, Q is calculated a block of
+    rows at a time into buffer so the whole matrix is never held and the block stays in cache
+    input:
+        :active: numpy float64 array (nodes x nodes) of distances
+        :r: numpy float64 array of the sum of distances of each node
+        :buffer: numpy float64 array to calculate blocks of Q in
+    output:
+        the indices (i < j) of the pair
+    '''
+    n = len(r)
+    rows = max(1, len(buffer) // n)
+    best = (numpy.inf, 0, 1)
+    for start in range(0, n, rows):
+        end = min(n, start + rows)
+        q = buffer[:(end - start) * n].reshape(end - start, n)
+        numpy.multiply(active[start:end], n - 2, out = q)
+        q -= r[None, :]
+        q -= r[start:end, None]
+        q[numpy.arange(end - start), numpy.arange(start, end)] = numpy.inf
+        k = int(numpy.argmin(q))
+        if q.flat[k] < best[0]:
+            best = (q.flat[k], start + k // n, k % n)
+    return(min(best[1:]), max(best[1:]))
+
+
+def neighbour_joining(names, matrix):
+    '''
+    neighbour joining tree (Saitou and Nei 1987), the distance matrix is updated in place and shrinks by one
+    each round, so memory stays at a single isolates x isolates array
+    input:
+        :names: names of the isolates
+        :matrix: numpy float64 array (isolates x isolates) of distances
+    output:
+        the tree in newick format
+    '''
+    n = len(names)
+    if n == 0:
+        return(';')
+    if n == 1:
+        return(f"({names[0]});")
+    d = numpy.array(matrix, dtype = numpy.float64)
+    labels = list(names)
+    r = d.sum(axis = 1)
+    buffer = numpy.empty(BLOCK_SIZE, dtype = numpy.float64)
+    while n > 3:
+        active = d[:n, :n]
+        i, j = closest_pair(active, r[:n], buffer)
+        bi = max(0.0, 0.5 * active[i, j] + (r[i] - r[j]) / (2 * (n - 2)))
+        bj = max(0.0, active[i, j] - bi)
+        # the new node replaces i, the last isolate is moved into the place of j
+        node = 0.5 * (active[i] + active[j] - active[i, j])
+        node[[i, j]] = 0
+        r[:n] += node - active[i] - active[j]
+        r[i] = node.sum()
+        labels[i] = f"({labels[i]}:{bi:g},{labels[j]}:{bj:g})"
+        active[i, :] = node
+        active[:, i] = node
+        last = n - 1
+        if j != last:
+            active[j, :] = active[last, :]
+            active[:, j] = active[:, last]
+            active[j, j] = 0
+            labels[j] = labels[last]
+            r[j] = r[last]
+        n -= 1
+    if n == 2:
+        return(f"({labels[0]}:{d[0, 1] / 2:g},{labels[1]}:{d[0, 1] / 2:g});")
+    lengths = [max(0.0, (d[a, b] + d[a, c] - d[b, c]) / 2) for a, b, c in [(0, 1, 2), (1, 0, 2), (2, 0, 1)]]
+    return(f"({labels[0]}:{lengths[0]:g},{labels[1]}:{lengths[1]:g},{labels[2]}:{lengths[2]:g});")
+
+
+def set_parsers():
+    parser = argparse.ArgumentParser(description='Neighbour joining tree from a snp distance matrix',formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('distances', help = 'distance matrix from snp_dists.py (distances.tab)')
+    parser.add_argument('-o', '--output', help = 'file to write the tree to in newick format', default = 'core.treefile')
+    args = parser.parse_args()
+    return(args)
+
+
+if __name__ == '__main__':
+    args = set_parsers()
+    names, matrix = read_distances(args.distances)
+    pathlib.Path(args.output).write_text(f"{neighbour_joining(names, matrix)}\n")
@@ -0,0 +1,306 @@
+import gzip, pathlib, argparse
+import numpy, pandas
+
+# size of each block of decompressed sequence data read from the fastq
+CHUNK_SIZE = 1 << 24
+# line type for each line of a fastq record
+HEADER, SEQUENCE, SEPARATOR, QUALITY = range(4)
+# offset for phred encoded quality scores
+PHRED_OFFSET = 33
+# settings for the k-mer based depth estimate (same k-mer size and minimum copies as mash sketch -r -m 3 -k 31)
+KMER_SIZE = 31
+MIN_COPIES = 3
+# only 1 in SKETCH_SCALE k-mers (by hash) are counted
+SKETCH_SCALE = 64
+# number of sequence bytes turned into k-mers at a time, bounds memory use
+KMER_BLOCK = 1 << 20
+# 2 bit encoding of bases, anything that is not ACGT breaks a k-mer
+BASE_CODES = numpy.full(256, 4, dtype = numpy.uint8)
+for code, bases in enumerate(['Aa', 'Cc', 'Gg', 'Tt']):
+    for b in bases:
+        BASE_CODES[ord(b)] = code
+
+
+def open_reads(path):
+    '''
+    open a fastq file for reading in binary mode, gzipped or not
+    input:
+        :path: path to the fastq file
+    output:
+        a file handle
+    '''
+    with open(path, 'rb') as f:
+        magic = f.read(2)
+    if magic == b'\x1f\x8b':
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def fastq_blocks(path, chunk_size = CHUNK_SIZE):
+    '''
+    stream a fastq file in large blocks which only contain complete records
+    input:
+        :path: path to the fastq file
+        :chunk_size: number of decompressed bytes to read at a time
+    output:
+        yields numpy uint8 arrays of whole records
+    '''
+    leftover = b''
+    with open_reads(path) as f:
+        while True:
+            data = f.read(chunk_size)
+            if not data:
+                break
+            buf = leftover + data
+            arr = numpy.frombuffer(buf, dtype = numpy.uint8)
+            newlines = numpy.flatnonzero(arr == 10)
+            nrecords = len(newlines) // 4
+            if nrecords == 0:
+                leftover = buf
+                continue
+            end = newlines[4 * nrecords - 1] + 1
+            leftover = buf[end:]
+            yield arr[:end]
+    if leftover.strip():
+        if not leftover.endswith(b'\n'):
+            leftover = leftover + b'\n'
+        arr = numpy.frombuffer(leftover, dtype = numpy.uint8)
+        if numpy.count_nonzero(arr == 10) % 4 != 0:
+            raise ValueError(f"{path} ends with an incomplete fastq record")
+        yield arr
+
+
+def split_lines(block):
+    '''
+    get the start and length of each line in a block of whole fastq records
+    input:
+        :block: numpy uint8 array of complete records
+    output:
+        :starts: index of the first byte of each line
+        :lengths: length of each line without the newline
+    '''
+    ends = numpy.flatnonzero(block == 10)
+    starts = numpy.empty_like(ends)
+    starts[0] = 0
+    starts[1:] = ends[:-1] + 1
+    return(starts, ends - starts)
+
+
+def mix_hash(values):
+    '''
+    64 bit finaliser from splitmix64 - spreads k-mer values evenly over the hash space
+    '''
+    with numpy.errstate(over = 'ignore'):
+        values = values ^ (values >> numpy.uint64(30))
+        values = values * numpy.uint64(0xbf58476d1ce4e5b9)
+        values = values ^ (values >> numpy.uint64(27))
+        values = values * numpy.uint64(0x94d049bb133111eb)
+        values = values ^ (values >> numpy.uint64(31))
+    return(values)
+
+
+def canonical_kmers(codes, k = KMER_SIZE):
+    '''
+    build the canonical (smaller of forward and reverse complement) 2 bit packed k-mers of a run of encoded bases
+    k-mers are built by doubling, (1, 2, 4, 8 and 16-mers are joined) rather than shifting in one base at a time
+    input:
+        :codes: numpy uint8 array of base codes (0-3, 4 for any other character)
+        :k: k-mer size (at most 32)
+    output:
+        numpy uint64 array of the canonical k-mers that do not contain a non ACGT character
+    '''
+    n = len(codes) - k + 1
+    if n <= 0:
+        return(numpy.empty(0, dtype = numpy.uint64))
+    invalid = numpy.concatenate([[0], numpy.cumsum(codes > 3)])
+    valid = (invalid[k:] - invalid[:-k]) == 0
+    forward = {1: (codes & 3).astype(numpy.uint64)}
+    reverse = {1: numpy.uint64(3) - forward[1]}
+    size = 1
+    while size * 2 <= k:
+        f, r = forward[size], reverse[size]
+        forward[size * 2] = (f[:-size] << numpy.uint64(2 * size)) | f[size:]
+        reverse[size * 2] = r[:-size] | (r[size:] << numpy.uint64(2 * size))
+        size = size * 2
+    fw = numpy.zeros(n, dtype = numpy.uint64)
+    rc = numpy.zeros(n, dtype = numpy.uint64)
+    offset = 0
+    for size in sorted(forward, reverse = True):
+        if offset + size <= k and (k - offset) & size:
+            fw |= forward[size][offset:offset + n] << numpy.uint64(2 * (k - offset - size))
+            rc |= reverse[size][offset:offset + n] << numpy.uint64(2 * offset)
+            offset = offset + size
+    return(numpy.minimum(fw, rc)[valid])
+
+
+class KmerDepth:
+    '''
+    Estimate genome size and sequencing depth from a hash sample of the canonical k-mers in the reads.
+    K-mers seen fewer than min_copies times are treated as sequencing errors.
+    '''
+    def __init__(self, k = KMER_SIZE, min_copies = MIN_COPIES, scale = SKETCH_SCALE):
+        self.k = k
+        self.min_copies = min_copies
+        self.scale = scale
+        self.threshold = numpy.uint64((1 << 64) // scale - 1)
+        self.hashes = numpy.empty(0, dtype = numpy.uint64)
+        self.counts = numpy.empty(0, dtype = numpy.int64)
+        self.pending = []
+        self.pending_size = 0
+
+    def update(self, sequence):
+        '''
+        add the k-mers from sequence data to the sample
+        input:
+            :sequence: numpy uint8 array of sequence lines, each ending in a newline
+        '''
+        codes = BASE_CODES[sequence]
+        for start in range(0, len(codes), KMER_BLOCK):
+            kmers = canonical_kmers(codes[start:start + KMER_BLOCK + self.k - 1], k = self.k)
+            hashes = mix_hash(kmers)
+            hashes = hashes[hashes <= self.threshold]
+            self.pending.append(hashes)
+            self.pending_size += len(hashes)
+        # only merge once enough hashes are waiting so that the counted set is not re-sorted for every block
+        if self.pending_size >= max(len(self.hashes), KMER_BLOCK):
+            self.merge()
+
+    def merge(self):
+        '''
+        fold the hashes waiting to be counted into the counts
+        '''
+        if self.pending_size == 0:
+            return
+        hashes = numpy.concatenate(self.pending + [self.hashes])
+        weights = numpy.concatenate([numpy.ones(self.pending_size, dtype = numpy.int64), self.counts])
+        self.hashes, inverse = numpy.unique(hashes, return_inverse = True)
+        self.counts = numpy.bincount(inverse.ravel(), weights = weights, minlength = len(self.hashes)).astype(numpy.int64)
+        self.pending = []
+        self.pending_size = 0
+
+    def estimate(self):
+        '''
+        output:
+            :genome_size: estimated number of distinct (solid) k-mers in the genome
+            :depth: total k-mers in the reads over the estimated genome size (as reported by mash)
+        '''
+        self.merge()
+        solid = numpy.count_nonzero(self.counts >= self.min_copies)
+        if solid == 0:
+            return(0, 0.0)
+        genome_size = solid * self.scale
+        depth = self.counts.sum() / solid
+        return(int(genome_size), float(depth))
+
+
+class ReadStats:
+    '''
+    Accumulate read statistics (counts, yield, composition, length and quality histograms) over blocks of fastq records.
+    If a KmerDepth is given the sequence data is also added to it, so depth is estimated in the same pass.
+    '''
+    def __init__(self, kmers = None):
+        self.kmers = kmers
+        self.reads = 0
+        self.length_hist = numpy.zeros(1, dtype = numpy.int64)
+        self.base_counts = numpy.zeros(256, dtype = numpy.int64)
+        self.qual_counts = numpy.zeros(256, dtype = numpy.int64)
+
+    def update(self, block):
+        '''
+        add a block of whole fastq records to the running totals
+        input:
+            :block: numpy uint8 array of complete records
+        '''
+        starts, lengths = split_lines(block)
+        nrecords = len(lengths) // 4
+        # label every byte with the type of line it belongs to (newlines included)
+        line_types = numpy.tile(numpy.arange(4, dtype = numpy.uint8), nrecords)
+        byte_types = numpy.repeat(line_types, lengths + 1)
+        self.reads += nrecords
+        hist = numpy.bincount(lengths[SEQUENCE::4])
+        if len(hist) > len(self.length_hist):
+            hist[:len(self.length_hist)] += self.length_hist
+            self.length_hist = hist
+        else:
+            self.length_hist[:len(hist)] += hist
+        sequence = block[byte_types == SEQUENCE]
+        self.base_counts += numpy.bincount(sequence, minlength = 256)
+        if self.kmers is not None:
+            self.kmers.update(sequence)
+        self.qual_counts += numpy.bincount(block[byte_types == QUALITY], minlength = 256)
+
+    def median_length(self):
+        '''
+        the median read length from the length histogram, the lower of the two middle lengths when there is an even
+        number of reads
+        '''
+        # the length of the read in the middle of the reads sorted by length
+        position = numpy.searchsorted(numpy.cumsum(self.length_hist), (self.reads + 1) // 2)
+        return(int(position))
+
+    def summary(self):
+        '''
+        output:
+            a dictionary of read statistics using the same names as seqtk fqchk
+        '''
+        # newline and carriage return bytes are counted against their line, drop them
+        for counts in [self.base_counts, self.qual_counts]:
+            counts[[10, 13]] = 0
+        bases = int(self.base_counts.sum())
+        lengths = numpy.flatnonzero(self.length_hist)
+        gc = sum(int(self.base_counts[ord(b)]) for b in 'GCgc')
+        scores = numpy.arange(256) - PHRED_OFFSET
+        avg_qual = float((self.qual_counts * scores).sum() / self.qual_counts.sum()) if bases else 0.0
+        data = {
+            'Reads': self.reads,
+            'bases': bases,
+            'GC content': round(100 * gc / bases, 2) if bases else 0.0,
+            'min_len': int(lengths[0]) if len(lengths) else 0,
+            'avg_len': round(bases / self.reads, 2) if self.reads else 0.0,
+            'max_len': int(lengths[-1]) if len(lengths) else 0,
+            'avgQ': round(avg_qual, 1),
+            'med_len': self.median_length() if self.reads else 0
+        }
+        if self.kmers is not None:
+            data['Genome size'], data['Estimated depth'] = self.kmers.estimate()
+        return(data)
+
+
+def get_stats(reads, chunk_size = CHUNK_SIZE, depth = True):
+    '''
+    generate read statistics for one or more fastq files in a single pass over each file
+    input:
+        :reads: list of paths to fastq files (R1 and R2)
+        :depth: if True also estimate genome size and depth from the k-mers in the reads
+    output:
+        a dictionary of read statistics
+    '''
+    stats = ReadStats(kmers = KmerDepth() if depth else None)
+    for r in reads:
+        for block in fastq_blocks(r, chunk_size = chunk_size):
+            stats.update(block)
+    return(stats.summary())
+
+
+def main(reads, outputpath):
+    data = get_stats(reads)
+    print(f"Estimated genome size: {data['Genome size']}")
+    print(f"Estimated depth: {data['Estimated depth']:.2f}")
+    df = pandas.DataFrame(data = data, index = [0])
+    df['Estimated depth'] = int(data['Estimated depth'])
+    df = df.rename(columns={'bases':'Yield', 'min_len': 'Min len', 'avg_len': 'Avg len', 'max_len':'Max len', 'avgQ': 'Avg Qual'})
+    df = df[['Reads','Yield','GC content','Min len','Avg len','Max len','Avg Qual','Estimated depth']]
+    df.to_csv(pathlib.Path(f"{outputpath}"), index = False, sep = '\t')
+
+
+def set_parsers():
+    parser = argparse.ArgumentParser(description='Read statistics and estimated depth (replaces seqtk fqchk and mash sketch) for paired end reads',formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('reads', help = 'path to R1 and R2', nargs='+')
+    parser.add_argument('-o', '--output', help = 'path to yield.tab', required = True)
+    args = parser.parse_args()
+    return(args)
+
+
+if __name__ == '__main__':
+    args = set_parsers()
+    main(args.reads, args.output)
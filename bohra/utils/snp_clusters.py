@@ -0,0 +1,103 @@
+import pathlib, argparse
+import numpy
+
+
+def find(parent, nodes):
+    '''
+    the root of each of nodes in a union-find forest
+    input:
+        :parent: numpy int64 array of the parent of each node
+        :nodes: numpy array of node indices
+    output:
+        numpy int64 array of roots
+    '''
+    roots = parent[nodes]
+    while True:
+        up = parent[roots]
+        if (up == roots).all():
+            return(roots)
+        roots = up
+
+
+def stream_rows(path, skip = ('Reference',)):
+    '''
+    read a distance matrix in the snp-dists format one row at a time, yielding the part of each row above the diagonal
+    input:
+        :path: path to distances.tab
+        :skip: names of rows (and columns) to leave out
+    output:
+        the names first, then (index, numpy int64 array of the distances to later isolates) for each isolate
+    '''
+    with open(path) as f:
+        header = f.readline().rstrip('\n').split('\t')[1:]
+        keep = numpy.array([name not in skip for name in header], dtype = bool)
+        yield([name for name, k in zip(header, keep) if k])
+        i = 0
+        for line in f:
+            fields = line.rstrip('\n').split('\t')
+            if not fields[0] or fields[0] in skip:
+                continue
+            row = numpy.array(fields[1:], dtype = numpy.int64)[keep]
+            yield(i, row[i + 1:])
+            i += 1
+
+
+def cluster(path, thresholds):
+    '''
+    single linkage clusters at each threshold, a union-find forest per threshold is updated from each row
+    of the matrix in turn so only one row is held at a time
+    input:
+        :path: path to distances.tab
+        :thresholds: list of snp thresholds
+    output:
+        a list of names and a numpy int64 array (isolates x thresholds) of cluster numbers, numbered from 1 in the
+        order each cluster is first seen
+    '''
+    rows = stream_rows(path)
+    names = next(rows)
+    n = len(names)
+    parents = [numpy.arange(n, dtype = numpy.int64) for t in thresholds]
+    for i, row in rows:
+        for parent, t in zip(parents, thresholds):
+            linked = numpy.flatnonzero(row <= t) + i + 1
+            if len(linked):
+                root = find(parent, numpy.array([i]))[0]
+                roots = find(parent, linked)
+                parent[roots] = root
+                parent[linked] = root
+    clusters = numpy.zeros((n, len(thresholds)), dtype = numpy.int64)
+    for c, parent in enumerate(parents):
+        _, first, inverse = numpy.unique(find(parent, numpy.arange(n)), return_index = True, return_inverse = True)
+        rank = numpy.empty(len(first), dtype = numpy.int64)
+        rank[numpy.argsort(first)] = numpy.arange(1, len(first) + 1)
+        clusters[:, c] = rank[inverse]
+    return(names, clusters)
+
+
+def write_table(names, clusters, thresholds, path):
+    '''
+    write the cluster of each isolate at each threshold and a cluster code of the clusters from the largest
+    threshold to the smallest, isolates with the same code up to a level are in the same cluster at that level
+    '''
+    order = numpy.argsort(thresholds)[::-1]
+    lines = ['\t'.join(['Isolate', 'Cluster code'] + [f"Cluster {thresholds[o]} SNPs" for o in order])]
+    for name, row in zip(names, clusters):
+        levels = [f"{row[o]}" for o in order]
+        lines.append('\t'.join([name, '.'.join(levels)] + levels))
+    pathlib.Path(path).write_text('\n'.join(lines) + '\n')
+
+
+def set_parsers():
+    parser = argparse.ArgumentParser(description='Single linkage snp clusters at several thresholds from a snp distance matrix',formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('distances', help = 'distance matrix from snp_dists.py (distances.tab)')
+    parser.add_argument('-t', '--thresholds', help = 'comma separated snp thresholds', default = '5,10,25')
+    parser.add_argument('-o', '--output', help = 'file to write the clusters to', default = 'clusters.tab')
+    args = parser.parse_args()
+    return(args)
+
+
+if __name__ == '__main__':
+    args = set_parsers()
+    thresholds = [int(t) for t in args.thresholds.split(',')]
+    names, clusters = cluster(args.distances, thresholds)
+    write_table(names, clusters, thresholds, args.output)
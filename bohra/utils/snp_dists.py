@@ -0,0 +1,326 @@
+import pathlib, sys, os, zipfile, argparse, concurrent.futures
+import numpy, pandas
+try:
+    from bohra.utils import alignment_pack
+except ImportError:
+    import alignment_pack
+
+# top left cell written by snp-dists, kept so that distances.tab is identical to the snp-dists output
+HEADER = 'snp-dists 0.7.0'
+# the bases compared when ambiguous bases are ignored
+BASES = b'ACGT'
+# number of 64 bit words of a tile held in memory at a time
+TILE_WORDS = 1 << 22
+# when more than this fraction of the core columns were added or removed the distances are worked out again rather
+# than updated
+REBUILD_FRACTION = 0.5
+# number of set bits in each byte, used when numpy has no bitwise_count
+POPCOUNT = numpy.array([bin(i).count('1') for i in range(256)], dtype = numpy.uint8)
+
+
+def read_alignment(path, keep_case = False):
+    '''
+    read a multiple sequence alignment in fasta format
+    input:
+        :path: path to the alignment
+        :keep_case: do not convert sequences to upper case
+    output:
+        a list of names and a numpy uint8 array (isolates x positions) of the alignment
+    '''
+    names = []
+    seqs = []
+    for record in pathlib.Path(path).read_bytes().split(b'\n>'):
+        if not record.strip():
+            continue
+        header, _, seq = record.lstrip(b'>').partition(b'\n')
+        names.append(header.split()[0].decode() if header.split() else '')
+        seqs.append(b''.join(seq.split()))
+    lengths = set(len(s) for s in seqs)
+    if len(lengths) > 1:
+        raise ValueError(f"The sequences in {path} are not all the same length")
+    aln = numpy.frombuffer(b''.join(seqs), dtype = numpy.uint8).reshape(len(seqs), -1) if seqs else numpy.empty((0, 0), dtype = numpy.uint8)
+    if not keep_case:
+        aln = alignment_pack.upper_case(aln)
+    return(names, aln)
+
+
+def read_packed(path, keep_case = False):
+    '''
+    read a packed alignment (core.pack), which also has the position of each column - the pack is memory mapped
+    but the alignment is decoded into memory
+    input:
+        :path: path to the pack
+        :keep_case: do not convert sequences to upper case
+    output:
+        a list of names, a numpy uint8 array (isolates x positions) of the alignment and numpy array of CHR:POS:REF for each column
+    '''
+    packed = alignment_pack.read_pack(path)
+    aln = alignment_pack.unpack(packed)
+    if not keep_case:
+        aln = alignment_pack.upper_case(aln)
+    names = packed['isolates']
+    ref = aln[names.index('Reference')] if 'Reference' in names else numpy.full(aln.shape[1], ord('N'), dtype = numpy.uint8)
+    columns = numpy.array([f"{packed['contigs'][c]}:{p}:{chr(r)}" for c, p, r in zip(packed['chrom'], packed['pos'], ref)], dtype = str)
+    return(names, aln, columns)
+
+
+def pack(mask):
+    '''
+    pack a boolean array (isolates x positions) into 64 bit words, 64 positions per word
+    '''
+    packed = numpy.packbits(mask, axis = 1)
+    pad = (-packed.shape[1]) % 8
+    if pad:
+        packed = numpy.pad(packed, ((0, 0), (0, pad)))
+    return(numpy.ascontiguousarray(packed).view(numpy.uint64))
+
+
+def encode(aln, all_chars = False):
+    '''
+    encode the alignment as packed bit planes - each character is given a code and bit k of the code for every
+    position is packed into plane k, a separate mask marks the positions that are compared
+    input:
+        :aln: numpy uint8 array (isolates x positions)
+        :all_chars: compare every character in the alignment, otherwise only A, C, G and T
+    output:
+        numpy uint64 arrays of the code planes (bits x isolates x words) and of the mask (isolates x words)
+    '''
+    chars = numpy.unique(aln) if all_chars else numpy.frombuffer(BASES, dtype = numpy.uint8)
+    lookup = numpy.zeros(256, dtype = numpy.uint8)
+    lookup[chars] = numpy.arange(len(chars))
+    codes = lookup[aln]
+    bits = max(1, int(len(chars) - 1).bit_length())
+    planes = numpy.stack([pack((codes >> b) & 1) for b in range(bits)]) if aln.size else numpy.zeros((bits, aln.shape[0], 0), dtype = numpy.uint64)
+    mask = pack(numpy.isin(aln, chars)) if aln.size else numpy.zeros((aln.shape[0], 0), dtype = numpy.uint64)
+    return(planes, mask)
+
+
+def popcount(words, axis):
+    '''
+    the number of set bits in an array of uint64 words, summed over axis
+    '''
+    if hasattr(numpy, 'bitwise_count'):
+        return(numpy.bitwise_count(words).sum(axis = axis, dtype = numpy.int64))
+    as_bytes = words.view(numpy.uint8).reshape(words.shape[:-1] + (-1,))
+    return(POPCOUNT[as_bytes].sum(axis = axis, dtype = numpy.int64))
+
+
+_rows = None
+_cols = None
+
+
+def _set_planes(rows, cols):
+    global _rows, _cols
+    _rows = rows
+    _cols = cols
+
+
+def tile_distances(rows, cols):
+    '''
+    distances between one block of isolates and another - the number of positions compared in both isolates where any bit of the code differs
+    input:
+        :rows: (start, end) of the isolates in the first block
+        :cols: (start, end) of the isolates in the second block
+    output:
+        numpy int64 array (rows x cols) of distances
+    '''
+    a, ma = _rows[0][:, rows[0]:rows[1]], _rows[1][rows[0]:rows[1]]
+    b, mb = _cols[0][:, cols[0]:cols[1]], _cols[1][cols[0]:cols[1]]
+    dist = numpy.zeros((ma.shape[0], mb.shape[0]), dtype = numpy.int64)
+    for i in range(ma.shape[0]):
+        differ = numpy.bitwise_or.reduce(a[:, i:i + 1] ^ b, axis = 0)
+        dist[i] = popcount(differ & ma[i] & mb, axis = 1)
+    return(dist)
+
+
+def blocks(n, size):
+    '''
+    (start, end) of blocks of isolates
+    '''
+    return([(s, min(s + size, n)) for s in range(0, n, size)])
+
+
+def distances(aln, all_chars = False, threads = 1, rows = None):
+    '''
+    pairwise distances between isolates in the alignment
+    input:
+        :aln: numpy uint8 array (isolates x positions)
+        :all_chars: count all differences, otherwise only differences between A, C, G and T
+        :threads: number of processes
+        :rows: indices of the isolates to calculate distances for, None for every isolate
+    output:
+        numpy int64 array (isolates x isolates) of distances, or (rows x isolates) if rows is given
+    '''
+    n = aln.shape[0]
+    planes, mask = encode(aln, all_chars = all_chars)
+    if rows is None:
+        matrix = numpy.zeros((n, n), dtype = numpy.int64)
+        row_planes = (planes, mask)
+    else:
+        rows = numpy.asarray(rows, dtype = numpy.int64)
+        matrix = numpy.zeros((len(rows), n), dtype = numpy.int64)
+        row_planes = (planes[:, rows], mask[rows])
+    if matrix.size == 0:
+        return(matrix)
+    threads = max(1, int(threads))
+    # a tile is sized so that the planes of one isolate against a block of isolates fit in TILE_WORDS
+    # and there are enough tiles to keep every process busy
+    size = max(1, min(-(-n // (2 * threads)) if threads > 1 else n, TILE_WORDS // max(1, planes.shape[0] * mask.shape[1])))
+    if rows is None:
+        # the matrix is symmetric so only the upper triangle of tiles is calculated
+        jobs = [(r, c) for i, r in enumerate(blocks(n, size)) for c in blocks(n, size)[i:]]
+    else:
+        jobs = [(r, c) for r in blocks(len(rows), size) for c in blocks(n, size)]
+    threads = min(threads, len(jobs))
+    if threads == 1:
+        _set_planes(row_planes, (planes, mask))
+        results = [tile_distances(r, c) for r, c in jobs]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers = threads, initializer = _set_planes, initargs = (row_planes, (planes, mask))) as pool:
+            results = list(pool.map(tile_distances, [r for r, _ in jobs], [c for _, c in jobs]))
+    for (r, c), d in zip(jobs, results):
+        matrix[r[0]:r[1], c[0]:c[1]] = d
+        if rows is None:
+            matrix[c[0]:c[1], r[0]:r[1]] = d.T
+    return(matrix)
+
+
+def read_columns(core_tab):
+    '''
+    an identifier for each column of the core alignment from the core.tab, which has a row for each column
+    input:
+        :core_tab: path to the core.tab
+    output:
+        numpy array of CHR:POS:REF strings
+    '''
+    df = pandas.read_csv(core_tab, sep = '\t', usecols = ['CHR', 'POS', 'REF'], dtype = str)
+    return((df['CHR'] + ':' + df['POS'] + ':' + df['REF']).to_numpy(dtype = str))
+
+
+def load_store(store, settings):
+    '''
+    load the distances saved by a previous run, None if there are none or they were calculated with different settings
+    '''
+    store = pathlib.Path(store)
+    if not store.exists():
+        return(None)
+    try:
+        with numpy.load(store, allow_pickle = False) as saved:
+            saved = {k: saved[k] for k in saved.files}
+    except (OSError, ValueError, zipfile.BadZipFile):
+        return(None)
+    if saved['settings'].tolist() != settings:
+        return(None)
+    return(saved)
+
+
+def save_store(store, names, columns, aln, matrix, settings):
+    '''
+    save the distances with the isolates and alignment columns they were calculated from
+    '''
+    store = pathlib.Path(store)
+    store.parent.mkdir(parents = True, exist_ok = True)
+    tmp = store.with_name(f".{store.name}.tmp.npz")
+    numpy.savez(tmp, names = numpy.array(names, dtype = str), columns = columns, aln = aln, matrix = matrix, settings = numpy.array(settings))
+    os.replace(tmp, store)
+
+
+def incremental_distances(names, aln, columns, store, all_chars = False, keep_case = False, threads = 1):
+    '''
+    pairwise distances, reusing the distances saved by a previous run. Distances are a sum over columns, so for isolates
+    whose sequence at the shared columns has not changed only the columns removed from or added to the core are counted.
+    New isolates, and isolates whose sequence has changed, are calculated against every isolate and isolates
+    no longer in the alignment are dropped.
+    input:
+        :names: names of the isolates in the alignment
+        :aln: numpy uint8 array (isolates x positions)
+        :columns: identifier of each column of the alignment
+        :store: path to the saved distances, updated on completion
+        :all_chars: count all differences, otherwise only differences between A, C, G and T
+        :keep_case: the alignment was not converted to upper case
+        :threads: number of processes
+    output:
+        numpy int64 array (isolates x isolates) of distances and the number of isolates that were calculated in full
+    '''
+    settings = [f"{all_chars}", f"{keep_case}"]
+    columns = numpy.asarray(columns, dtype = str)
+    saved = load_store(store, settings)
+    n = len(names)
+    if saved is None or len(columns) != aln.shape[1]:
+        matrix = distances(aln, all_chars = all_chars, threads = threads)
+        if len(columns) == aln.shape[1]:
+            save_store(store, names, columns, aln, matrix, settings)
+        return(matrix, n)
+    old_index = {name: i for i, name in enumerate(saved['names'].tolist())}
+    old_columns = {c: i for i, c in enumerate(saved['columns'].tolist())}
+    shared = numpy.array([c in old_columns for c in columns], dtype = bool)
+    shared_old = numpy.array([old_columns[c] for c in columns[shared]], dtype = numpy.int64)
+    removed = numpy.setdiff1d(numpy.arange(len(old_columns)), shared_old)
+    # isolates from the previous run with the same sequence at the shared columns
+    kept = [i for i, name in enumerate(names) if name in old_index]
+    kept_old = numpy.array([old_index[names[i]] for i in kept], dtype = numpy.int64)
+    same = (aln[kept][:, shared] == saved['aln'][kept_old][:, shared_old]).all(axis = 1) if kept else numpy.zeros(0, dtype = bool)
+    clean = numpy.array(kept, dtype = numpy.int64)[same]
+    clean_old = kept_old[same]
+    changed = (~shared).sum() + len(removed)
+    # when most of the core has changed it is quicker to start again
+    if len(clean) == 0 or changed > aln.shape[1] * REBUILD_FRACTION:
+        matrix = distances(aln, all_chars = all_chars, threads = threads)
+        save_store(store, names, columns, aln, matrix, settings)
+        return(matrix, n)
+    matrix = numpy.zeros((n, n), dtype = numpy.int64)
+    sub = saved['matrix'][numpy.ix_(clean_old, clean_old)]
+    if len(removed):
+        sub = sub - distances(saved['aln'][clean_old][:, removed], all_chars = all_chars, threads = threads)
+    if (~shared).any():
+        sub = sub + distances(aln[clean][:, ~shared], all_chars = all_chars, threads = threads)
+    matrix[numpy.ix_(clean, clean)] = sub
+    todo = numpy.setdiff1d(numpy.arange(n), clean)
+    if len(todo):
+        block = distances(aln, all_chars = all_chars, threads = threads, rows = todo)
+        matrix[todo] = block
+        matrix[:, todo] = block.T
+    save_store(store, names, columns, aln, matrix, settings)
+    return(matrix, len(todo))
+
+
+def write_matrix(names, matrix, out = sys.stdout, sep = '\t', blank = False):
+    '''
+    write the distance matrix in the format of snp-dists
+    '''
+    print(sep.join(['' if blank else HEADER] + names), file = out)
+    for name, row in zip(names, matrix):
+        print(sep.join([name] + [f"{d}" for d in row]), file = out)
+
+
+def set_parsers():
+    parser = argparse.ArgumentParser(description='Pairwise SNP distances from a core alignment, output is the same as snp-dists',formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('alignment', help = 'multiple sequence alignment in fasta format or a packed alignment (core.pack)')
+    parser.add_argument('-a', '--all', action = 'store_true', help = 'count all differences, not just between A, C, G and T')
+    parser.add_argument('-k', '--keep_case', action = 'store_true', help = 'keep case, do not convert sequences to upper case')
+    parser.add_argument('-c', '--csv', action = 'store_true', help = 'write comma separated values instead of tab separated')
+    parser.add_argument('-b', '--blank', action = 'store_true', help = 'leave the top left cell blank')
+    parser.add_argument('-j', '--threads', help = 'number of processes', type = int, default = 1)
+    parser.add_argument('-t', '--tab', help = 'core.tab describing the columns of the alignment, required with --store unless the alignment is packed', default = None)
+    parser.add_argument('-s', '--store', help = 'file to save distances in, distances from a previous run are reused for unchanged isolates', default = None)
+    args = parser.parse_args()
+    return(args)
+
+
+def main():
+    args = set_parsers()
+    if alignment_pack.is_pack(args.alignment):
+        names, aln, columns = read_packed(args.alignment, keep_case = args.keep_case)
+    else:
+        names, aln = read_alignment(args.alignment, keep_case = args.keep_case)
+        columns = read_columns(args.tab) if args.tab else None
+    if args.store and columns is not None:
+        matrix, calculated = incremental_distances(names, aln, columns, args.store, all_chars = args.all, keep_case = args.keep_case, threads = args.threads)
+        print(f"Distances for {len(names) - calculated} isolates were updated from {args.store}, {calculated} were calculated in full", file = sys.stderr)
+    else:
+        matrix = distances(aln, all_chars = args.all, threads = args.threads)
+    write_matrix(names, matrix, sep = ',' if args.csv else '\t', blank = args.blank)
+
+
+if __name__ == '__main__':
+    main()
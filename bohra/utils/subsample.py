@@ -0,0 +1,107 @@
+import gzip, pathlib, argparse, itertools, os
+import numpy, pandas
+
+# number of read pairs kept in memory at a time
+BATCH_SIZE = 100000
+
+
+def open_reads(path):
+    '''
+    open a fastq file for reading in binary mode, gzipped or not
+    '''
+    with open(path, 'rb') as f:
+        magic = f.read(2)
+    if magic == b'\x1f\x8b':
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def get_fraction(yield_tab, depth):
+    '''
+    the fraction of read pairs to keep to bring the estimated depth down to the target depth
+    input:
+        :yield_tab: path to the yield.tab for the isolate
+        :depth: the target depth
+    output:
+        the fraction of pairs to keep (1.0 if the isolate is already at or below the target)
+    '''
+    df = pandas.read_csv(yield_tab, sep = '\t')
+    estimated = float(df.loc[0, 'Estimated depth'])
+    if estimated <= depth or estimated == 0:
+        return(1.0)
+    return(depth / estimated)
+
+
+def link_reads(reads, outputs):
+    '''
+    nothing to subsample, link the original reads into place
+    '''
+    for r, o in zip(reads, outputs):
+        if o.exists() or o.is_symlink():
+            o.unlink()
+        o.symlink_to(pathlib.Path(r).resolve())
+
+
+def subsample_pairs(reads, outputs, fraction, seed):
+    '''
+    stream R1 and R2 in step and keep each pair with probability fraction, so pairs stay in sync
+    the same seed and input always give the same output
+    input:
+        :reads: paths to R1 and R2
+        :outputs: paths to write the subsampled R1 and R2 to
+        :fraction: fraction of pairs to keep
+        :seed: seed for the random number generator
+    output:
+        the number of pairs read and the number kept
+    '''
+    rng = numpy.random.default_rng(seed)
+    total = kept = 0
+    tmp = [o.with_name(f".{o.name}.tmp") for o in outputs]
+    with open_reads(reads[0]) as r1, open_reads(reads[1]) as r2, \
+        gzip.open(tmp[0], 'wb', compresslevel = 4) as o1, gzip.open(tmp[1], 'wb', compresslevel = 4) as o2:
+        while True:
+            lines1 = list(itertools.islice(r1, 4 * BATCH_SIZE))
+            lines2 = list(itertools.islice(r2, 4 * BATCH_SIZE))
+            if len(lines1) != len(lines2):
+                raise ValueError(f"{reads[0]} and {reads[1]} do not have the same number of reads")
+            if not lines1:
+                break
+            pairs = len(lines1) // 4
+            keep = numpy.flatnonzero(rng.random(pairs) < fraction)
+            o1.write(b''.join(b''.join(lines1[4 * k:4 * k + 4]) for k in keep))
+            o2.write(b''.join(b''.join(lines2[4 * k:4 * k + 4]) for k in keep))
+            total += pairs
+            kept += len(keep)
+    # only move into place once complete so an interrupted run is not mistaken for a finished one
+    for t, o in zip(tmp, outputs):
+        os.replace(t, o)
+    return(total, kept)
+
+
+def main(reads, yield_tab, depth, seed, outdir):
+    outdir = pathlib.Path(outdir)
+    outdir.mkdir(parents = True, exist_ok = True)
+    outputs = [outdir / 'R1.fq.gz', outdir / 'R2.fq.gz']
+    fraction = get_fraction(yield_tab, depth)
+    if fraction >= 1.0:
+        print(f"Estimated depth is below {depth}x, reads will not be subsampled")
+        link_reads(reads, outputs)
+    else:
+        total, kept = subsample_pairs(reads, outputs, fraction, seed)
+        print(f"Kept {kept} of {total} read pairs ({fraction:.3f}) to reach {depth}x")
+
+
+def set_parsers():
+    parser = argparse.ArgumentParser(description='Subsample paired end reads to a target depth',formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('reads', help = 'path to R1 and R2', nargs = 2)
+    parser.add_argument('-y', '--yield_tab', help = 'yield.tab with the Estimated depth of the isolate', required = True)
+    parser.add_argument('-d', '--depth', help = 'target depth', type = float, required = True)
+    parser.add_argument('-s', '--seed', help = 'seed for random subsampling', type = int, default = 42)
+    parser.add_argument('-o', '--outdir', help = 'directory to write R1.fq.gz and R2.fq.gz to', required = True)
+    args = parser.parse_args()
+    return(args)
+
+
+if __name__ == '__main__':
+    args = set_parsers()
+    main(args.reads, args.yield_tab, args.depth, args.seed, args.outdir)
@@ -0,0 +1,151 @@
+import pathlib, shutil, subprocess, re, json, concurrent.futures, argparse
+
+VERSION_PAT = re.compile(r'\bv?(?P<major>[0-9]+)\.(?P<minor>[0-9]+)\.(?P<release>[0-9]+)(?:\.(?P<build>[0-9]+))?\b')
+# tools that print their version to stderr rather than stdout
+STDERR_TOOLS = ['snippy', 'prokka']
+# command line name of each assembler
+ASSEMBLERS = {'shovill': 'shovill', 'skesa':'skesa','spades':'spades.py'}
+# seconds to wait for a tool to report its version
+TIMEOUT = 60
+
+
+def pipeline_tools(pipeline, assembler):
+    '''
+    the tools used by a pipeline, in the order they are listed in the report
+    input:
+        :pipeline: the type of pipeline (s, a, sa or all)
+        :assembler: the assembler used in the pipeline
+    output:
+        a list of command line names
+    '''
+    snippy_tools = ['snippy', 'snippy-core', 'iqtree']
+    assembly_tools = ['mlst', 'kraken2', 'prokka', 'abricate', ASSEMBLERS.get(assembler, assembler)]
+    if pipeline == 's':
+        return(snippy_tools)
+    elif pipeline == 'a':
+        return(assembly_tools)
+    elif pipeline == 'sa':
+        return(snippy_tools + assembly_tools)
+    elif pipeline == 'all':
+        return(snippy_tools + assembly_tools + ['roary'])
+    return([])
+
+
+def tool_key(executable):
+    '''
+    key used to cache the version of a tool - if the executable is replaced or updated the key changes
+    input:
+        :executable: path to the executable, as found on the PATH
+    output:
+        a string of the resolved path and modification time
+    '''
+    p = pathlib.Path(executable).resolve()
+    return(f"{p}:{p.stat().st_mtime_ns}")
+
+
+def probe_tool(tool):
+    '''
+    find a tool on the PATH and run it with --version
+    input:
+        :tool: the command line name of the tool
+    output:
+        a dictionary of the tool, the resolved path, the cache key, the version (empty if it could not be found) and if it was found
+    '''
+    result = {'tool': tool, 'path': '', 'key': '', 'version': '', 'found': False}
+    executable = shutil.which(tool)
+    if not executable:
+        return(result)
+    result.update({'path': f"{pathlib.Path(executable).resolve()}", 'key': tool_key(executable), 'found': True})
+    try:
+        sft = subprocess.run([executable, '--version'], stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout = TIMEOUT)
+    except (OSError, subprocess.TimeoutExpired):
+        return(result)
+    streams = [sft.stderr, sft.stdout] if tool in STDERR_TOOLS else [sft.stdout, sft.stderr]
+    for stream in streams:
+        v = VERSION_PAT.search(stream.decode(errors = 'replace'))
+        if v:
+            result['version'] = v.group()
+            break
+    return(result)
+
+
+def load_cache(cache_path):
+    '''
+    load the versions found by previous runs
+    '''
+    if cache_path and pathlib.Path(cache_path).exists():
+        try:
+            return(json.loads(pathlib.Path(cache_path).read_text()))
+        except json.decoder.JSONDecodeError:
+            return({})
+    return({})
+
+
+def build_manifest(tools, cache_path = None, workers = None):
+    '''
+    the version of each tool, tools are run at the same time in a thread pool and tools that have not changed
+    since they were last run are read from the cache
+    input:
+        :tools: a list of command line names
+        :cache_path: path to the json file where versions are kept, None to not cache
+        :workers: number of tools to run at a time, None for all of them
+    output:
+        a dictionary of the result of probe_tool for each tool
+    '''
+    cache = load_cache(cache_path)
+    manifest = {}
+    to_probe = []
+    for tool in dict.fromkeys(tools):
+        executable = shutil.which(tool)
+        key = tool_key(executable) if executable else ''
+        if key in cache and cache[key]['tool'] == tool:
+            manifest[tool] = cache[key]
+        else:
+            to_probe.append(tool)
+    if to_probe:
+        with concurrent.futures.ThreadPoolExecutor(max_workers = workers or len(to_probe)) as pool:
+            for tool, result in zip(to_probe, pool.map(probe_tool, to_probe)):
+                manifest[tool] = result
+                # only keep tools with a version, a missing tool should be looked for again
+                if result['version']:
+                    cache[result['key']] = result
+        if cache_path:
+            pathlib.Path(cache_path).write_text(json.dumps(cache, indent = 1))
+    return({tool: manifest[tool] for tool in tools})
+
+
+def container_manifest(tools, container_path, label):
+    '''
+    the manifest of a pipeline run in singularity containers - the tools run inside the containers so their versions
+    can not be found on this machine, the containers and when they were used are recorded instead
+    input:
+        :tools: a list of command line names
+        :container_path: where the containers are pulled from
+        :label: recorded as the version of each tool, singularity_<day> as in source.log
+    output:
+        a dictionary for each tool in the same form as probe_tool, with container set
+    '''
+    return({tool: {'tool': tool, 'path': f"{container_path}", 'key': '', 'version': label, 'found': True, 'container': True} for tool in tools})
+
+
+def write_manifest(manifest, path):
+    pathlib.Path(path).write_text(json.dumps(manifest, indent = 1))
+
+
+def read_manifest(path):
+    return(json.loads(pathlib.Path(path).read_text()))
+
+
+def set_parsers():
+    parser = argparse.ArgumentParser(description='Record the versions of the tools used by a bohra pipeline',formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('pipeline', help = 'the type of pipeline', choices = ['s', 'a', 'sa', 'all'])
+    parser.add_argument('-a', '--assembler', help = 'the assembler used in the pipeline', default = 'shovill')
+    parser.add_argument('-c', '--cache', help = 'json file to cache versions in, keyed on the path and modification time of each tool', default = None)
+    parser.add_argument('-o', '--output', help = 'file to write the manifest to', default = 'tool_manifest.json')
+    args = parser.parse_args()
+    return(args)
+
+
+if __name__ == '__main__':
+    args = set_parsers()
+    write_manifest(build_manifest(pipeline_tools(args.pipeline, args.assembler), cache_path = args.cache), args.output)
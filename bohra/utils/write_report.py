@@ -1,17 +1,88 @@
 
-import svgwrite, re, sys, subprocess
+import svgwrite, re, sys, subprocess, base64, hashlib, json, shutil, concurrent.futures
 from svgwrite import cm, mm
 from Bio import Phylo
 import jinja2, pathlib, pandas, numpy, re
 from packaging import version
 import datetime
+try:
+    from bohra.utils import alignment_pack, tool_manifest
+except ImportError:
+    import alignment_pack, tool_manifest
 # from bokeh.io import export_png
 # import PyQt5
 # from ete3 import Tree, TreeStyle, NodeStyle, TextFace
 
+# class of the rows of each table, the first match to the name of the table is used
+ROW_CLASSES = [('summary_table.tab', "{} tiplab"), ('distances.tab', "distances-{}"), ('assembly.tab', "{}-assembly"),
+               ('species', "{}-species-identification"), ('core_genome.tab', "{}-core-genome"), ('mlst.tab', "{}-mlst"),
+               ('resistome.tab', "{}-resistome"), ('seqdata.tab', "{}-sequence-data")]
+
+
+def row_class(table):
+    '''
+    the format of the class of the rows of a table, from the isolate in the first column, None if the rows have no class
+    '''
+    for name, fmt in ROW_CLASSES:
+        if name in table:
+            return(fmt)
+    return(None)
+
+
+class TableRows:
+    '''
+    the rows of the body of a table as html, read a line at a time from the file each time it is iterated
+    '''
+    def __init__(self, path, row_class = None, columns = None):
+        self.path = path
+        self.row_class = row_class
+        self.columns = columns
+
+    def cells(self):
+        '''
+        the cells of each row
+        '''
+        with open(self.path) as f:
+            f.readline()
+            for line in f:
+                yield(line.rstrip('\n').split('\t'))
+
+    def __iter__(self):
+        for raw in self.cells():
+            tr = f"<tr class='{self.row_class.format(raw[0])}'>" if self.row_class else "<tr>"
+            yield(tr + ''.join([f"<td align=\"center\">{d}</td>" for d in raw]) + "</tr>\n")
+
+    def __str__(self):
+        return(''.join(self))
+
+
+# number of windows the genome is split into for the snp density plot
+DENSITY_BINS = 1000
+# largest number of bins in the histogram of snp distances
+DISTANCE_BINS = 100
+# the tables in the summary, in the order of their columns - the first table whose name contains the key is read,
+# with the arguments to read only the isolate and the columns kept, and the names to give the columns
+SUMMARY_SOURCES = [('species', {'usecols': ['Isolate', '#1 Match']}, {'#1 Match': 'Species'}),
+                   ('seqdata', {'usecols': ['Isolate', 'Estimated depth']}, {}),
+                   ('assembly', {'usecols': ['Isolate', '# Contigs']}, {}),
+                   ('mlst', {'usecols': [0, 2], 'skiprows': 1, 'header': None}, {0: 'Isolate', 2: 'ST'}),
+                   ('core_genome', {'usecols': ['Isolate', '% USED']}, {}),
+                   ('clusters', {'usecols': ['Isolate', 'Cluster code']}, {})]
+# the table with a row for every isolate in the job, the summary has its isolates and no others (core_genome.tab also
+# has the Reference)
+SUMMARY_ANCHOR = 'seqdata'
+# directory in the report for the scripts with the data of each section
+SECTION_DIR = 'sections'
+# digest of this script, fragments rendered by an older version are not used
+RENDERER = hashlib.md5(pathlib.Path(__file__).read_bytes()).digest()
+# trees with more tips than this have clades closer to their tips than TREE_COLLAPSE of the height of the tree drawn as one row
+TREE_MAX_TIPS = 2000
+TREE_COLLAPSE = 0.005
+
+
 class Tree:
     '''
-    This script will draw a tree from a newick using a recursive approach to extract positions of nodes (adapted for my needs from https://github.com/plotly/dash-phylogeny/blob/dev/app.py) and placement with svgwrite.
+    This script will draw a tree from a newick, the positions of nodes are found with iterative traversals into numpy arrays (adapted for my needs from https://github.com/plotly/dash-phylogeny/blob/dev/app.py) so deep trees do not hit the recursion limit, and the svg is streamed to a file.
     '''
     def read_treefile(self,filename):
         '''
@@ -20,135 +91,181 @@ class Tree:
         tree = Phylo.read(filename, "newick")
         return tree 
 
-    def get_x_coordinates(self,tree):
-        """Associates to  each clade an x-coord.
-        returns dict {clade: x-coord}
-        """
-        xcoords = tree.depths()
-        # tree.depth() maps tree clades to depths (by branch length).
-        # returns a dict {clade: depth} where clade runs over all Clade instances of the tree, and depth
-        # is the distance from root to clade
-
-        #  If there are no branch lengths, assign unit branch lengths
-        if not max(xcoords.values()):
-            xcoords = tree.depths(unit_branch_lengths=True)
-        return xcoords
-
-    def get_y_coordinates(self,tree, dist=.8):
-        """
-        returns  dict {clade: y-coord}
-        The y-coordinates are  (float) multiple of integers (i*dist below)
-        dist depends on the number of tree leafs
-        """
-        maxheight = tree.count_terminals()  # Counts the number of tree leafs.
-        # Rows are defined by the tips/leafs
-        ycoords = dict((leaf, maxheight - i * dist) for i, leaf in enumerate(reversed(tree.get_terminals())))
-        
-        def calc_row(clade):
-            for subclade in clade:
-                if subclade not in ycoords:
-                    calc_row(subclade)
-            ycoords[clade] = (ycoords[clade.clades[0]] +
-                            ycoords[clade.clades[-1]]) / 2
-
-        if tree.root.clades:
-            calc_row(tree.root)
-        return ycoords
-
-    def get_clade_lines(self,orientation='horizontal',y_curr=0, x_start=0, x_curr=0, y_bot=0, y_top=0):
-        """define a shape of type 'line', for branch
-        """
-        branch_line = dict()
-        if orientation == 'horizontal':
-            branch_line.update(x0=x_start,
-                            y0=y_curr,
-                            x1=x_curr,
-                            y1=y_curr)
-        elif orientation == 'vertical':
-            branch_line.update(x0=x_curr,
-                            y0=y_bot,
-                            x1=x_curr,
-                            y1=y_top,
-                            type = 'vertical')
-        else:
-            raise ValueError("Line type can be 'horizontal' or 'vertical'")
+    def layout(self, tree, dist = .8, collapse = 0, max_tips = 0):
+        '''
+        the position of every clade, from a preorder traversal for the x coordinates (depth by branch length, or unit branch
+        lengths if there are none) and a postorder pass for the y coordinates (tips in rows, a clade halfway between its
+        first and last child)
+        input:
+            :tree: Bio.Phylo tree
+            :dist: the distance between rows
+            :collapse: clades less than this fraction of the height of the tree from their tips are drawn as a single row, 0 to draw every tip
+            :max_tips: only collapse clades if the tree has more tips than this
+        output:
+            a dictionary of the clades in preorder and numpy arrays of the index of the parent (-1 for the root), first and last child
+            (-1 for tips and collapsed clades), x and y of each clade, the number of tips it holds and the number of clades below it
+            (so the clades below i are i + 1 to i + size - 1 in preorder)
+        '''
+        clades = []
+        parent = []
+        stack = [(tree.root, -1)]
+        while stack:
+            clade, p = stack.pop()
+            parent.append(p)
+            clades.append(clade)
+            i = len(clades) - 1
+            # children are pushed in reverse so they come off the stack in order
+            stack.extend([(child, i) for child in reversed(clade.clades)])
+        parent = numpy.array(parent, dtype = numpy.int64)
+        n = len(clades)
+        lengths = numpy.array([c.branch_length or 0 for c in clades], dtype = numpy.float64)
+        if not lengths.any():
+            lengths[1:] = 1
+        x = numpy.zeros(n)
+        x[0] = lengths[0]
+        for i in range(1, n):
+            x[i] = x[parent[i]] + lengths[i]
+        first = numpy.full(n, -1, dtype = numpy.int64)
+        last = numpy.full(n, -1, dtype = numpy.int64)
+        tips = numpy.zeros(n, dtype = numpy.int64)
+        size = numpy.ones(n, dtype = numpy.int64)
+        height = numpy.zeros(n)
+        for i in range(n - 1, 0, -1):
+            p = parent[i]
+            first[p] = i
+            if last[p] < 0:
+                last[p] = i
+            tips[i] = max(tips[i], 1)
+            tips[p] += tips[i]
+            size[p] += size[i]
+            height[p] = max(height[p], height[i] + lengths[i])
+        tips[0] = max(tips[0], 1)
+        if tips[0] <= max_tips:
+            collapse = 0
+        # a collapsed clade is drawn as a tip, so its children are not drawn
+        collapsed = (first >= 0) & (height < collapse * height[0])
+        collapsed[0] = False
+        hidden = numpy.zeros(n, dtype = bool)
+        for i in range(1, n):
+            hidden[i] = hidden[parent[i]] or collapsed[parent[i]]
+        first[collapsed] = -1
+        last[collapsed] = -1
+        rows = (first < 0) & ~hidden
+        y = numpy.zeros(n)
+        y[rows] = rows.sum() - (rows.sum() - 1 - numpy.arange(rows.sum())) * dist
+        for i in range(n - 1, -1, -1):
+            if first[i] >= 0:
+                y[i] = (y[first[i]] + y[last[i]]) / 2
+        return({'clades': clades, 'parent': parent, 'first': first, 'last': last, 'x': x, 'y': y, 'tips': tips, 'size': size, 'hidden': hidden})
+
+    def svg_lines(self, positions):
+        '''
+        the lines of the svg, a branch (and the label of a tip or support of a clade) then the line joining its children,
+        for each clade in preorder
+        '''
+        x = positions['x']
+        y = positions['y']
+        drawn = numpy.flatnonzero(~positions['hidden'])
+        maxlength = x[drawn].max()
+        minheight = min(float((positions['first'][drawn] < 0).sum()), y[drawn].min())
+        maxheight = max(0.0, y[drawn].max())
+        f = 10/maxlength if maxlength else 10 # factor to multiply the
+        # viewbox is calculated based on 1cm = 37.8 pixels
+        yield(f"<svg baseProfile=\"full\" version=\"1.1\" viewBox=\"-37.8,{(minheight*37.8)-37.8},1000,{(maxheight*37.8)+37.8}\" ><defs />\"")
+        for i in drawn:
+            clade = positions['clades'][i]
+            x0 = x[positions['parent'][i]] if i else 0
+            yield(f"<line x1=\"{(x0*f)*cm}\" x2=\"{(x[i]*f)*cm}\" y1=\"{y[i]*cm}\" y2=\"{y[i]*cm}\" stroke=\"black\"/>")
+            if not clade.clades:
+                yield(f"<text class = \"tiplab {clade.name}\" x=\"{((x[i]*f) + 0.1)*cm}\" y=\"{y[i]*cm}\">{clade.name}</text>")
+                yield(f"<circle cx=\"{(x[i]*f)*cm}\" cy=\"{y[i]*cm}\" r=\"0.05cm\" />")
+            elif positions['first'][i] < 0:
+                below = positions['clades'][i + 1:i + positions['size'][i]]
+                names = ', '.join([c.name for c in below if not c.clades])
+                yield(f"<text class = \"collapsed-clade\" x=\"{((x[i]*f) + 0.1)*cm}\" y=\"{y[i]*cm}\"><title>{names}</title>{positions['tips'][i]} isolates</text>")
+            elif clade.name is not None:
+                yield(f"<text class = \"branch-support\" x=\"{((x[i]*f) + 0.1)*cm}\" y=\"{y[i]*cm}\" style=\"font-size:smaller; color:#3973ac; display:none;\">{clade.name}</text>")
+            if positions['first'][i] >= 0:
+                yield(f"<line x1=\"{(x[i]*f)*cm}\" x2=\"{(x[i]*f)*cm}\" y1=\"{y[positions['last'][i]]*cm}\" y2=\"{y[positions['first'][i]]*cm}\" stroke = \"black\"/>")
+
+    def main(self,treepath, outpath, collapse = 0, max_tips = 0):
+        '''
+        draw the tree as an svg, written to outpath a line at a time
+        input:
+            :treepath: the tree in newick format
+            :outpath: file to write the svg to
+            :collapse: clades less than this fraction of the height of the tree from their tips are drawn as a single row
+            :max_tips: only collapse clades if the tree has more tips than this
+        output:
+            the svg, read from outpath as the report is written
+        '''
+        tree = self.read_treefile(treepath)
+        with open(outpath, 'w') as f:
+            for line in self.svg_lines(self.layout(tree, collapse = collapse, max_tips = max_tips)):
+                f.write(f"{line}\n")
+        return(FileLines(outpath))
 
-        return branch_line
 
+class FileLines:
+    '''
+    a text file (an svg or the rows of a table), read a line at a time each time it is iterated
+    '''
+    def __init__(self, path):
+        self.path = path
 
-    def draw_clade(self,clade, x_start, line_shapes, line_width=1, x_coords=0, y_coords=0):
-        """Recursively draw the tree branches, down from the given clade"""
+    def __iter__(self):
+        with open(self.path) as f:
+            yield from f
 
-        x_curr = x_coords[clade]
-        y_curr = y_coords[clade]
+    def __str__(self):
+        return(pathlib.Path(self.path).read_text())
 
-        # Draw a horizontal line from start to here
-        branch_line = self.get_clade_lines(orientation='horizontal', y_curr=y_curr, x_start=x_start, x_curr=x_curr)
-        # add in name of node
-        branch_line['nodename'] = clade.name
-        branch_line['type'] = 'horizontal'
-        line_shapes.append(branch_line)
-        if clade.clades:
-            # Draw a vertical line connecting all children
-            y_top = y_coords[clade.clades[0]]
-            y_bot = y_coords[clade.clades[-1]]
-            line_shapes.append(self.get_clade_lines(orientation='vertical', x_curr=x_curr, y_bot=y_bot, y_top=y_top))
 
-    # Draw descendant
-            for child in clade:
-                self.draw_clade(child, x_curr, line_shapes, x_coords=x_coords, y_coords=y_coords)
-        
-        return(line_shapes)
+class FragmentCache:
+    '''
+    rendered sections of the report, each kept in a directory named by a digest of the content of the files the section is
+    made from, so a section is only rendered again when its input files change
+    '''
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+        self.path.mkdir(parents = True, exist_ok = True)
 
-    def main(self,treepath, outpath):
+    def key(self, inputs):
         '''
-        Use svgwrite to generate a tree
+        digest of the content of the input files, a missing file is included as missing
         '''
-        # get the tree using bio phylo
-        tree = self.read_treefile(treepath)
-        # get the x and y co-ordinates for nodes
-        xs = self.get_x_coordinates(tree)
-        ys = self.get_y_coordinates(tree)
-        terms = [t.name for t in tree.get_terminals()]
-        line_shapes = [] # empty list to begin 
-        # line shapes is a list of dictionaries for each node and branch
-        tree_coords = self.draw_clade(tree.root, 0, line_shapes, x_coords=xs,y_coords=ys)
-    
-        # find the maximum x position for generation of a figure which will scale
-        maxlength = 0
-        minheight = len(terms)
-        maxheight = 0
-        for t in tree_coords:
-            if t['type'] == 'horizontal':
-                if t['x1'] > float(maxlength):
-                    maxlength = t['x1']
-                if t['y1'] < float(minheight):
-                    minheight = t['y1']
-                if t['y1'] > float(maxheight):
-                    maxheight = t['y1']
-        f = 10/maxlength # factor to multiply the
-        # a drawing object
-        # viewbox is calculated based on 1cm = 37.8 pixels
-        svg_text = [f"<svg baseProfile=\"full\" version=\"1.1\" viewBox=\"-37.8,{(minheight*37.8)-37.8},1000,{(maxheight*37.8)+37.8}\" ><defs />\""]
-        
-        for t in tree_coords:
-            if t['type'] == 'horizontal':
-                # branches.add(dwg.line(start=((t['x0']*f)*cm, t['y0']*cm), end=((t['x1']*f)*cm, t['y1']*cm)))
-                svg_text.append(f"<line x1=\"{(t['x0']*f)*cm}\" x2=\"{(t['x1']*f)*cm}\" y1=\"{t['y0']*cm}\" y2=\"{t['y1']*cm}\" stroke=\"black\"/>")
-                if t['nodename'] in terms:
-                    svg_text.append(f"<text class = \"tiplab {t['nodename']}\" x=\"{((t['x1']*f) + 0.1)*cm}\" y=\"{t['y1']*cm}\">{t['nodename']}</text>")
-                    # labels.add(dwg.text(t['nodename'], ((((t['x1']*f) + 0.1)*cm, (t['y1']*cm))),style = 'font-family: -apple-system, BlinkMacSystemFont, "Segoe UI", Roboto, "Helvetica Neue", Arial, sans-serif, "Apple Color Emoji", "Segoe UI Emoji", "Segoe UI Symbol", "Noto Color Emoji"'))
-                    # circleA = dwg.circle(center=((t['x1']*f)*cm, t['y1']*cm), r='0.05cm')
-                    svg_text.append(f"<circle cx=\"{(t['x1']*f)*cm}\" cy=\"{t['y1']*cm}\" r=\"0.05cm\" />")
-                    # tips.add(circleA)
-                elif (t['nodename'] not in terms) and (t['nodename'] != 'None'):
-                    svg_text.append(f"<text class = \"branch-support\" x=\"{((t['x1']*f) + 0.1)*cm}\" y=\"{t['y1']*cm}\" style=\"font-size:smaller; color:#3973ac; display:none;\">{t['nodename']}</text>")
-            elif t['type'] == 'vertical':
-                # vlines.add(dwg.line(start = ((t['x0']*f)*cm, t['y0']*cm), end = ((t['x1']*f)*cm, t['y1']*cm)))
-                svg_text.append(f"<line x1=\"{(t['x0']*f)*cm}\" x2=\"{(t['x1']*f)*cm}\" y1=\"{t['y0']*cm}\" y2=\"{t['y1']*cm}\" stroke = \"black\"/>")
-        # dwg.save()
-        # svg_text.append('</svg')
-        return('\n'.join(svg_text))
+        digest = hashlib.md5(RENDERER)
+        for i in inputs:
+            p = pathlib.Path(i)
+            digest.update(f"{p.name}\0".encode())
+            if p.exists():
+                with open(p, 'rb') as f:
+                    for chunk in iter(lambda: f.read(1 << 24), b''):
+                        digest.update(chunk)
+            digest.update(b'\0')
+        return(digest.hexdigest())
+
+    def fetch(self, name, inputs, render):
+        '''
+        the directory of a section, rendered if there is none for the current content of the inputs
+        input:
+            :name: name of the section
+            :inputs: paths of the files the section is made from
+            :render: function that writes the section into the directory it is given
+        output:
+            pathlib.Path of the directory
+        '''
+        fragment = self.path / f"{name}.{self.key(inputs)}"
+        if fragment.exists():
+            return(fragment)
+        # a section only has the fragment for its latest inputs
+        for old in self.path.glob(f"{name}.*"):
+            shutil.rmtree(old)
+        tmp = self.path / f"{name}.tmp"
+        tmp.mkdir()
+        render(tmp)
+        tmp.rename(fragment)
+        return(fragment)
 
 
 
@@ -158,17 +275,16 @@ class Report:
     '''
     def write_tables(self,reportdir, table):
         '''
-        Write a table, given a tab delimited file generate a html string
+        Write a table, given a tab delimited file generate a html string for the head and the rows of the body,
+        the rows are read from the file as the report is written rather than held in memory
         '''
-        # TODO add class isolate id to <tr>
-        # TODO add class distances-isolate to tr if matrix and head-isolate to head td
         path = reportdir / f"{table}"
-        data = open(path).readlines()
-        # for header
-        header = data[0].split('\t')
+        with open(path) as f:
+            header = f.readline().rstrip('\n').split('\t')
+            first = f.readline()
         if 'mlst' in f"{table}":
             # number of alleles
-            length = len(data[1].split('\t'))-2
+            length = len(first.split('\t'))-2
             header = ['Isolate', 'Scheme', 'ST']
             for l in range(1,length):
                 header.append(f"Allele_{l}")
@@ -176,35 +292,101 @@ class Report:
             tablehead = [f"<th class='{column}-head'>{column}</th>" for column in header]
         else:
             tablehead = [f"<th>{column}</th>" for column in header]
-        # for body seqtablebody
-        body = []
-        for i in range(1,len(data)):
-            raw = data[i].split('\t')
-            if 'summary_table.tab' in table:
-                row = [f"<tr class='{raw[0]} tiplab'>"]
-            elif 'distances.tab' in table:
-                row = [f"<tr class='distances-{raw[0]}'>"]
-            elif 'assembly.tab' in table:
-                row = [f"<tr class='{raw[0]}-assembly'>"]
-            elif 'species' in table:
-                row = [f"<tr class='{raw[0]}-species-identification'>"]
-            elif 'core_genome.tab' in table:
-                row = [f"<tr class='{raw[0]}-core-genome'>"]
-            elif 'mlst.tab' in table:
-                row = [f"<tr class='{raw[0]}-mlst'>"]
-            elif 'resistome.tab' in table:
-                row = [f"<tr class='{raw[0]}-resistome'>"]
-            elif 'seqdata.tab' in table:
-                row = [f"<tr class='{raw[0]}-sequence-data'>"]
-            else:
-                row = [f"<tr>"] # TODO add class isolate id to <tr>
-            for d in raw:
-                row.append(f"<td align=\"center\">{d}</td>")
-            row.append(f"</tr>")
-            body = body + row
-        return('\n'.join(tablehead),'\n'.join(body))
+        return('\n'.join(tablehead), TableRows(path, row_class(table), columns = header))
 
-    
+    def write_section(self, path, link, data, rows = None):
+        '''
+        write the data for a section of the report as a script that is loaded when the section is opened, a script rather
+        than a json file so the report can still be opened from the file system
+        input:
+            :path: the file to write to
+            :link: the link of the section
+            :data: json serialisable dictionary of the data
+            :rows: the rows of a table (lists of cells), written one at a time
+        '''
+        with open(path, 'w') as f:
+            f.write(f"bohraSection({json.dumps(link)}, {json.dumps(data)}")
+            if rows is not None:
+                f.write(", [")
+                for k, row in enumerate(rows):
+                    f.write(f"{',' if k else ''}\n{json.dumps(row)}")
+                f.write("]")
+            f.write(");\n")
+
+    def copy_section(self, fragment, reportdir, link):
+        '''
+        copy the script of a section from its fragment to the sections directory of the report
+        '''
+        sections = reportdir / SECTION_DIR
+        sections.mkdir(exist_ok = True)
+        shutil.copy(fragment / 'section.js', sections / f"{link}.js")
+
+    def write_fragment(self, fragment, reportdir, table, link, data = None):
+        '''
+        render the head of a table and the script with its rows into a fragment directory
+        '''
+        head, body = self.write_tables(reportdir = reportdir, table = table)
+        (fragment / 'head.html').write_text(head)
+        data = dict(data or {}, columns = body.columns, row_class = body.row_class)
+        self.write_section(fragment / 'section.js', link, data, rows = body.cells())
+
+    def cached_table(self, cache, reportdir, table, link, image = None):
+        '''
+        the head of a table, the table is only rendered if it has changed since the report was last written
+        input:
+            :cache: FragmentCache
+            :reportdir: the directory where report files are stored
+            :table: the name of the table
+            :link: the link of the section the table is in
+            :image: path to an svg shown with the table, None for no image
+        output:
+            the head, the rows are in the script of the section
+        '''
+        inputs = [reportdir / table] + ([image] if image else [])
+        data = lambda: {'image': pathlib.Path(image).read_text()} if image else {}
+        fragment = cache.fetch(f"table-{link}", inputs, lambda f: self.write_fragment(f, reportdir, table, link, data()))
+        self.copy_section(fragment, reportdir, link)
+        return((fragment / 'head.html').read_text())
+
+    def cached_summary(self, cache, reportdir, link = 'summary'):
+        '''
+        the head of the summary table, only generated if one of the tables it is made from (found by summary_sources) has
+        changed, summary_table.tab is copied to the report directory from the fragment
+        '''
+        inputs = [tab for key, (tab, kwargs, columns) in self.summary_sources(reportdir)]
+        def render(fragment):
+            self.generate_summary(reportdir = reportdir)
+            shutil.copy(reportdir / 'summary_table.tab', fragment)
+            self.write_fragment(fragment, reportdir, 'summary_table.tab', link)
+        fragment = cache.fetch(link, inputs, render)
+        shutil.copy(fragment / 'summary_table.tab', reportdir)
+        self.copy_section(fragment, reportdir, link)
+        return((fragment / 'head.html').read_text())
+
+    def cached_section(self, cache, reportdir, link, inputs, plot):
+        '''
+        the script of a section with the data for a plot, only calculated if its inputs have changed
+        input:
+            :cache: FragmentCache
+            :reportdir: the directory where report files are stored
+            :link: the link of the section
+            :inputs: paths of the files the data comes from
+            :plot: function returning the data, which must be json serialisable
+        '''
+        fragment = cache.fetch(link, inputs, lambda f: self.write_section(f / 'section.js', link, plot()))
+        self.copy_section(fragment, reportdir, link)
+
+    def cached_tree(self, cache, reportdir, link):
+        '''
+        the script of the section with the tree image, only drawn if the tree has changed, core_tree.svg is copied to the report
+        directory from the fragment
+        '''
+        def render(fragment):
+            svg = self.get_tree_image(reportdir = reportdir, out = fragment / 'core_tree.svg')
+            self.write_section(fragment / 'section.js', link, {'image': f"{svg}"})
+        fragment = cache.fetch(link, [reportdir / 'core.treefile'], render)
+        shutil.copy(fragment / 'core_tree.svg', reportdir)
+        self.copy_section(fragment, reportdir, link)
 
     def get_table_data(self,reportdir, td):
         '''
@@ -252,101 +434,113 @@ class Report:
         # show(p)
         return(script,div)
 
+    def bin_snps(self, positions, counts, offsets, total, bins = None):
+        '''
+        count snps in fixed windows across the genome
+        input:
+            :positions: numpy array of the genome position (1 based, contigs end to end) of each site
+            :counts: numpy array of the number of isolates with a snp at each site
+            :offsets: start of each contig in the genome
+            :total: length of the genome
+            :bins: number of windows, DENSITY_BINS if not given
+        output:
+            dictionary of the window size and count of each window in kb and the position of contig breaks in kb
+        '''
+        window = max(1, -(-int(total) // (bins or DENSITY_BINS)))
+        binned = numpy.bincount((numpy.asarray(positions, dtype = numpy.int64) - 1) // window, weights = counts, minlength = -(-int(total) // window))
+        return({'window': window / 1000, 'counts': binned.astype(int).tolist(), 'breaks': [int(o) / 1000 for o in list(offsets)[1:]]})
+
     def plot_snpdensity(self,reportdir, workdir):
 
         '''
-        generate a snp-density accross the genome plot - using the core.tab file
+        generate a snp-density accross the genome plot - using core.pack if it is there, otherwise the core.tab file
         input:
             :reportdir: the directory where files are kept
+            :workdir: the job directory, where ref.fa.fai and core.pack are
         out:
-            :snpdensityscript: the javascript string for insert into html
-            :snpdenstiydiv: the html div for inster in html doc
+            dictionary of snp counts in windows across the genome and contig breaks, from bin_snps
         '''
-        # helper functions for getting the data into the right format.
-        def adjust_offset(row, d):
-            if row['CHR'] in d:
-                return(int(d[row['CHR']]) + int(row['POS']))
-            else:
-                return(int(row['POS']))
-
-        def generate_dict(idx_file):
-            d = {}
-            pos = 0
-            offset = 0
-            with open(f"{idx_file}") as f:
-                for line in f:
-                    l = line.split()
-                    d[l[0]] = offset
-                    offset = offset + int(l[1])
-            return(d)
-        
-        # open fai file and generate the dictionary
-        idx = pathlib.Path(workdir ,'ref.fa.fai')
-        d = generate_dict(idx)
-        # get the core file
-        core = reportdir / 'core.tab'
-        df = pandas.read_csv(core, sep = '\t')
-        # get a list of isolate names
-        names = list(df.columns[3:len(df.columns)])
-        # if the there is no snp in the isolate (ie same as ref then mak na - then easy to drop)
-        for i in names:
-                df[i]=numpy.where(df['REF'] == df[i], numpy.nan, df[i])
-        # generate the offset value
-        df['POS_OFFSET'] = df[['CHR', 'POS']].apply(lambda x:adjust_offset(x,d), axis = 1)
-        # collect positions to get allow for histogram and dropna (no snp)
-        melted_df = pandas.melt(df, id_vars=['POS_OFFSET'], value_vars=names)
-        melted_df = melted_df.dropna()
-        melted_df = melted_df.sort_values(by= ['POS_OFFSET'])
-        # generate histogram
-        # snpdensityscript, snpdensitydiv = self.plot_histogram(series=melted_df['POS']/1000,xlabel="Genome Position (MB)", ylabel="SNPS",bins=10000)
-        contig_breaks = [d[value] for value in d]
-        
-        # return dictionary
-        return(list(melted_df['POS_OFFSET']/1000))
+        # the packed alignment has the genome position of each site, so only the codes need comparing
+        packed = pathlib.Path(workdir, 'core.pack')
+        if packed.exists():
+            pack = alignment_pack.read_pack(packed)
+            aln = alignment_pack.upper_case(alignment_pack.unpack(pack))
+            ref = pack['isolates'].index('Reference') if 'Reference' in pack['isolates'] else 0
+            counts = (aln[numpy.arange(len(aln)) != ref] != aln[ref]).sum(axis = 0)
+            return(self.bin_snps(alignment_pack.positions(pack) + 1, counts, pack['contig_offsets'], sum(pack['contig_lengths'])))
+        # contig offsets from the fai file, looked up for each site by the category code of its contig
+        idx = pandas.read_csv(pathlib.Path(workdir ,'ref.fa.fai'), sep = '\t', header = None, usecols = [0, 1], names = ['contig', 'length'], dtype = {'contig': str})
+        offsets = numpy.concatenate([[0], numpy.cumsum(idx['length'].to_numpy())[:-1]])
+        core = pandas.read_csv(reportdir / 'core.tab', sep = '\t', dtype = {'CHR': str})
+        codes = pandas.Categorical(core['CHR'], categories = idx['contig']).codes
+        # sites on a contig not in the fai keep their position, as before
+        positions = numpy.where(codes >= 0, offsets[codes], 0) + core['POS'].to_numpy()
+        # every isolate is compared with REF at once
+        calls = core.iloc[:, 3:].to_numpy(dtype = object)
+        counts = ((calls != core['REF'].to_numpy(dtype = object)[:, None]) & pandas.notna(calls)).sum(axis = 1)
+        return(self.bin_snps(positions, counts, offsets, idx['length'].sum()))
 
     def plot_distances(self,reportdir):
 
         '''
-        generate a snp-density plot - using the distacnes.tab file
+        pack the snp distances for the report - using the distances.tab file, which is read a row at a time
         input:
             :reportdir: the directory where files are kept
         out:
-            :distancescript: the javascript string for insert into html
-            :distancesdiv: the html div for inster in html doc
+            dictionary of
+                :names: the isolate names
+                :dtype, data: the upper triangle of the matrix (row by row, without the diagonal) as a base64 little endian
+                uint16 array (uint32 if a distance is too large), the page draws the table from it
+                :histogram: the bin size and counts of pairwise distances between isolates (not the Reference)
+                :isolates: for each isolate the nearest isolate, the distance to it and the quartiles of its distances
         '''
         distance = reportdir / 'distances.tab'
-
-        df = pandas.read_csv(distance, sep = '\t')
-        # get a list of isolate names
-        names = list(df.columns[1:len(df.columns)])
-        col1 = df.columns[0]
-        
-        # if the there is no snp in the isolate (ie same as ref then mak na - then easy to drop)
-        
-        # collect positions to get allow for histogram and dropna (no snp)
-        melted_df = pandas.melt(df, id_vars=[col1], value_vars=names)
-        melted_df = melted_df[melted_df[col1]!= melted_df['variable']]
-        # generate histogram
-        # distancescript, distancediv = self.plot_histogram(series=melted_df['value'], xlabel="SNP distances", ylabel="Frequency", bins=100)
-        # td['pairwisedistance'] = {'script':distancecript, 'div':distancediv}
-        # return dictionary
-        return(list(melted_df['value']))
-
-
-    def get_tree_image(self,reportdir):
+        with open(distance) as f:
+            names = f.readline().rstrip('\n').split('\t')[1:]
+            n = len(names)
+            isolates = numpy.array([name != 'Reference' for name in names], dtype = bool)
+            upper = numpy.zeros(n * (n - 1) // 2, dtype = numpy.uint32)
+            counts = numpy.zeros(1, dtype = numpy.int64)
+            summary = []
+            offset = 0
+            for i, line in enumerate(f):
+                row = numpy.array(line.rstrip('\n').split('\t')[1:], dtype = numpy.uint32)
+                # only the part of each row after the diagonal is kept
+                upper[offset:offset + n - i - 1] = row[i + 1:]
+                offset += n - i - 1
+                if not isolates[i]:
+                    continue
+                later = numpy.bincount(row[i + 1:][isolates[i + 1:]], minlength = len(counts))
+                counts = numpy.pad(counts, (0, len(later) - len(counts))) + later
+                others = isolates.copy()
+                others[i] = False
+                if others.any():
+                    nearest = int(numpy.argmin(numpy.where(others, row, numpy.iinfo(numpy.uint32).max)))
+                    quartiles = numpy.percentile(row[others], [25, 50, 75])
+                    summary.append([names[i], names[nearest], int(row[nearest])] + [round(float(q), 1) for q in quartiles])
+        dtype = 'uint16' if upper.size == 0 or upper.max() <= numpy.iinfo(numpy.uint16).max else 'uint32'
+        # counts of each distance are summed into at most DISTANCE_BINS bins
+        size = max(1, -(-len(counts) // DISTANCE_BINS))
+        counts = numpy.pad(counts, (0, (-len(counts)) % size)).reshape(-1, size).sum(axis = 1)
+        return({'names': names, 'dtype': dtype, 'data': base64.b64encode(upper.astype('<u2' if dtype == 'uint16' else '<u4').tobytes()).decode(),
+                'histogram': {'size': size, 'counts': counts.tolist()}, 'isolates': summary})
+
+
+    def get_tree_image(self,reportdir, out = None):
         '''
         Generate a tree image from a newick
         input:
             :reportdir: the directory where report files are stored
+            :out: the file to write the svg to, None for core_tree.svg in reportdir
         output:
-            string reporesentation of the path to the tree image
+            the svg, read back a line at a time as the report is written
         '''
         # get tree
         nwk=f"{reportdir / 'core.treefile'}"
-        out = f"{reportdir / 'core_tree.svg'}"
+        out = f"{out or reportdir / 'core_tree.svg'}"
         tree = Tree()
         
-        return(tree.main(treepath=nwk, outpath=out))
+        return(tree.main(treepath=nwk, outpath=out, collapse = TREE_COLLAPSE, max_tips = TREE_MAX_TIPS))
 
     def get_software_versions(self, software):
 
@@ -357,62 +551,42 @@ class Report:
         output:
             a string in the form of 'Name_of_Sofware v.X.Y.Z'
         '''
-
-        version_pat = re.compile(r'\bv?(?P<major>[0-9]+)\.(?P<minor>[0-9]+)\.(?P<release>[0-9]+)(?:\.(?P<build>[0-9]+))?\b')
-
-        if software == 'snp-dists':
-            v = '-v'
-        else:
-            v = '--version'
-        
-        if software in ['snippy', 'prokka']:
-            sft = subprocess.run([software, v], stderr=subprocess.PIPE)
-            sft = sft.stderr.decode().strip()
-        else:
-            sft = subprocess.run([software, v], stdout=subprocess.PIPE)
-            sft = sft.stdout.decode().strip()
-        v = version_pat.search(sft)
-        v = v.group()
-        sft_version = f"{software} v.{v}"
-        return(sft_version)
+        return(self.make_dict_versions([software])[software])
     
-    def make_dict_versions(self, tools):
+    def make_dict_versions(self, tools, manifest = None):
         '''
-        Called by get_software_file to make a dictionary of tools used
+        Called by get_software_file to make a dictionary of tools used, versions are read from the manifest
+        and any tools not in it are run (at the same time)
         input:
             :tools: a list of tools
+            :manifest: the tool manifest recorded when the job was set up, None to run every tool
         output:
             a dictionary with tools and versions.
         '''
+        manifest = dict(manifest or {})
+        missing = [t for t in tools if t not in manifest]
+        if missing:
+            manifest.update(tool_manifest.build_manifest(missing))
         tool_dict = {}
         for t in tools:
-               v = self.get_software_versions(t)
-               tool_dict[t] = v
+            if manifest[t].get('container'):
+                tool_dict[t] = f"{t} {manifest[t]['version']}"
+            else:
+                tool_dict[t] = f"{t} v.{manifest[t]['version']}" if manifest[t]['version'] else f"{t} not found"
         return(tool_dict)
 
     def get_software_file(self, reportdir, pipeline, assembler ):
         '''
-        get the versions of software on the system at completion of the piepline
+        get the versions of software used by the pipeline, from tool_manifest.json in the job directory
+        which was written when dependencies were checked, so tools are only run if it is missing
         input:
             :reportdir: the directory where report files are stored
             :pipeline: the type of pipeline
             :assembler: the assembler used in the pipeline
         '''
-        snippy_tools = ['snippy', 'snippy-core', 'snp-dists', 'iqtree']
-        assembly_tools = ['mlst', 'kraken2', 'prokka', 'abricate', assembler]
-        
-        if pipeline == 's':
-            tool_dict = self.make_dict_versions(snippy_tools)
-        elif pipeline == 'a':
-            tool_dict = self.make_dict_versions(assembly_tools)
-        elif pipeline == 'sa':
-            snippy_tools.extend(assembly_tools)
-            tool_dict = self.make_dict_versions(snippy_tools)
-        elif pipeline == 'all':
-            snippy_tools.extend(assembly_tools)
-            snippy_tools.append('roary')
-            tool_dict = self.make_dict_versions(snippy_tools)
-        
+        manifest_path = reportdir.parent / 'tool_manifest.json'
+        manifest = tool_manifest.read_manifest(manifest_path) if manifest_path.exists() else None
+        tool_dict = self.make_dict_versions(tool_manifest.pipeline_tools(pipeline, assembler), manifest = manifest)
         
         versions = ['Software versions']
         for t in tool_dict:
@@ -422,47 +596,52 @@ class Report:
 
         p.write_text('\n'.join(versions))
 
-    def merge_dfs(self,start, added):
-        if start.empty:
-            start = added
-        else:
-            start = start.merge(added)
-        return(start)
+    def read_summary_source(self, tab, kwargs, columns):
+        '''
+        read the columns of a table used in the summary, as text so values are written as they are in the table
+        input:
+            :tab: path to the table
+            :kwargs: arguments to pandas.read_csv
+            :columns: new names for the columns
+        output:
+            a dataframe indexed by isolate, the first row is kept for an isolate that is in the table more than once
+        '''
+        df = pandas.read_csv(tab, sep = '\t', dtype = str, **kwargs).rename(columns = columns)
+        df = df.drop_duplicates(subset = 'Isolate').set_index('Isolate')
+        return(df)
+
+    def summary_sources(self, reportdir):
+        '''
+        the tables in the report directory that the summary is made from
+        output:
+            a list of the key of each table in SUMMARY_SOURCES and the path, arguments and column names to read it with
+        '''
+        tabs = sorted([t for t in reportdir.iterdir() if f"{t.suffix}" == '.tab'])
+        sources = []
+        for key, kwargs, columns in SUMMARY_SOURCES:
+            found = [t for t in tabs if key in f"{t.name}"]
+            if found:
+                sources.append((key, (found[0], kwargs, columns)))
+        return(sources)
 
     def generate_summary(self, reportdir):
         '''
-        function to generate a summary table
+        function to generate a summary table, the tables are read at the same time and joined once on the isolates
+        of the job so an isolate missing from one of the tables is kept with empty values for that table, and rows
+        of other tables that are not isolates (such as the Reference) are left out
         '''
-        tabs = [t for t in reportdir.iterdir() if f"{t.suffix}" == '.tab']
+        sources = self.summary_sources(reportdir)
         summary_df = pandas.DataFrame()
-        df_list = []
-        # print(tabs)
-        for tab in tabs:
-            # print(df)
-            if 'species' in f"{tab.name}":
-                species = pandas.read_csv(tab, sep = '\t')
-                species = species[['Isolate', '#1 Match']]
-                summary_df = self.merge_dfs(summary_df, species)
-                summary_df = summary_df.rename(columns={'#1 Match': 'Species'})
-            elif 'seqdata' in f"{tab.name}":
-                seq = pandas.read_csv(tab, sep = '\t')
-                seq = seq[['Isolate', 'Estimated depth']]
-                summary_df = self.merge_dfs(summary_df, seq)
-            elif 'assembly' in f"{tab.name}":
-                assembly = pandas.read_csv(tab, sep = '\t')
-                assembly = assembly[['Isolate', '# Contigs']]
-                summary_df = self.merge_dfs(summary_df, assembly)
-            elif 'mlst' in f"{tab.name}":
-                mlst = pandas.read_csv(tab, sep = '\t', skiprows=1, header=None)
-                mlst = mlst.rename(columns = {0:'Isolate', 2:'ST'})
-                mlst = mlst[['Isolate', 'ST']]
-                summary_df = self.merge_dfs(summary_df, mlst)
-            elif 'core_genome' in f"{tab.name}":
-                core = pandas.read_csv(tab, sep = '\t')
-                core = core[['Isolate', '% USED']]
-                summary_df = self.merge_dfs(summary_df, core)
-        # print(mlst)
-        # print(summary_df)
+        if sources:
+            with concurrent.futures.ThreadPoolExecutor(max_workers = len(sources)) as pool:
+                dfs = dict(zip([key for key, source in sources], pool.map(lambda s: self.read_summary_source(*s), [source for key, source in sources])))
+            summary_df = pandas.concat(dfs.values(), axis = 1, join = 'outer')
+            if SUMMARY_ANCHOR in dfs:
+                summary_df = summary_df.reindex(dfs[SUMMARY_ANCHOR].index)
+            else:
+                summary_df = summary_df.drop(index = 'Reference', errors = 'ignore')
+            summary_df.index.name = 'Isolate'
+            summary_df = summary_df.reset_index()
         
         summary_file = reportdir / 'summary_table.tab'
         summary_df.to_csv(summary_file, sep = '\t', index = False)
@@ -478,6 +657,7 @@ class Report:
             :assembler: assembler used - for versions
             :gubbins: not in use yet
             :pipeline: the type of pipeline - default is sa = snippy and assembly
+        each section is rendered into a fragment in cache/report and only rendered again when its input files change
         '''
 
         # set up paths variables
@@ -491,7 +671,11 @@ class Report:
         # copy scc across to report dir
         csstemplate = jinja2.Template(pathlib.Path(resources,'job.css').read_text())
         csstarget = reportdir / 'job.css'
-        csstarget.write_text(csstemplate.render())
+        css = csstemplate.render()
+        if not csstarget.exists() or csstarget.read_text() != css:
+            csstarget.write_text(css)
+        # rendered sections from previous runs
+        cache = FragmentCache(pathlib.Path(workdir, 'cache', 'report'))
         # save tool table
         self.get_software_file(reportdir = reportdir, pipeline = pipeline, assembler = assembler)
         
@@ -533,7 +717,7 @@ class Report:
             # td.extend(s_td)
         elif pipeline == 'all':
             # a_ll = td.extend()
-            roary_td = [{'file':'summary_statistics.txt', 'title':'Pan Genome', 'type': 'pan', 'image': f"{pathlib.Path('pan_genome.svg').open().read()}", 'link':'pan-genome'}]
+            roary_td = [{'file':'summary_statistics.txt', 'title':'Pan Genome', 'type': 'pan', 'image': pathlib.Path('pan_genome.svg'), 'link':'pan-genome'}]
             td.extend(a_td)
             td.extend(s_td)
             td.extend(roary_td)
@@ -547,35 +731,33 @@ class Report:
         # get versions of software
         versions_td = {'file': 'software_versions.tab', 'title': 'Tools', 'type': 'versions', 'link':'versions'}
         td.append(versions_td)
-        snpdistances = ''
-        snpdensity = ''
-        # add data to sections
+        # add data to sections, the data of each section is in a script in sections/ that is loaded when the section is opened
         # print(td)
         for t in range(len(td)):
             # print(t)
             # TODO if table add a modal modal + link and link will be title lowercase with hyphen
             if td[t]['type'] == 'table':
-                td[t]['head'], td[t]['body'] = self.write_tables(reportdir=reportdir, table=td[t]['file'])
+                td[t]['head'] = self.cached_table(cache, reportdir=reportdir, table=td[t]['file'], link = td[t]['link'])
             if td[t]['type'] == 'tree':
-                td[t]['image'] = self.get_tree_image(reportdir = reportdir)
+                self.cached_tree(cache, reportdir = reportdir, link = td[t]['link'])
             if td[t]['type'] == 'pan':
-                td[t]['head'], td[t]['body'] = self.write_tables(reportdir=reportdir, table=td[t]['file'])
+                td[t]['head'] = self.cached_table(cache, reportdir=reportdir, table=td[t]['file'], link = td[t]['link'], image = td[t]['image'])
 
             if td[t]['link'] == 'snp-distances':
-                td[t]['head'], td[t]['body'] = self.write_tables(reportdir=reportdir, table=td[t]['file'])
-                snpdistances = self.plot_distances(reportdir=reportdir)
+                self.cached_section(cache, reportdir, td[t]['link'], [reportdir / 'distances.tab'], lambda: self.plot_distances(reportdir=reportdir))
             if td[t]['link'] == 'snp-density':
-                snpdensity= self.plot_snpdensity(reportdir= reportdir, workdir=workdir)
+                core = pathlib.Path(workdir, 'core.pack') if pathlib.Path(workdir, 'core.pack').exists() else reportdir / 'core.tab'
+                self.cached_section(cache, reportdir, td[t]['link'], [core, pathlib.Path(workdir, 'ref.fa.fai')], lambda: self.plot_snpdensity(reportdir= reportdir, workdir=workdir))
             if td[t]['type'] == 'versions':
-                td[t]['head'], td[t]['body'] = self.write_tables(reportdir=reportdir, table=td[t]['file'])
+                td[t]['head'] = self.cached_table(cache, reportdir=reportdir, table=td[t]['file'], link = td[t]['link'])
             if td[t]['type'] == 'summary':
-                self.generate_summary(reportdir = reportdir)
-                td[t]['head'], td[t]['body'] = self.write_tables(reportdir = reportdir, table = td[t]['file'])
+                td[t]['head'] = self.cached_summary(cache, reportdir = reportdir, link = td[t]['link'])
         
         # fill template
         date = datetime.datetime.today().strftime("%d/%m/%y")
         report_template = jinja2.Template(pathlib.Path(indexhtml).read_text())
-        reporthtml.write_text(report_template.render( display = display,tables = tables,td = td, job_id = job_id, pipeline = pipeline, snpdistances=snpdistances, snpdensity = snpdensity, modaltables = modaltables, date = date))
+        # the report is a shell, the data of each section is loaded from its script when the section is opened
+        report_template.stream( display = display,tables = tables,td = td, job_id = job_id, pipeline = pipeline, modaltables = modaltables, date = date).dump(f"{reporthtml}")
     #    TODO pass a list of links for the javascript section called 'table'
     # TODO pass the value of the graphs as separate variable 
         return(True)